@@ -0,0 +1,155 @@
+import hashlib
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, Dict, FrozenSet, Optional, Set, Tuple
+
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '1000'))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', str(24 * 3600)))
+
+WORD_RE = re.compile(r"[a-z0-9_]+")
+# Words that never change what is asked. Interrogatives (how, why, ...), negations (not,
+# without, ...), modals like should and verbs like use are content: they change the answer.
+STOPWORDS = {
+    'a', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'by', 'can', 'could', 'do', 'does', 'for',
+    'from', 'i', 'in', 'is', 'it', 'me', 'my', 'of', 'on', 'or', 'please', 'so',
+    'the', 'there', 'this', 'to', 'via', 'way', 'we', 'with', 'would', 'you', 'your',
+}
+
+
+def normalize(question: str) -> str:
+    """Lowercase, strip punctuation and collapse whitespace."""
+    return ' '.join(WORD_RE.findall(question.lower()))
+
+
+def terms(question: str) -> Set[str]:
+    """Content words of a question with plural 's' stripped, the key of near-duplicate lookups."""
+    words = set()
+    for word in WORD_RE.findall(question.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        words.add(word)
+    return words
+
+
+_file_hashes: Dict[str, Tuple[Tuple[int, int], str]] = {}
+
+
+def file_hash(path: str) -> str:
+    """SHA-256 of a file, recomputed only when its mtime or size changes."""
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _file_hashes.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    _file_hashes[path] = (key, digest.hexdigest())
+    return _file_hashes[path][1]
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    terms: FrozenSet[str]
+    created: float
+
+
+class AnswerCache:
+    """LRU + TTL cache of answers keyed by normalized question and knowledge base version.
+
+    Exact matches are a dict lookup. Near-duplicates, questions with the same content words
+    in another order or with other stopwords and plurals, are a second lookup keyed by those
+    words. Questions differing in a content word always miss: one different word, e.g.
+    another network, can need another answer. When version() changes (knowledge-base.txt
+    regenerated) every entry is dropped.
+    """
+
+    def __init__(self, version: Callable[[], str], max_entries: int = ANSWER_CACHE_SIZE,
+                 ttl: float = ANSWER_CACHE_TTL, clock: Callable[[], float] = time.monotonic):
+        self.version = version
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = Lock()
+        self._entries: 'OrderedDict[str, CachedAnswer]' = OrderedDict()
+        # Content words -> key of the latest entry with them
+        self._by_terms: Dict[FrozenSet[str], str] = {}
+        self._version = None
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def get(self, question: str, count: bool = True) -> Optional[str]:
+        """Cached answer to question or a near-duplicate; count=False leaves hit / miss stats alone."""
+        key = normalize(question)
+        with self._lock:
+            self._check_version()
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += count
+                return entry.answer
+
+            words = frozenset(terms(question))
+            if words and words in self._by_terms:
+                entry = self._lookup(self._by_terms[words])
+                if entry is not None:
+                    self.near_hits += count
+                    return entry.answer
+            self.misses += count
+            return None
+
+    def put(self, question: str, answer: str, version: Optional[str] = None) -> None:
+        """Cache an answer; skipped if it was written for a version() that is no longer current."""
+        key = normalize(question)
+        if not key:
+            return
+        words = frozenset(terms(question))
+        with self._lock:
+            self._check_version()
+            if version is not None and version != self._version:
+                return
+            self._remove(key)
+            self._entries[key] = CachedAnswer(question, answer, words, self.clock())
+            if words:
+                self._by_terms[words] = key
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_terms.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _check_version(self) -> None:
+        version = self.version()
+        if version != self._version:
+            self._entries.clear()
+            self._by_terms.clear()
+            self._version = version
+
+    def _lookup(self, key: str) -> Optional[CachedAnswer]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self.clock() - entry.created > self.ttl:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None and self._by_terms.get(entry.terms) == key:
+            del self._by_terms[entry.terms]
@@ -5,11 +5,25 @@ import datetime
 import argparse
 import base64
 import yaml
-from anthropic import Anthropic, APIError, APIConnectionError, APITimeoutError
+from anthropic import APIError, APIConnectionError, APITimeoutError
+
+# Shared modules (retrieval, ...) live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from retrieval import KnowledgeIndex, CHUNK_TOKENS, CONTEXT_TOKENS, TOP_K, estimate_tokens
+from llm import create_message
+from prompts import SOURCES_PROMPT, KnowledgeBase
+from tokens import TokenBudgetExceeded
+from clients import anthropic_client
+from routing import COMMAND_ROUTES, route_for
+from concat import EXCLUDED_PATTERNS, iter_source_files, is_known_binary, looks_like_text, SNIFF_BYTES
+from repo_cache import CorpusCache, sync_repository
 
 CONFIG_FILE = 'claude_config.yml'
 SOURCES_DIR = 'sources'
 RESPONSES_DIR = 'responses'
+# Files larger than this are never sent, and sources stop once the budget is reached
+MAX_FILE_BYTES = int(os.getenv('SOURCE_MAX_FILE_BYTES', str(512 * 1024)))
+SOURCE_TOKEN_BUDGET = int(os.getenv('SOURCE_TOKEN_BUDGET', '150000'))
 
 os.makedirs(SOURCES_DIR, exist_ok=True)
 os.makedirs(RESPONSES_DIR, exist_ok=True)
@@ -34,64 +48,138 @@ def load_api_key():
         print(f"Error loading API key: {str(e)}")
         sys.exit(1)
 
-def clone_repository(repo_url):
-    repo_name = repo_url.split('/')[-1].replace('.git', '')
-    repo_path = os.path.join(SOURCES_DIR, repo_name)
+def clone_repository(repo_url, depth=1, branch=None):
+    """Shallow clone into SOURCES_DIR, or fetch the new commits of an existing clone."""
     try:
-        subprocess.run(["git", "clone", repo_url, repo_path], check=True)
-        print(f"Successfully cloned repository to {repo_path}")
-        return repo_name
+        repo_path, commit = sync_repository(repo_url, SOURCES_DIR, depth, branch)
+        print(f"Repository {repo_path} is at {commit[:12]}")
+        return os.path.basename(repo_path)
     except subprocess.CalledProcessError as e:
-        print(f"Error cloning repository: {str(e)}")
+        print(f"Error cloning repository: {e.stderr.strip() or e}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error cloning repository: {e}")
         sys.exit(1)
 
-def concatenate_sources(source_dirs):
-    concatenated_content = ""
+class SourceReport:
+    """Which files made it into the prompt, and why the others were dropped."""
+
+    def __init__(self):
+        self.included = []
+        self.dropped = []
+        self.tokens = 0
+        self.cached = False
+
+    def to_dict(self):
+        return {'included': self.included, 'dropped': self.dropped, 'tokens': self.tokens}
+
+    def restore(self, data):
+        """Fill in the report of a cached corpus, saved with to_dict."""
+        self.included = [tuple(item) for item in data['included']]
+        self.dropped = [tuple(item) for item in data['dropped']]
+        self.tokens = data['tokens']
+        self.cached = True
+
+    def summary(self, limit=20):
+        lines = [f"Included {len(self.included)} files (~{self.tokens} tokens), dropped {len(self.dropped)}"
+                 + (' (cached corpus)' if self.cached else '')]
+        for file_path, reason in self.dropped[:limit]:
+            lines.append(f"  - {file_path}: {reason}")
+        if len(self.dropped) > limit:
+            lines.append(f"  ... and {len(self.dropped) - limit} more")
+        return '\n'.join(lines)
+
+def iter_source_sections(source_dirs, token_budget=SOURCE_TOKEN_BUDGET, report=None):
+    """Yield one '######## path' section per usable source file until token_budget is reached.
+
+    Uses concat.py's exclusion rules (.git, node_modules, lock files, ...), skips known
+    binary extensions and oversized files without reading them, and sniffs the first
+    bytes of everything else before reading the rest.
+    """
+    report = report if report is not None else SourceReport()
     for src_dir in source_dirs:
         full_src_dir = os.path.join(SOURCES_DIR, src_dir)
         if not os.path.exists(full_src_dir):
             print(f"Error: Source directory '{src_dir}' not found in {SOURCES_DIR}")
             sys.exit(1)
-            
-        for root, dirs, files in os.walk(full_src_dir):
-            for file in files:
-                if file.endswith('.lock'):  # Skip lock files
+
+        for path in iter_source_files(full_src_dir):
+            file_path = str(path)
+            if report.tokens >= token_budget:
+                report.dropped.append((file_path, 'token budget reached'))
+                continue
+            if is_known_binary(file_path):
+                report.dropped.append((file_path, 'binary'))
+                continue
+            try:
+                size = path.stat().st_size
+                if size > MAX_FILE_BYTES:
+                    report.dropped.append((file_path, f'larger than {MAX_FILE_BYTES} bytes'))
                     continue
-                file_path = os.path.join(root, file)
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        concatenated_content += f'######## {file_path}\n\n'
-                        concatenated_content += f.read() + '\n\n'
-                except Exception as e:
-                    print(f"Skipping non-text file or error reading file: {file_path} - {e}")
-    return concatenated_content
-
-def send_claude_prompt(concatenated_content, prompt):
+                if report.tokens + size // 4 > token_budget:
+                    report.dropped.append((file_path, 'would exceed token budget'))
+                    continue
+                with open(path, 'rb') as f:
+                    header = f.read(SNIFF_BYTES)
+                    if not looks_like_text(header):
+                        report.dropped.append((file_path, 'binary'))
+                        continue
+                    content = (header + f.read()).decode('utf-8')
+            except UnicodeDecodeError:
+                report.dropped.append((file_path, 'not UTF-8'))
+                continue
+            except OSError as e:
+                print(f"Skipping file, error reading: {file_path} - {e}")
+                report.dropped.append((file_path, 'read error'))
+                continue
+
+            section = f'######## {file_path}\n\n{content}\n\n'
+            tokens = estimate_tokens(section)
+            report.tokens += tokens
+            report.included.append((file_path, tokens))
+            yield section
+
+def concatenate_sources(source_dirs, token_budget=SOURCE_TOKEN_BUDGET, report=None, use_cache=True):
+    """All sections of source_dirs as one text.
+
+    When every directory is a git clone, the text is cached per checked out commit and
+    filter settings, so an unchanged repository is not walked again.
+    """
+    report = report if report is not None else SourceReport()
+    cache = CorpusCache(SOURCES_DIR)
+    settings = {'token_budget': token_budget, 'max_file_bytes': MAX_FILE_BYTES,
+                'excluded': sorted(EXCLUDED_PATTERNS)}
+    key = cache.key(source_dirs, settings) if use_cache else None
+    cached = cache.load(key) if key else None
+    if cached is not None:
+        text, data = cached
+        report.restore(data)
+        return text
+    text = ''.join(iter_source_sections(source_dirs, token_budget, report))
+    if key:
+        cache.store(key, text, report.to_dict())
+    return text
+
+def send_claude_prompt(concatenated_content, prompt, cache_sources=True, route=None):
     try:
-        client = Anthropic(api_key=load_api_key())
-        
-        system_prompt = """
-/- Analyze the provided source code and documentation.
-/- Base your answers solely on the provided content.
-/- If the answer cannot be found in the sources, state that clearly.
-/- When referencing specific parts of the code, cite the relevant file paths.
-/- Provide concrete examples when possible.
-"""
-        
-        messages = [{
-            "role": "user",
-            "content": f"{system_prompt}\n\nSource Content:\n{concatenated_content}\n\nQuestion/Task: {prompt}"
-        }]
-
-        response = client.messages.create(
-            model="claude-3-opus-20240229",
-            max_tokens=4000,
-            temperature=0,
-            messages=messages
-        )
+        client = anthropic_client(load_api_key())
+
+        # System prompt + sources are a cacheable prefix, so repeated prompts against
+        # the same sources only pay for the question
+        route = route or route_for('cli', prompt)
+        if cache_sources:
+            request = SOURCES_PROMPT.request(prompt, knowledge_base=KnowledgeBase(concatenated_content),
+                                             model=route.model, max_tokens=route.max_tokens)
+        else:
+            request = SOURCES_PROMPT.request(prompt, excerpts=concatenated_content,
+                                             model=route.model, max_tokens=route.max_tokens)
+        response = create_message(client, request, label='gpt.py', account='gpt.py')
         
         return response.content[0].text
     
+    except TokenBudgetExceeded as e:
+        print(f"Error: {str(e)}, lower --max-tokens or drop --full")
+        sys.exit(1)
     except (APIError, APIConnectionError, APITimeoutError) as e:
         print(f"Claude API error: {str(e)}")
         sys.exit(1)
@@ -107,13 +195,22 @@ def main():
     subparsers.add_parser('config', help='Configure the Claude API key')
     
     # Clone command
-    clone_parser = subparsers.add_parser('clone', help='Clone a GitHub repository into the sources directory')
+    clone_parser = subparsers.add_parser('clone', help='Clone a GitHub repository into the sources directory, or update it')
     clone_parser.add_argument('repo_url', type=str, help='GitHub repository URL to clone')
+    clone_parser.add_argument('--depth', type=int, default=1, help='Commits of history to fetch, 0 for all')
+    clone_parser.add_argument('-b', '--branch', help='Branch, tag or commit to check out, remembered by the clone (default: the remote HEAD, then the one asked for last)')
     
     # Prompt command
     prompt_parser = subparsers.add_parser('prompt', help='Send a prompt to Claude with concatenated source directories')
     prompt_parser.add_argument('--src', action='append', required=True, help='Source directory to include in the prompt')
     prompt_parser.add_argument('prompt', type=str, help='Prompt text to send to Claude')
+    prompt_parser.add_argument('-k', '--top-k', type=int, default=TOP_K, help='Number of source chunks to retrieve')
+    prompt_parser.add_argument('--chunk-tokens', type=int, default=CHUNK_TOKENS, help='Max estimated tokens per source chunk')
+    prompt_parser.add_argument('--context-tokens', type=int, default=CONTEXT_TOKENS, help='Max estimated tokens of sources sent with the prompt')
+    prompt_parser.add_argument('--full', action='store_true', help='Send all sources instead of the most relevant chunks')
+    prompt_parser.add_argument('--max-tokens', type=int, default=SOURCE_TOKEN_BUDGET, help='Stop reading sources after this many estimated tokens')
+    prompt_parser.add_argument('--no-cache', dest='cache', action='store_false', help='Walk the sources even if a cached corpus exists')
+    prompt_parser.add_argument('-m', '--model', default=COMMAND_ROUTES['cli'], help="'auto' (pick by prompt), fast, standard, large or a model id")
 
     args = parser.parse_args()
 
@@ -126,11 +223,19 @@ def main():
             save_api_key()
         
         elif args.command == 'clone':
-            clone_repository(args.repo_url)
+            clone_repository(args.repo_url, args.depth, args.branch)
         
         elif args.command == 'prompt':
-            concatenated_content = concatenate_sources(args.src)
-            response = send_claude_prompt(concatenated_content, args.prompt)
+            report = SourceReport()
+            concatenated_content = concatenate_sources(args.src, args.max_tokens, report, use_cache=args.cache)
+            print(report.summary())
+            source_index = None
+            if not args.full:
+                source_index = KnowledgeIndex.from_text(concatenated_content, args.chunk_tokens)
+                concatenated_content = source_index.context_for(args.prompt, args.top_k, args.context_tokens)
+            route = route_for('cli', args.prompt, source_index, choice=args.model)
+            print(f"Model: {route.model} ({route.reason})")
+            response = send_claude_prompt(concatenated_content, args.prompt, cache_sources=args.full, route=route)
             
             # Save response with timestamp
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
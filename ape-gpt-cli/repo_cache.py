@@ -0,0 +1,210 @@
+"""Shallow clones under sources/ and a cache of the source corpus built from them.
+
+`gpt.py clone` clones with --depth 1 and, when the repository is already there, fetches
+only the new tip. The corpus a prompt sends is stored under sources/.corpus, keyed by the
+commit checked out in each source directory and the filter settings, so a prompt against
+an unchanged repository reads one file instead of walking the tree. Commits are read from
+.git directly, without running git; a work tree with local changes is never cached, and is
+not updated over.
+"""
+import hashlib
+import json
+import os
+import re
+import subprocess
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+CORPUS_DIR = '.corpus'
+# Corpora kept in the cache, least recently used are removed
+CORPUS_CACHE_ENTRIES = int(os.getenv('SOURCE_CACHE_ENTRIES', '20'))
+# Bump when the corpus format or the file filters change
+CORPUS_VERSION = 2
+# Set in a clone's git config to the branch, tag or commit it was asked for, so updates follow it
+REF_CONFIG = 'ape-gpt.ref'
+COMMIT_RE = re.compile(r'[0-9a-f]{40}')
+
+
+def git(*args: str, cwd: Optional[str] = None) -> str:
+    result = subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True)
+    return result.stdout.strip()
+
+
+def repo_name(repo_url: str) -> str:
+    name = repo_url.rstrip('/').split('/')[-1]
+    return name[:-4] if name.endswith('.git') else name
+
+
+def head_commit(repo_path: str) -> Optional[str]:
+    """Commit checked out in repo_path, or None if it is not a git work tree."""
+    git_dir = os.path.join(repo_path, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r', encoding='utf-8') as f:
+            head = f.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        if os.path.isfile(git_dir):
+            # Linked work trees and submodules point elsewhere, let git resolve them
+            try:
+                return git('rev-parse', 'HEAD', cwd=repo_path)
+            except (OSError, subprocess.CalledProcessError):
+                return None
+        return None
+    if not head.startswith('ref: '):
+        return head
+    ref = head[5:]
+    try:
+        with open(os.path.join(git_dir, ref), 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    try:
+        with open(os.path.join(git_dir, 'packed-refs'), 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def has_local_changes(repo_path: str) -> bool:
+    """Whether repo_path has modified, staged or untracked files (or git cannot tell)."""
+    try:
+        return bool(git('status', '--porcelain', cwd=repo_path))
+    except (OSError, subprocess.CalledProcessError):
+        return True
+
+
+def _git_or_none(*args: str, cwd: Optional[str] = None) -> Optional[str]:
+    try:
+        return git(*args, cwd=cwd) or None
+    except subprocess.CalledProcessError:
+        return None
+
+
+def resolve_ref(repo_url: str, ref: str) -> Tuple[str, Optional[str]]:
+    """What to fetch for a branch, tag, commit or HEAD, and the local branch to check it out as.
+
+    The branch is None for tags and commits, which are checked out detached.
+    """
+    if COMMIT_RE.fullmatch(ref):
+        return ref, None
+    refs = {}
+    for line in git('ls-remote', '--symref', repo_url, ref).splitlines():
+        target, _, name = line.partition('\t')
+        refs[name] = target
+    if ref == 'HEAD' and refs.get('HEAD', '').startswith('ref: refs/heads/'):
+        ref = refs['HEAD'][len('ref: refs/heads/'):]
+        return f'refs/heads/{ref}', ref
+    if f'refs/heads/{ref}' in refs:
+        return f'refs/heads/{ref}', ref
+    if f'refs/tags/{ref}' in refs:
+        return f'refs/tags/{ref}', None
+    raise ValueError(f"{ref} is not a branch or tag of {repo_url}")
+
+
+def sync_repository(repo_url: str, sources_dir: str, depth: int = 1,
+                    branch: Optional[str] = None) -> Tuple[str, str]:
+    """Clone repo_url into sources_dir, or bring an existing clone up to date.
+
+    branch may also be a tag or a commit, checked out detached. It is recorded in the
+    clone, so later updates without one follow it; otherwise they follow the branch
+    checked out, and a detached clone without a record stays where it is. A depth of 0
+    fetches the whole history. Returns (path, commit). An existing clone with local
+    changes is not touched: it raises ValueError rather than discard them.
+    """
+    path = os.path.join(sources_dir, repo_name(repo_url))
+    depth_args = ['--depth', str(depth)] if depth > 0 else []
+    if not os.path.exists(path):
+        if branch and COMMIT_RE.fullmatch(branch):
+            # clone --branch takes no commits, fetch it below
+            git('clone', '--quiet', '--no-checkout', *depth_args, repo_url, path)
+        else:
+            branch_args = ['--branch', branch] if branch else []
+            git('clone', '--quiet', *depth_args, *branch_args, repo_url, path)
+            if branch:
+                git('config', REF_CONFIG, branch, cwd=path)
+            return path, head_commit(path)
+    if head_commit(path) is None:
+        raise ValueError(f"{path} exists and is not a git repository")
+    if has_local_changes(path):
+        raise ValueError(f"{path} has local changes, commit or remove them before updating it")
+    ref = (branch or _git_or_none('config', '--get', REF_CONFIG, cwd=path)
+           or _git_or_none('symbolic-ref', '--quiet', '--short', 'HEAD', cwd=path))
+    if ref is None:
+        return path, head_commit(path)
+    source, local_branch = resolve_ref(repo_url, ref)
+    git('fetch', '--quiet', *depth_args, repo_url, source, cwd=path)
+    if local_branch:
+        git('checkout', '--quiet', '--force', '-B', local_branch, 'FETCH_HEAD', cwd=path)
+    else:
+        git('checkout', '--quiet', '--force', '--detach', 'FETCH_HEAD', cwd=path)
+    git('config', REF_CONFIG, ref, cwd=path)
+    return path, head_commit(path)
+
+
+class CorpusCache:
+    """Corpora built from source directories, keyed by their commits and the filter settings.
+
+    Each entry is <key>.txt (the corpus) and <key>.json (the source report). Directories
+    that are not git work trees, or have local changes, are never cached, since the commit
+    does not tell what they hold.
+    """
+
+    def __init__(self, sources_dir: str, max_entries: int = CORPUS_CACHE_ENTRIES):
+        self.directory = os.path.join(sources_dir, CORPUS_DIR)
+        self.sources_dir = sources_dir
+        self.max_entries = max_entries
+
+    def key(self, source_dirs: Sequence[str], settings: Dict[str, Any]) -> Optional[str]:
+        commits = []
+        for src_dir in source_dirs:
+            commit = head_commit(os.path.join(self.sources_dir, src_dir))
+            if commit is None or has_local_changes(os.path.join(self.sources_dir, src_dir)):
+                return None
+            commits.append([src_dir, commit])
+        identity = json.dumps({'version': CORPUS_VERSION, 'sources': commits, 'settings': settings},
+                              sort_keys=True)
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:24]
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.directory, key)
+        return f'{base}.txt', f'{base}.json'
+
+    def load(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        text_path, report_path = self._paths(key)
+        try:
+            with open(report_path, 'r', encoding='utf-8') as f:
+                report = json.load(f)
+            with open(text_path, 'r', encoding='utf-8', newline='') as f:
+                text = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        # Recently used entries are kept longest
+        os.utime(report_path)
+        return text, report
+
+    def store(self, key: str, text: str, report: Dict[str, Any]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        text_path, report_path = self._paths(key)
+        # The report is written last, so a partial entry is never loaded
+        for path, data in ((text_path, text), (report_path, json.dumps(report))):
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self.prune()
+
+    def entries(self) -> List[str]:
+        """Cached keys, most recently used first."""
+        reports = [name for name in os.listdir(self.directory) if name.endswith('.json')]
+        reports.sort(key=lambda name: os.path.getmtime(os.path.join(self.directory, name)), reverse=True)
+        return [name[:-5] for name in reports]
+
+    def prune(self) -> None:
+        for key in self.entries()[self.max_entries:]:
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
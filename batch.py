@@ -0,0 +1,293 @@
+"""Answer every question of a JSONL file, for `python request.py batch`.
+
+Rows are appended to the output file as they finish, so an interrupted run picks up
+where it stopped: questions that already have an answer row are skipped, failed ones
+are asked again.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from llm import acreate_message
+from routing import Route, escalate, should_escalate
+from tokens import check_budget, cost, estimate_request_tokens
+
+logger = logging.getLogger(__name__)
+
+# Fields read from each input row, first one present wins
+QUESTION_FIELDS = ('question', 'prompt', 'body', 'text')
+ID_FIELDS = ('id', 'request_id', 'custom_id')
+# Message Batches are billed at half the price of regular calls
+BATCH_DISCOUNT = 0.5
+# Questions per submitted Message Batch (the API takes up to 100,000 requests or 256 MB)
+BATCH_SIZE = 500
+
+# (question) -> (messages.create kwargs, route)
+RequestBuilder = Callable[[str], Tuple[Dict[str, Any], Optional[Route]]]
+
+
+@dataclass
+class Question:
+    id: str
+    text: str
+    line: int
+
+
+def read_questions(path: str, question_field: Optional[str] = None,
+                   id_field: Optional[str] = None) -> Iterator[Question]:
+    """Questions from a JSONL file of objects (or plain strings), streamed line by line."""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                logger.warning("%s:%d: not JSON, skipped", path, line_no)
+                continue
+            if isinstance(row, str):
+                yield Question(str(line_no), row, line_no)
+                continue
+            fields = (question_field,) if question_field else QUESTION_FIELDS
+            text = next((row[name] for name in fields if row.get(name)), None)
+            if not isinstance(text, str):
+                logger.warning("%s:%d: no question field (%s), skipped", path, line_no, ', '.join(fields))
+                continue
+            ids = (id_field,) if id_field else ID_FIELDS
+            ident = next((row[name] for name in ids if row.get(name) is not None), line_no)
+            yield Question(str(ident), text, line_no)
+
+
+def answered_ids(path: str) -> Set[str]:
+    """Ids that already have an answer row in the output file."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                # The last row of an interrupted run may be cut short
+                continue
+            if isinstance(row, dict) and 'answer' in row:
+                done.add(str(row.get('id')))
+    return done
+
+
+class ResultWriter:
+    """Appends result rows to a JSONL file, each one flushed as soon as it is written."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = Lock()
+        self.rows = 0
+        self.errors = 0
+        self.tokens = 0
+        self.cost = 0.0
+        self.latencies: List[float] = []
+        # Start on a fresh line if the previous run was interrupted mid-row
+        needs_newline = False
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b'\n'
+        self.file = open(path, 'a', encoding='utf-8')
+        if needs_newline:
+            self.file.write('\n')
+
+    def write(self, row: Dict[str, Any]) -> None:
+        with self._lock:
+            self.file.write(json.dumps(row, ensure_ascii=False) + '\n')
+            self.file.flush()
+            self.rows += 1
+            if 'error' in row:
+                self.errors += 1
+            else:
+                self.tokens += row['input_tokens'] + row['output_tokens']
+                self.cost += row['cost']
+            if row.get('latency_s') is not None:
+                self.latencies.append(row['latency_s'])
+
+    def close(self) -> None:
+        self.file.close()
+
+    def summary(self) -> str:
+        latencies = sorted(self.latencies)
+        p50 = f"{latencies[len(latencies) // 2]:.2f}s" if latencies else '-'
+        return (f"{self.rows} rows written ({self.errors} failed), {self.tokens} tokens, "
+                f"${self.cost:.4f}, p50 latency {p50}")
+
+
+def usage_row(usage, model: str, discount: float = 1.0) -> Dict[str, Any]:
+    return {
+        'model': model,
+        'input_tokens': getattr(usage, 'input_tokens', 0) or 0,
+        'output_tokens': getattr(usage, 'output_tokens', 0) or 0,
+        'cache_read_tokens': getattr(usage, 'cache_read_input_tokens', 0) or 0,
+        'cache_write_tokens': getattr(usage, 'cache_creation_input_tokens', 0) or 0,
+        'cost': round(cost(model, usage) * discount, 6),
+    }
+
+
+async def answer(client, question: Question, build: RequestBuilder) -> Dict[str, Any]:
+    """One result row, escalating low knowledge base matches like request.py does."""
+    started = time.monotonic()
+    row: Dict[str, Any] = {'id': question.id, 'question': question.text}
+    try:
+        request, route = build(question.text)
+        label = f"batch id={question.id}"
+        response = await acreate_message(client, request, label=label, account='batch')
+        text = response.content[0].text
+        totals = usage_row(response.usage, request['model'])
+        while route is not None and should_escalate(route, text):
+            route = escalate(route)
+            response = await acreate_message(client, {**request, 'model': route.model, 'max_tokens': route.max_tokens},
+                                             label=label, account='batch')
+            text = response.content[0].text
+            escalated = usage_row(response.usage, route.model)
+            for key in ('input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens', 'cost'):
+                totals[key] += escalated[key]
+            totals['model'] = route.model
+        row.update(answer=text, **totals)
+    except Exception as e:
+        row['error'] = f"{type(e).__name__}: {e}"
+    row['latency_s'] = round(time.monotonic() - started, 3)
+    return row
+
+
+async def run_concurrent(client, questions: Iterable[Question], build: RequestBuilder, writer: ResultWriter,
+                         concurrency: int = 4, warm_first: bool = False) -> None:
+    """Ask with up to concurrency calls in flight, writing each row as it finishes.
+
+    With warm_first the first question is asked alone, so the others read the knowledge
+    base prefix it wrote to the prompt cache.
+    """
+    questions = iter(questions)
+    if warm_first:
+        first = next(questions, None)
+        if first is not None:
+            writer.write(await answer(client, first, build))
+
+    async def worker():
+        # Workers share the iterator, so the input is never held in memory
+        for question in questions:
+            writer.write(await answer(client, question, build))
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+
+
+def load_state(path: str) -> Optional[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(path: str, state: Dict[str, Any]) -> None:
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def submit_batches(client, questions: Iterable[Question], build: RequestBuilder, writer: ResultWriter,
+                   batch_size: int = BATCH_SIZE,
+                   on_submit: Optional[Callable[[Dict[str, Any]], None]] = None) -> List[Dict[str, Any]]:
+    """Submit the questions as Message Batches; questions over the token budget fail right away.
+
+    on_submit, if given, is called with each batch entry as soon as it is created.
+    """
+    batches, chunk, ids = [], [], {}
+
+    def flush():
+        if chunk:
+            batch = client.messages.batches.create(requests=list(chunk))
+            logger.info("Submitted batch %s with %d questions", batch.id, len(chunk))
+            entry = {'batch_id': batch.id, 'questions': dict(ids)}
+            batches.append(entry)
+            if on_submit is not None:
+                on_submit(entry)
+            chunk.clear()
+            ids.clear()
+
+    for question in questions:
+        try:
+            request, _ = build(question.text)
+            check_budget(estimate_request_tokens(request))
+        except Exception as e:
+            writer.write({'id': question.id, 'question': question.text, 'error': f"{type(e).__name__}: {e}",
+                          'latency_s': None})
+            continue
+        # custom_id allows [a-zA-Z0-9_-]{1,64} only, so rows are named by input line
+        custom_id = f'line-{question.line}'
+        chunk.append({'custom_id': custom_id, 'params': request})
+        ids[custom_id] = [question.id, question.text]
+        if len(chunk) >= batch_size:
+            flush()
+    flush()
+    return batches
+
+
+def run_provider_batches(client, questions: Iterable[Question], build: RequestBuilder, writer: ResultWriter,
+                         state_path: str, poll_interval: float = 30.0, batch_size: int = BATCH_SIZE,
+                         sleep: Callable[[float], None] = time.sleep) -> None:
+    """Answer through the Message Batches API, waiting for the batches to end.
+
+    Each batch id is saved in state_path as soon as the batch is created, and kept until
+    every result is written, so a rerun collects the same batches and only submits the
+    questions that none of them covers.
+    """
+    state = load_state(state_path) or {'batches': []}
+    submitted = {ident for entry in state['batches'] for ident, _ in entry['questions'].values()}
+
+    def on_submit(entry):
+        state['batches'].append(entry)
+        save_state(state_path, state)
+
+    submit_batches(client, (question for question in questions if question.id not in submitted),
+                   build, writer, batch_size, on_submit)
+
+    for entry in state['batches']:
+        batch_id = entry['batch_id']
+        while True:
+            batch = client.messages.batches.retrieve(batch_id)
+            if batch.processing_status == 'ended':
+                break
+            counts = batch.request_counts
+            logger.info("Batch %s: %d processing, %d succeeded, %d errored", batch_id,
+                        counts.processing, counts.succeeded, counts.errored)
+            sleep(poll_interval)
+
+        done = answered_ids(writer.path)
+        for result in client.messages.batches.results(batch_id):
+            ident, text = entry['questions'][result.custom_id]
+            if ident in done:
+                continue
+            row: Dict[str, Any] = {'id': ident, 'question': text}
+            if result.result.type == 'succeeded':
+                message = result.result.message
+                row.update(answer=message.content[0].text,
+                           **usage_row(message.usage, message.model, BATCH_DISCOUNT))
+            else:
+                error = getattr(result.result, 'error', None)
+                row['error'] = f"{result.result.type}: {error}" if error else result.result.type
+            row['latency_s'] = None
+            writer.write(row)
+    os.remove(state_path)
+
+
+def pending_questions(questions: Iterable[Question], done: Set[str]) -> Iterator[Question]:
+    """Questions without an answer yet; repeated ids in the input are asked once."""
+    seen = set(done)
+    for question in questions:
+        if question.id in seen:
+            continue
+        seen.add(question.id)
+        yield question
@@ -0,0 +1,301 @@
+"""Offline benchmark for the bot and request.py against local stub servers.
+
+    python benchmark.py prompt -n 200 -c 20 --latency 0.5
+    python benchmark.py preaudit -n 20 -c 5 --functions 200
+    python benchmark.py cli -n 50 -c 10 --error-rate 0.1
+
+Reports p50/p95/p99 latency, throughput, peak memory, storage writes and stub API calls.
+No request leaves the machine.
+"""
+import argparse
+import asyncio
+import contextvars
+import importlib
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, List
+
+from stub_servers import StubAnthropic, StubTelegram
+
+BENCH_GROUP = -100
+STORAGE_WRITES = ('add_admin', 'set_group', 'add_group_if_missing', 'increment_messages', 'set_usage')
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class Results:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.started = time.perf_counter()
+        self.finished = self.started
+        self.extra: Dict[str, object] = {}
+
+    def summary(self) -> Dict[str, object]:
+        elapsed = self.finished - self.started
+        done = len(self.latencies)
+        return {
+            'requests': done + self.errors,
+            'errors': self.errors,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(done / elapsed, 2) if elapsed else 0.0,
+            'p50_ms': round(percentile(self.latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(self.latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(self.latencies, 99) * 1000, 1),
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            **self.extra,
+        }
+
+
+def questions(count: int, repeat_ratio: float, seed: int) -> List[str]:
+    """Distinct questions built from knowledge base vocabulary, with repeat_ratio of them repeated."""
+    rng = random.Random(seed)
+    vocabulary = ['account', 'network', 'plugin', 'contract', 'deploy', 'test', 'provider', 'compile',
+                  'console', 'transaction', 'gas', 'fork', 'project', 'config', 'query', 'event', 'proxy']
+    pool = [f"how do I use {' '.join(rng.sample(vocabulary, 3))} in ape" for _ in range(5)]
+    return [rng.choice(pool) if rng.random() < repeat_ratio
+            else f"how do I use {' '.join(rng.sample(vocabulary, 4))} with item {i} in ape"
+            for i in range(count)]
+
+
+def count_storage_writes(storage) -> Dict[str, int]:
+    """Wrap the storage instance's write methods with counters."""
+    counts = dict.fromkeys(STORAGE_WRITES, 0)
+
+    def counted(name, method):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return method(*args, **kwargs)
+        return wrapper
+
+    for name in STORAGE_WRITES:
+        setattr(storage, name, counted(name, getattr(storage, name)))
+    return counts
+
+
+def stage_means() -> Dict[str, float]:
+    """Mean milliseconds per recorded stage (knowledge, claude, first_token, split, telegram, ...)."""
+    from metrics import STAGE_SECONDS
+    stages = {key[0] for key in STAGE_SECONDS._values}
+    return {stage: round(STAGE_SECONDS.total(stage=stage) / STAGE_SECONDS.count(stage=stage) * 1000, 2)
+            for stage in sorted(stages)}
+
+
+def load_bot(args, anthropic_stub: StubAnthropic, workdir: str):
+    """Import bot.py configured for the stubs: a temp database and no rate limits unless set."""
+    os.environ['ANTHROPIC_BASE_URL'] = anthropic_stub.url
+    os.environ.setdefault('CLAUDE_KEY', 'benchmark')
+    os.environ['BOT_DB'] = os.path.join(workdir, 'bench.db')
+    os.environ['STREAM_RESPONSES'] = 'true' if args.stream else 'false'
+    for knob in ('GROUP_MESSAGES_PER_DAY', 'USER_MESSAGES_PER_HOUR', 'GLOBAL_MESSAGES_PER_MINUTE',
+                 'GROUP_TOKENS_PER_DAY', 'TELEGRAM_CHAT_INTERVAL', 'TELEGRAM_GROUP_PER_MINUTE',
+                 'TELEGRAM_GLOBAL_PER_SECOND'):
+        os.environ.setdefault(knob, '0')
+    bot = importlib.import_module('bot')
+    bot.load_data()
+    bot.storage.set_group(str(BENCH_GROUP))
+    bot.groups[str(BENCH_GROUP)] = {'messages_today': 0, 'last_reset': str(time.strftime('%Y-%m-%d'))}
+    return bot
+
+
+async def drive_bot(args, anthropic_stub: StubAnthropic, telegram_stub: StubTelegram, workdir: str) -> Results:
+    bot = load_bot(args, anthropic_stub, workdir)
+    try:
+        return await send_updates(args, bot, anthropic_stub, telegram_stub)
+    finally:
+        # Stop the SQLite event poller before the temporary directory goes away
+        bot.state_backend.close()
+
+
+async def send_updates(args, bot, anthropic_stub: StubAnthropic, telegram_stub: StubTelegram) -> Results:
+    from telegram import Bot, Update
+    from telegram.request import HTTPXRequest
+    import llm
+    from metrics import current_trace
+
+    writes = count_storage_writes(bot.storage)
+    done: Dict[int, asyncio.Future] = {}
+    # The update being handled, inherited by the queued job and the tasks it starts
+    current = contextvars.ContextVar('current')
+
+    # Claude responses received per update
+    responses: Dict[int, int] = {}
+    record_response = llm.record_response
+
+    def counted_response(*args, **kwargs):
+        i = current.get(None)
+        responses[i] = responses.get(i, 0) + 1
+        return record_response(*args, **kwargs)
+
+    llm.record_response = counted_response
+
+    # Completion of the queued job, keyed by the update's message id: (time, failed). A job
+    # fails if it replied with an error, or answered without any Claude response
+    def finished(job):
+        async def wrapper(update, *rest, **kwargs):
+            failed = True
+            try:
+                await job(update, *rest, **kwargs)
+                trace = current_trace()
+                outcome = trace.outcome if trace is not None else None
+                failed = outcome == 'error' or (outcome == 'answered' and not responses.get(current.get(None)))
+            finally:
+                future = done.get(update.message.message_id)
+                if future is not None and not future.done():
+                    future.set_result((time.perf_counter(), failed))
+        return wrapper
+
+    bot.answer_message = finished(bot.answer_message)
+    bot.run_preaudit = finished(bot.run_preaudit)
+
+    # Which handler calls queued a job; cache hits reply inline and busy replies are errors
+    queued, rejected = set(), set()
+    submit = bot.request_queue.submit
+
+    def tracked_submit(group_id, job):
+        accepted = submit(group_id, job)
+        (queued if accepted else rejected).add(current.get())
+        return accepted
+
+    bot.request_queue.submit = tracked_submit
+
+    request = HTTPXRequest(connection_pool_size=max(args.concurrency * 2, 8))
+    telegram_bot = Bot('123:bench', base_url=f'{telegram_stub.url}/bot', request=request)
+    results = Results()
+    texts = questions(args.requests, args.repeat_ratio, args.seed)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            text = f'/p {texts[i]}' if args.scenario == 'prompt' else \
+                f'/preaudit {anthropic_stub.url}/sources/contract{i % args.distinct_sources}.vy'
+            update = Update.de_json({
+                'update_id': i,
+                'message': {'message_id': i, 'date': int(time.time()), 'text': text,
+                            'chat': {'id': BENCH_GROUP, 'type': 'supergroup', 'title': 'bench'},
+                            'from': {'id': 1000 + i % 50, 'is_bot': False, 'first_name': 'user'}},
+            }, telegram_bot)
+            future = done[i] = asyncio.get_running_loop().create_future()
+            current.set(i)
+            started = time.perf_counter()
+            context = SimpleNamespace(args=text.split()[1:])
+            if args.scenario == 'prompt':
+                await bot.handle_message(update, context)
+            else:
+                await bot.preaudit(update, context)
+            if i in rejected:
+                results.errors += 1
+                return
+            try:
+                end, failed = await asyncio.wait_for(future, timeout=args.timeout) if i in queued \
+                    else (time.perf_counter(), False)
+            except asyncio.TimeoutError:
+                results.errors += 1
+                return
+            if failed:
+                results.errors += 1
+            else:
+                results.latencies.append(end - started)
+
+    async with telegram_bot:
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        await bot.request_queue.join()
+    results.finished = time.perf_counter()
+    results.extra['storage_writes'] = sum(writes.values())
+    results.extra['answer_cache_hits'] = bot.answer_cache.hits + bot.answer_cache.near_hits
+    results.extra['stage_mean_ms'] = stage_means()
+    return results
+
+
+def drive_cli(args, anthropic_stub: StubAnthropic) -> Results:
+    os.environ['ANTHROPIC_BASE_URL'] = anthropic_stub.url
+    import request as request_cli
+    from clients import anthropic_client
+    from retrieval import KnowledgeIndex
+
+    client = anthropic_client('benchmark')
+    index = KnowledgeIndex.from_file(args.knowledge_base)
+    results = Results()
+    texts = questions(args.requests, args.repeat_ratio, args.seed)
+
+    def one(text: str) -> None:
+        started = time.perf_counter()
+        request = request_cli.create_request(index.context_for(text), text)
+        try:
+            request_cli.create_message(client, request, label='benchmark')
+            results.latencies.append(time.perf_counter() - started)
+        except Exception:
+            results.errors += 1
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one, texts))
+    results.finished = time.perf_counter()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark against stub Anthropic and Telegram servers')
+    parser.add_argument('scenario', choices=('prompt', 'preaudit', 'cli'))
+    parser.add_argument('-n', '--requests', type=int, default=100)
+    parser.add_argument('-c', '--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.2, help='Stub Claude seconds before the first byte')
+    parser.add_argument('--token-delay', type=float, default=0.0, help='Stub seconds between streamed chunks')
+    parser.add_argument('--answer-tokens', type=int, default=200)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of Claude calls answered with 529')
+    parser.add_argument('--match-score', type=int, default=90, help='Knowledge base match score in stub answers')
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--no-stream', dest='stream', action='store_false', help='Send whole answers instead of streaming')
+    parser.add_argument('--repeat-ratio', type=float, default=0.0, help='Share of repeated questions (answer cache)')
+    parser.add_argument('--functions', type=int, default=40, help='Functions in each stub /preaudit source')
+    parser.add_argument('--distinct-sources', type=int, default=1000000, help='Distinct /preaudit URLs')
+    parser.add_argument('--knowledge-base', default='knowledge-base.txt')
+    parser.add_argument('--timeout', type=float, default=300.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tracemalloc', action='store_true', help='Report peak Python heap (slows the run)')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    anthropic_stub = StubAnthropic(args.latency, args.token_delay, args.answer_tokens, args.error_rate,
+                                   args.match_score, args.functions, args.seed)
+    with anthropic_stub, StubTelegram(args.telegram_latency) as telegram_stub, \
+            tempfile.TemporaryDirectory() as workdir:
+        if args.scenario == 'cli':
+            results = drive_cli(args, anthropic_stub)
+        else:
+            results = asyncio.run(drive_bot(args, anthropic_stub, telegram_stub, workdir))
+        report = results.summary()
+        report['claude_calls'] = anthropic_stub.calls['messages']
+        report['claude_errors'] = anthropic_stub.calls['errors']
+        report['source_fetches'] = anthropic_stub.calls['source']
+        report['telegram_calls'] = dict(telegram_stub.calls)
+    if args.tracemalloc:
+        report['peak_heap_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+    else:
+        for key, value in report.items():
+            print(f"{key:>20}: {value}")
+    if not report['claude_calls']:
+        print("No request reached the stub Claude API, the numbers above measure nothing", file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,39 +1,82 @@
 import os
-import yaml
+import asyncio
 import datetime
-from threading import Lock
-from telegram import Update, ParseMode
-from telegram.ext import Updater, CommandHandler, CallbackContext, MessageHandler, Filters
+from telegram import Update
+from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 import requests
-import anthropic
+from anthropic import APIError, APIConnectionError, APITimeoutError
 import logging
-
+from retrieval import KB_MODE
+from llm import acreate_message, astream_message, total_tokens, claude_circuit
+from clients import async_anthropic_client
+from retry import CircuitOpen
+from routing import route_for, should_escalate, escalate, confidence_score
+from tokens import TokenBudgetExceeded, ledger
+from preaudit import (SourceTooLarge, fetch_source, split_source, chunk_request, merge_request, audit_chunks,
+                      reports as preaudit_reports)
+from workers import RequestQueue, SingleFlight
+from replies import StreamingReply, reply, send_markdown
+from storage import DB_PATH, Storage
+from state import STATE_BACKEND, open_backend
+from ratelimit import RateLimiter
+from answer_cache import AnswerCache, normalize
+from prompts import ANSWER_PROMPT, KNOWLEDGE_BASE_PATH
+from knowledge import LiveKnowledgeBase
+from conversations import CONVERSATION_MODEL_SUMMARIES, ConversationStore, summary_request
+from metrics import (ERRORS, RATE_LIMITED, configure_logging, current_trace, registry, start_metrics_server,
+                     start_trace, timed)
+
+
+logger = logging.getLogger(__name__)
 
 # Load your Claude API key and Telegram token from environment variables or direct string assignment
 CLAUDE_KEY = os.getenv('CLAUDE_KEY')
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+# Stream answers into a progressively edited message instead of waiting for the full answer
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() in ('1', 'true', 'yes')
 
-# Initialize Claude client
-client = anthropic.Anthropic(
-    # defaults to os.environ.get("ANTHROPIC_API_KEY")
-    api_key=CLAUDE_KEY
-)
+# Initialize Claude client, one per process so its connections are kept alive
+client = async_anthropic_client(CLAUDE_KEY)
 
-# Initialize a lock for thread-safe file writing
-file_lock = Lock()
+# Shared by replicas: admins, groups, message counters and rate limit buckets
+state_backend = open_backend(STATE_BACKEND, DB_PATH)
 
-# Load or initialize the admin list and group whitelist
+# Admin list and group whitelist, loaded from storage by load_data and kept current by on_state_change
+storage = None
 admins = {}
 groups = {}
 usage_data = {}
 
-def start(update: Update, context: CallbackContext) -> None:
-    update.message.reply_text('Hello! Ask me anything about ApeWorX!')
+# Slow Claude calls run here so handlers return right away
+request_queue = RequestQueue()
+
+# Message and token quotas per group, per user and globally
+rate_limiter = RateLimiter(backend=state_backend)
+
+# Load knowledge base and index it for retrieval; a changed knowledge-base.txt is swapped in while running
+knowledge = LiveKnowledgeBase(KNOWLEDGE_BASE_PATH, templates=[ANSWER_PROMPT])
+
+# Answers to repeated questions, dropped whenever the knowledge base version changes
+answer_cache = AnswerCache(lambda: knowledge.version)
+
+# Claude calls in progress, joined by identical questions asked meanwhile
+in_flight = SingleFlight()
+
+# Recent turns per thread, so replies to the bot's answers carry the conversation
+conversations = ConversationStore()
 
-# Load knowledge base
-knowledge_base = ''
-with open('knowledge-base.txt', 'r', encoding="utf-8") as file:
-    knowledge_base = file.read()
+registry.gauge('bot_queue_pending', 'Jobs queued or running', function=lambda: request_queue.pending)
+registry.gauge('claude_circuit_open', '1 while Claude calls fail fast', function=lambda: int(claude_circuit.retry_in() > 0))
+KNOWLEDGE_VERSION = registry.gauge('knowledge_base_info', 'Knowledge base version being served', ['version'])
+KNOWLEDGE_VERSION.set(1, version=knowledge.version)
+registry.gauge('knowledge_base_loaded_timestamp_seconds', 'When the knowledge base version was loaded',
+               function=lambda: knowledge.current().loaded)
+
+def on_knowledge_swap(snapshot) -> None:
+    KNOWLEDGE_VERSION.clear()
+    KNOWLEDGE_VERSION.set(1, version=snapshot.version)
+
+knowledge.on_swap.append(on_knowledge_swap)
 
 # Default configurations
 DEFAULT_ADMINS = {
@@ -45,200 +88,416 @@ DEFAULT_GROUPS = {
     '-4069234649': {'messages_today': 0, 'last_reset': str(datetime.date.today())},
 }
 
-def safe_split_message(text, max_length=4000):
-    """Split message while preserving markdown code blocks."""
-    messages = []
-    current_message = ""
-    code_block = False
-    
-    for line in text.split('\n'):
-        if line.startswith('```'):
-            code_block = not code_block
-            
-        if len(current_message + line + '\n') > max_length and not code_block:
-            messages.append(current_message)
-            current_message = line + '\n'
-        else:
-            current_message += line + '\n'
-            
-    if current_message:
-        messages.append(current_message)
-        
-    return messages
-
 def load_data():
-    global admins, groups, usage_data
-    try:
-        with open('admins.yml', 'r') as f:
-            admins = yaml.safe_load(f) or DEFAULT_ADMINS
-    except FileNotFoundError:
-        admins = DEFAULT_ADMINS.copy()
-
-    try:
-        with open('groups.yml', 'r') as f:
-            groups = yaml.safe_load(f) or DEFAULT_GROUPS
-    except FileNotFoundError:
-        groups = DEFAULT_GROUPS.copy()
-
-    try:
-        with open('usage.yml', 'r') as f:
-            usage_data = yaml.safe_load(f) or {}
-    except FileNotFoundError:
-        usage_data = {}
+    global admins, groups, usage_data, storage
+    storage = Storage(backend=state_backend)
+    # One-time imports of the bot.db tables and admins.yml, groups.yml and usage.yml of older versions
+    storage.migrate_from_tables()
+    storage.migrate_from_yaml()
 
     # Ensure default admins and groups are always present
-    for admin_id, value in DEFAULT_ADMINS.items():
-        admins.setdefault(admin_id, value)
-    for group_id, group_data in DEFAULT_GROUPS.items():
-        groups.setdefault(group_id, group_data)
-
-def save_data():
-    with file_lock:
-        with open('admins.yml', 'w') as f:
-            yaml.dump(admins, f)
-        with open('groups.yml', 'w') as f:
-            yaml.dump(groups, f)
-        with open('usage.yml', 'w') as f:
-            yaml.dump(usage_data, f)
-
-def start(update: Update, context: CallbackContext) -> None:
-    update.message.reply_text('Hello! Ask me anything about ApeWorX!')
-
-def add_admin(update: Update, context: CallbackContext) -> None:
+    for admin_id in DEFAULT_ADMINS:
+        storage.add_admin(admin_id)
+    for group_id in DEFAULT_GROUPS:
+        storage.add_group_if_missing(group_id)
+
+    admins, groups, usage_data = storage.load()
+    storage.watch(on_state_change)
+    # Pick up a regenerated knowledge-base.txt without a restart
+    knowledge.start()
+
+def on_state_change(kind: str, key: str) -> None:
+    """Apply an admin or group change made by any replica (called from a background thread)."""
+    if kind == 'admin':
+        admins[key] = True
+    elif kind == 'group':
+        group = storage.group(key)
+        if group is not None:
+            groups[key] = group
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await reply(update.message, 'Hello! Ask me anything about ApeWorX!')
+
+async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     owner_id = '67950696'
     if update.message.from_user.id == int(owner_id):
         new_admin_id = context.args[0] if context.args else ''
         admins[new_admin_id] = True
-        save_data()
-        update.message.reply_text('Admin added successfully.')
+        await asyncio.to_thread(storage.add_admin, new_admin_id)
+        await reply(update.message, 'Admin added successfully.')
     else:
-        update.message.reply_text('You are not authorized to add admins.')
+        await reply(update.message, 'You are not authorized to add admins.')
 
-def add_group(update: Update, context: CallbackContext) -> None:
+async def add_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if str(update.message.from_user.id) in admins:
         new_group_id = context.args[0] if context.args else ''
         groups[new_group_id] = {'messages_today': 0, 'last_reset': str(datetime.date.today())}
-        save_data()
-        update.message.reply_text('Group added to whitelist successfully.')
+        await asyncio.to_thread(storage.set_group, new_group_id)
+        await reply(update.message, 'Group added to whitelist successfully.')
     else:
-        update.message.reply_text('You are not authorized to add groups.')
+        await reply(update.message, 'You are not authorized to add groups.')
+
+async def reply_busy(update: Update) -> None:
+    await reply(update.message, 'Too many questions in progress, please try again in a minute.')
+
+def unavailable_message(retry_after: float) -> str:
+    return f'Claude is unavailable right now, please try again in {max(retry_after, 1):.0f}s.'
 
-def preaudit(update: Update, context: CallbackContext) -> None:
+async def usage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show this group's Claude token usage and cost since the bot started (admins only)."""
+    if str(update.message.from_user.id) not in admins:
+        await reply(update.message, 'You are not authorized to view usage.')
+        return
+    totals = ledger.totals(str(update.message.chat_id))
+    overall = ledger.totals()
+    await reply(update.message,
+        f"This group: {totals['requests']} requests, {totals['input_tokens']} input / "
+        f"{totals['output_tokens']} output tokens, cache read {totals['cache_read_tokens']}, "
+        f"${totals['cost']:.2f}\n"
+        f"All groups: {overall['requests']} requests, ${overall['cost']:.2f}"
+    )
+
+async def send_answer(update: Update, request: dict, label: str, account: str = 'default', sent: list = None,
+                      replace: list = None):
+    """Ask Claude and reply, streaming into edited messages when STREAM_RESPONSES is on.
+    Returns the response and the messages holding the answer.
+
+    When streaming, the answer is written over the messages in replace (an earlier answer).
+    The ids of the messages holding the answer are appended to sent, if given.
+    """
+    if STREAM_RESPONSES:
+        streaming = StreamingReply(update.message, reuse=replace)
+        # The placeholder is posted only once the request is within budget, and removed if it fails
+        try:
+            response = await astream_message(client, request, streaming.append, label=label, account=account,
+                                             on_start=streaming.start)
+        except Exception:
+            await streaming.abort()
+            raise
+        await streaming.finish()
+        messages = streaming.sent
+    else:
+        response = await acreate_message(client, request, label=label, account=account)
+        messages = await send_markdown(update.message, response.content[0].text)
+    if sent is not None:
+        if STREAM_RESPONSES and replace:
+            replaced = {message.message_id for message in replace}
+            sent[:] = [message_id for message_id in sent if message_id not in replaced]
+        sent.extend(message.message_id for message in messages)
+    return response, messages
+
+async def preaudit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    group_id = str(update.message.chat_id)
+    # A review is a fetch and up to one large model call per part: gated like /p
+    if group_id not in groups:
+        return
     url = context.args[0] if context.args else ''
     if not url:
-        update.message.reply_text('Please provide a URL.')
+        await reply(update.message, 'Please provide a URL.')
         return
 
+    trace = start_trace('preaudit', group=group_id)
+    if claude_circuit.retry_in() > 0:
+        await reply(update.message, unavailable_message(claude_circuit.retry_in()))
+        trace.finish('unavailable')
+        return
+
+    # Admins are not rate limited
+    user_id = str(update.message.from_user.id)
+    is_admin = bool(admins.get(user_id))
+    if not is_admin:
+        decision = rate_limiter.acquire(group_id, user_id)
+        if not decision.allowed:
+            RATE_LIMITED.inc(scope=decision.scope or 'unknown')
+            await reply(update.message, rate_limiter.describe(decision))
+            trace.finish('rate_limited')
+            return
+
+    if not request_queue.submit(group_id, lambda: run_preaudit(update, url, is_admin)):
+        if not is_admin:
+            rate_limiter.refund(group_id, user_id)
+        await reply_busy(update)
+        trace.finish('busy')
+
+async def run_preaudit(update: Update, url: str, is_admin: bool = False) -> None:
+    group_id = str(update.message.chat_id)
+    user_id = str(update.message.from_user.id)
+    label = f"preaudit url={url}"
+    # Started by the preaudit handler, unless this is called directly
+    trace = current_trace() or start_trace('preaudit', group=group_id)
+    trace.lap('queue')
+    outcome = 'error'
+    tokens_used = 0
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        code_content = response.text
-
-        prompt = '''
-/- Read and match the natspec documentation made for each function in the code above with its code, for each important function list the differences if they don't match perfectly.
-/- Make a list with function signatures and assessments for parts that do not match according to your interpretation.
-/- You can NEVER say that code is too long to make a review, you have more context size than the source code to craft your answer so you are allowed to make big analysis.
-/- For large codebases it's ok to analyze only the most important functions (normally the external ones).
-/- You don't need to execute any part of the code, just read it.
-'''
-        messages = [{
-            "role": "user",
-            "content": f"{prompt}\n\n{code_content}"
-        }]
-
-        response = client.messages.create(
-            model="claude-3-opus-20240229",
-            max_tokens=4000,
-            temperature=0,
-            messages=messages
-        )
-
-        bot_response = response.content[0].text
-        for msg in safe_split_message(bot_response):
-            update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+        with timed('fetch'):
+            source = await asyncio.to_thread(fetch_source, url)
+        report = preaudit_reports.get(source.digest)
+        if report is not None:
+            await send_markdown(update.message, report)
+            outcome = 'cached'
+            return
 
+        # Concurrent /preaudit of the same source share one review, each group is charged for it
+        (report, tokens_used), shared = await in_flight.do(('preaudit', source.digest),
+                                                           lambda: audit_source(update, url, source, label))
+        if shared:
+            await send_markdown(update.message, report)
+        outcome = 'shared' if shared else 'answered'
+
+    except SourceTooLarge as e:
+        ERRORS.inc(command='preaudit', kind='too_large')
+        await reply(update.message, f"Source too large: {e}")
+    except CircuitOpen as e:
+        ERRORS.inc(command='preaudit', kind='circuit_open')
+        await reply(update.message, unavailable_message(e.retry_after))
     except requests.RequestException as e:
-        update.message.reply_text(f"Error fetching data from the URL: {e}")
+        ERRORS.inc(command='preaudit', kind='fetch')
+        await reply(update.message, f"Error fetching data from the URL: {e}")
+    except TokenBudgetExceeded as e:
+        ERRORS.inc(command='preaudit', kind='budget')
+        await reply(update.message, f"Request too large: {e}")
     except (APIError, APIConnectionError, APITimeoutError) as e:
-        update.message.reply_text(f"Claude API error: {str(e)}")
+        ERRORS.inc(command='preaudit', kind='api')
+        await reply(update.message, f"Claude API error: {str(e)}")
     except Exception as e:
-        update.message.reply_text(f"Unexpected error: {str(e)}")
-
-def handle_message(update: Update, context: CallbackContext) -> None:
+        ERRORS.inc(command='preaudit', kind='unexpected')
+        await reply(update.message, f"Unexpected error: {str(e)}")
+    finally:
+        if not is_admin:
+            if outcome in ('answered', 'shared'):
+                rate_limiter.charge_tokens(group_id, tokens_used)
+                with timed('storage'):
+                    groups[group_id] = await asyncio.to_thread(storage.increment_messages, group_id)
+            else:
+                # Failed, or answered from the report cache
+                rate_limiter.refund(group_id, user_id)
+        trace.fields['tokens'] = tokens_used
+        trace.finish(outcome)
+
+async def audit_source(update: Update, url: str, source, label: str):
+    """Review source, answering in update's chat. Returns (report, tokens used)."""
+    group_id = str(update.message.chat_id)
+    chunks = split_source(source.text)
+    tokens_used = 0
+    if len(chunks) == 1:
+        request = chunk_request(chunks[0], 0, 1)
+    else:
+        # Map: review parts concurrently; reduce: merge their findings into one report
+        await reply(update.message, f'Large source, reviewing it in {len(chunks)} parts...')
+        findings, tokens_used = await audit_chunks(client, chunks, account=group_id, label=label)
+        request = merge_request(url, findings)
+    response, _ = await send_answer(update, request, label=label, account=group_id)
+    preaudit_reports.put(source.digest, response.content[0].text)
+    return response.content[0].text, tokens_used + total_tokens(response.usage)
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     group_id = str(update.message.chat_id)
 
     if group_id in groups:
-        # Check if the daily limit has been reached
-        group_data = groups[group_id]
-        if group_data['last_reset'] != str(datetime.date.today()):
-            group_data['messages_today'] = 0
-            group_data['last_reset'] = str(datetime.date.today())
-        if group_data['messages_today'] >= 10:
-            update.message.reply_text('GPT limit for this group has been reached (10 msgs a day).')
-            return
-        
+        trace = start_trace('prompt', group=group_id)
         user_message = update.message.text
         command_to_remove = update.message.text.split()[0]  # This will be either /p or /prompt
         user_message = user_message.replace(command_to_remove, '', 1).strip()
 
-        system_prompt = '''
-/- You are a bot helping people understand Ape.
-/- I have prefixed a KNOWLEDGE BASE that help you understand what is Ape.
-/- The answer must exist within the source files, otherwise don't answer.
-/- You can use ```language to write code that shows in a pretty way.
-/- Do not invent anything about ape that is not in source files unless you said you were going creative.
-/- False certanty about what ape can do is the worse thing you can do, avoid it at all costs.
-/- ALWAYS Answer the user question using the source files and tell the source of your answer.
-/- ALWAYS provide a % score of how much of your answer matches the KNOWLEDGE BASE.
-/- If the task is of creative nature it's ok to go wild and beyond just the sources, but you MUST state that confidence score is -1 in that case.
-'''
-        knowledge_base_content = "---START OF KNOWLEDGE BASE---\n\n" + knowledge_base + "\n\n---END OF KNOWLEDGE BASE---"
-        
-        content = f"{system_prompt}\n\n{knowledge_base_content}\n\n{user_message}"
-        if update.message.reply_to_message:
-            content = f"{system_prompt}\n\n{knowledge_base_content}\n\nPrevious message: {update.message.reply_to_message.text}\n\nNew message: {user_message}"
-
-        messages = [{
-            "role": "user",
-            "content": content
-        }]
+        # Follow-ups depend on the previous message, so only standalone questions are cached
+        cache_question = None if update.message.reply_to_message else user_message
+        if cache_question:
+            cached_answer = answer_cache.get(cache_question)
+            if cached_answer is not None:
+                await send_markdown(update.message, cached_answer)
+                trace.finish('cached')
+                return
+
+        # Fail fast during a Claude outage instead of queueing questions that will fail
+        if claude_circuit.retry_in() > 0:
+            await reply(update.message, unavailable_message(claude_circuit.retry_in()))
+            trace.finish('unavailable')
+            return
+
+        # Admins are not rate limited
+        user_id = str(update.message.from_user.id)
+        is_admin = bool(admins.get(user_id))
+        if not is_admin:
+            decision = rate_limiter.acquire(group_id, user_id)
+            if not decision.allowed:
+                RATE_LIMITED.inc(scope=decision.scope or 'unknown')
+                await reply(update.message, rate_limiter.describe(decision))
+                trace.finish('rate_limited')
+                return
+
+        # Replies to one of the bot's answers continue that thread with its recent turns
+        reply_to = update.message.reply_to_message
+        conversation = conversations.find(group_id, reply_to.message_id) if reply_to else None
+        question = user_message
+        if conversation is not None:
+            history = conversation.history()
+        else:
+            if reply_to:
+                question = f"Previous message: {reply_to.text}\n\nNew message: {user_message}"
+            conversation = conversations.start(group_id, update.message.message_id)
+            history = []
+
+        with timed('knowledge'):
+            # One version for the whole question, even if a newer one is swapped in meanwhile
+            snapshot = knowledge.current()
+            trace.fields['kb'] = snapshot.version
+            # Cheap model for short questions the knowledge base covers, larger ones as needed
+            route = route_for('prompt', question, snapshot.index)
+            if KB_MODE == 'cached':
+                request = ANSWER_PROMPT.request(question, knowledge_base=snapshot.knowledge_base, history=history,
+                                                model=route.model, max_tokens=route.max_tokens)
+            else:
+                excerpts = snapshot.index.context_for(conversation.retrieval_query(question))
+                request = ANSWER_PROMPT.request(question, excerpts=excerpts, history=history,
+                                                model=route.model, max_tokens=route.max_tokens)
+
+        trace.mark()
+        if not request_queue.submit(group_id, lambda: answer_message(update, group_id, request, is_admin,
+                                                                     cache_question, route,
+                                                                     conversation, question, snapshot.version)):
+            if not is_admin:
+                rate_limiter.refund(group_id, user_id)
+            await reply_busy(update)
+            trace.finish('busy')
+
+def fail(trace, kind: str) -> None:
+    ERRORS.inc(command='prompt', kind=kind)
+    trace.finish('error')
+
+async def answer_message(update: Update, group_id: str, request: dict, is_admin: bool,
+                         cache_question: str = None, route=None, conversation=None, question: str = None,
+                         kb_version: str = None) -> None:
+    user_id = str(update.message.from_user.id)
+    label = f"prompt group={group_id}"
+    if route is not None:
+        label += f" model={route.model} ({route.reason})"
+    trace = current_trace() or start_trace('prompt', group=group_id)
+    trace.fields['model'] = request['model']
+    trace.lap('queue')
+
+    if cache_question:
+        # An identical question may have been answered while this one waited in the queue
+        cached_answer = answer_cache.get(cache_question, count=False)
+        if cached_answer is not None:
+            if not is_admin:
+                rate_limiter.refund(group_id, user_id)
+            await send_markdown(update.message, cached_answer)
+            trace.finish('cached')
+            return
 
+    sent = []
+    try:
+        if cache_question:
+            # Concurrent identical questions share one Claude call
+            key = ('prompt', normalize(cache_question), kb_version, request['model'])
+            (answer, tokens_used), shared = await in_flight.do(
+                key, lambda: ask_claude(update, group_id, request, label, route, sent))
+        else:
+            (answer, tokens_used), shared = await ask_claude(update, group_id, request, label, route, sent), False
+        if shared:
+            sent.extend(message.message_id for message in await send_markdown(update.message, answer))
+    except TokenBudgetExceeded as e:
+        if not is_admin:
+            rate_limiter.refund(group_id, user_id)
+        await reply(update.message, f"Question too large: {e}")
+        return fail(trace, 'budget')
+    except CircuitOpen as e:
+        if not is_admin:
+            rate_limiter.refund(group_id, user_id)
+        await reply(update.message, unavailable_message(e.retry_after))
+        return fail(trace, 'circuit_open')
+    except (APIError, APIConnectionError, APITimeoutError) as e:
+        if not is_admin:
+            rate_limiter.refund(group_id, user_id)
+        error_message = f"Claude API error: {str(e)}"
+        await reply(update.message, error_message)
+        return fail(trace, 'api')
+    except Exception as e:
+        if not is_admin:
+            rate_limiter.refund(group_id, user_id)
+        error_message = f"Unexpected error: {str(e)}"
+        await reply(update.message, error_message)
+        return fail(trace, 'unexpected')
+
+    if conversation is not None:
+        fold = conversations.record(conversation, question, answer, sent)
+        # Older turns were folded into a local digest; the fast model writes a better one
+        if fold is not None and CONVERSATION_MODEL_SUMMARIES:
+            request_queue.submit(group_id, lambda: summarize(conversation, fold, group_id))
+    if cache_question and not shared:
+        answer_cache.put(cache_question, answer, version=kb_version)
+    # Joining a call made for another question (maybe from another group) is billed as if this
+    # group had asked: its message and the answer's tokens
+    if not is_admin:
+        rate_limiter.charge_tokens(group_id, tokens_used)
+        # Only this group's counter is written
+        with timed('storage'):
+            groups[group_id] = await asyncio.to_thread(storage.increment_messages, group_id)
+    trace.fields['tokens'] = tokens_used
+    trace.finish('shared' if shared else 'answered')
+
+async def ask_claude(update: Update, group_id: str, request: dict, label: str, route=None, sent: list = None):
+    """Answer in update's chat, escalating to larger models as needed. Returns (answer, tokens used)."""
+    response, messages = await send_answer(update, request, label=label, account=group_id, sent=sent)
+    answer = response.content[0].text
+    tokens_used = total_tokens(response.usage)
+    # A cheaper model that reports a low knowledge base match hands over to the next tier. A
+    # streamed answer is rewritten in place by the better one, whole answers follow each other
+    while route is not None and should_escalate(route, answer):
+        score = confidence_score(answer)
+        route = escalate(route)
+        await reply(update.message, f'Knowledge base match was only {score:.0f}%, asking a larger model...')
         try:
-            response = client.messages.create(
-                model="claude-3-opus-20240229",
-                max_tokens=4000,
-                temperature=0,
-                messages=messages
-            )
-
-            bot_response = response.content[0].text
-            for msg in safe_split_message(bot_response):
-                update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
-
-            if not admins.get(str(update.message.from_user.id)):
-                groups[group_id]['messages_today'] += 1
-            save_data()
-        except (APIError, APIConnectionError, APITimeoutError) as e:
-            error_message = f"Claude API error: {str(e)}"
-            update.message.reply_text(error_message)
+            response, messages = await send_answer(
+                update, {**request, 'model': route.model, 'max_tokens': route.max_tokens},
+                label=f"prompt group={group_id} model={route.model} ({route.reason})",
+                account=group_id, sent=sent, replace=messages)
         except Exception as e:
-            error_message = f"Unexpected error: {str(e)}"
-            update.message.reply_text(error_message)
+            logger.warning("Escalation to %s failed: %s", route.model, e)
+            ERRORS.inc(command='prompt', kind='escalation')
+            break
+        answer = response.content[0].text
+        tokens_used += total_tokens(response.usage)
+    return answer, tokens_used
+
+async def summarize(conversation, fold, group_id: str) -> None:
+    try:
+        response = await acreate_message(client, summary_request(fold), label=f"summary group={group_id}",
+                                         account=group_id)
+    except Exception as e:
+        # The local digest stays in place
+        logger.warning("Conversation summary failed: %s", e)
+        return
+    conversations.replace_summary(conversation, fold, response.content[0].text)
+
+async def post_stop(application: Application) -> None:
+    # Let in-flight answers finish before the process exits
+    await request_queue.join()
+
+def build_application() -> Application:
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .post_stop(post_stop)
+        .build()
+    )
+
+    application.add_handler(CommandHandler("prompt", handle_message))
+    application.add_handler(CommandHandler("p", handle_message))
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("add_admin", add_admin))
+    application.add_handler(CommandHandler("add_group", add_group))
+    application.add_handler(CommandHandler("preaudit", preaudit))
+    application.add_handler(CommandHandler("usage", usage))
+    application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r'^y\s'), handle_message))
+    return application
 
 def main() -> None:
+    configure_logging()
+    start_metrics_server()
     load_data()
-    updater = Updater(TELEGRAM_TOKEN)
-
-    dispatcher = updater.dispatcher
-    dispatcher.add_handler(CommandHandler("prompt", handle_message))
-    dispatcher.add_handler(CommandHandler("p", handle_message))
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("add_admin", add_admin))
-    dispatcher.add_handler(CommandHandler("add_group", add_group))
-    dispatcher.add_handler(CommandHandler("preaudit", preaudit))
-    dispatcher.add_handler(MessageHandler(Filters.text & Filters.regex(r'^y\s'), handle_message))
-    updater.start_polling()
-    updater.idle()
+    build_application().run_polling()
 
 if __name__ == '__main__':
     main()
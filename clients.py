@@ -0,0 +1,31 @@
+import os
+
+import anthropic
+import requests
+from requests.adapters import HTTPAdapter
+
+# Keep-alive connections kept per host by the requests session
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '10'))
+# Timeout of a Claude call; streamed answers reset it with every chunk
+CLAUDE_TIMEOUT = float(os.getenv('CLAUDE_TIMEOUT', '300'))
+
+
+def http_session(pool_size: int = HTTP_POOL_SIZE) -> requests.Session:
+    """requests Session reusing up to pool_size keep-alive connections per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# The SDK clients keep their own keep-alive pool, so each process creates one and reuses it.
+# Retries happen in llm.py (retry.py) instead of the SDK so the circuit breaker sees every failure.
+
+def anthropic_client(api_key: str) -> anthropic.Anthropic:
+    return anthropic.Anthropic(api_key=api_key, max_retries=0, timeout=CLAUDE_TIMEOUT)
+
+
+def async_anthropic_client(api_key: str) -> anthropic.AsyncAnthropic:
+    return anthropic.AsyncAnthropic(api_key=api_key, max_retries=0, timeout=CLAUDE_TIMEOUT)
@@ -1,93 +1,511 @@
 import os
+import re
+import json
+import mmap
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from functools import lru_cache
 from pathlib import Path
 import mimetypes
 
+from retrieval import estimate_tokens
+
+TEXT_EXTENSIONS = {'.txt', '.md', '.py', '.js', '.sol', '.yml', '.yaml', '.json', '.toml', '.ini', '.cfg'}
+EXCLUDED_PATTERNS = {
+    '.lock',
+    '.pyc',
+    '__pycache__',
+    '.git',
+    '.env',
+    '.venv',
+    'node_modules',
+    '.DS_Store'
+}
+# Files read ahead of the writer; bounds memory to roughly this many documents
+READ_AHEAD = 32
+# Bytes read to decide whether a file without a known text extension is text
+SNIFF_BYTES = 8192
+# Mimetypes skipped without reading: media, fonts and these application types (archives,
+# executables, office documents, ...). Everything else is sniffed.
+BINARY_MIME_FAMILIES = ('image/', 'audio/', 'video/', 'font/')
+BINARY_APPLICATION_TYPES = {
+    'octet-stream', 'zip', 'gzip', 'x-tar', 'x-bzip2', 'x-xz', 'x-7z-compressed', 'x-rar-compressed',
+    'java-archive', 'pdf', 'wasm', 'x-msdos-program', 'x-executable', 'x-sharedlib', 'x-python-code',
+    'vnd.ms-fontobject', 'msword', 'vnd.ms-excel', 'vnd.ms-powerpoint', 'x-shockwave-flash', 'x-sqlite3',
+}
+
+# Compaction (--compact): files dropped by name, matched against the lowercased file name. None by
+# default: release notes and changelogs answer "when did X change" questions (opt in with --drop)
+DROP_PATTERNS = ()
+# Documentation files whose markup is stripped and whose paragraphs are deduplicated; code is left alone
+DOC_EXTENSIONS = {'.md', '.rst', '.txt'}
+# Only paragraphs with at least this many words are deduplicated: shorter ones (headings, "Example:",
+# a sentence of context) are repeated on purpose
+DEDUPE_MIN_WORDS = 30
+
+# reStructuredText directives that only matter to Sphinx (navigation, indexes, layout)
+NOISE_DIRECTIVES = {'toctree', 'index', 'contents', 'highlight', 'meta', 'only', 'image', 'figure', 'raw',
+                    'include', 'literalinclude', 'sectionauthor', 'moduleauthor', 'currentmodule', 'tabularcolumns'}
+ADMONITIONS = {'note', 'warning', 'tip', 'important', 'caution', 'danger', 'attention', 'hint', 'seealso', 'error'}
+DIRECTIVE_RE = re.compile(r'^(\s*)\.\.\s+([\w:-]+)::\s*(.*)$')
+TARGET_RE = re.compile(r'^\s*\.\.\s+(_[^:]*|\|[^|]*\|[^:]*):')
+COMMENT_RE = re.compile(r'^(\s*)\.\.(\s|$)')
+OPTION_RE = re.compile(r'^\s+:[\w-]+:(\s.*)?$')
+# Section over/underlines in reStructuredText, setext underlines and rules in Markdown
+ADORNMENT_RE = re.compile(r'^\s*([=\-~^"\'`#*+<>:._])\1{2,}\s*$')
+RST_LINK_RE = re.compile(r'`([^`<]+?)\s*<([^>`]+)>`__?')
+RST_ROLE_RE = re.compile(r':[\w:-]+:`(?:([^`<]*?)\s*<([^>`]*)>|([^`]*))`')
+# Pull request / issue / advisory links whose text (#1234) already says what they are
+REFERENCE_URL_RE = re.compile(r'https?://github\.com/[^/]+/[^/]+/(pull|issues|security/advisories)/')
+HTML_COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+BADGE_LINE_RE = re.compile(r'^\s*(\[?!\[[^\]]*\]\([^)]*\)(\]\([^)]*\))?\s*)+$')
+HTML_LINE_RE = re.compile(r'^\s*(<[^>]+>\s*)+$')
+FENCE_RE = re.compile(r'^\s*(```|~~~)\s*(\{?[\w-]*\}?)')
+
+@lru_cache(maxsize=None)
+def _is_text_suffix(suffix):
+    if suffix in TEXT_EXTENSIONS:
+        return True
+    mime_type, _ = mimetypes.guess_type('file' + suffix)
+    return bool(mime_type and mime_type.startswith('text/'))
+
 def is_text_file(file_path):
     """Check if a file is likely to be a text file based on its mimetype and extension."""
-    mime_type, _ = mimetypes.guess_type(file_path)
-    text_extensions = {'.txt', '.md', '.py', '.js', '.sol', '.yml', '.yaml', '.json', '.toml', '.ini', '.cfg'}
-    
-    # Check file extension
-    if Path(file_path).suffix.lower() in text_extensions:
+    return _is_text_suffix(os.path.splitext(str(file_path))[1].lower())
+
+@lru_cache(maxsize=None)
+def _is_binary_suffix(suffix):
+    if _is_text_suffix(suffix):
+        return False
+    mime_type, encoding = mimetypes.guess_type('file' + suffix)
+    if encoding is not None:
+        # Compressed (.gz, .bz2, ...)
         return True
-    
-    # Check mime type
-    if mime_type and mime_type.startswith('text/'):
+    if mime_type is None or mime_type.endswith(('+xml', '+json')):
+        return False
+    family, _, subtype = mime_type.partition('/')
+    return (mime_type.startswith(BINARY_MIME_FAMILIES) or subtype.startswith('vnd.openxmlformats')
+            or family == 'application' and subtype in BINARY_APPLICATION_TYPES)
+
+def is_known_binary(file_path):
+    """Check if the extension maps to a binary mimetype (images, archives, executables, ...).
+
+    Used by gpt.py, which sniffs everything else with looks_like_text: other non-text
+    mimetypes (application/xml, application/sql, .rs, .rb, ...) are source code often
+    enough. The knowledge base build only takes is_text_file documents.
+    """
+    return _is_binary_suffix(os.path.splitext(str(file_path))[1].lower())
+
+def looks_like_text(header):
+    """Sniff the first bytes of a file: text has no NUL bytes and decodes as UTF-8."""
+    if b'\0' in header:
+        return False
+    try:
+        header.decode('utf-8')
         return True
-        
-    return False
+    except UnicodeDecodeError as e:
+        # The sniffed block may end in the middle of a multi-byte character
+        return len(header) == SNIFF_BYTES and e.start >= len(header) - 3
 
 def is_excluded_file(file_path):
     """Check if the file should be excluded based on patterns."""
-    excluded_patterns = {
-        '.lock',
-        '.pyc',
-        '__pycache__',
-        '.git',
-        '.env',
-        '.venv',
-        'node_modules',
-        '.DS_Store'
-    }
-    
-    path_parts = Path(file_path).parts
-    return any(pattern in path_parts or file_path.endswith(pattern) for pattern in excluded_patterns)
-
-def concatenate_files(dir_name, output_filename):
+    file_path = str(file_path)
+    path_parts = set(file_path.replace('\\', '/').split('/'))
+    return any(pattern in path_parts or file_path.endswith(pattern) for pattern in EXCLUDED_PATTERNS)
+
+def iter_source_files(dir_path):
+    """Yield text files under dir_path in sorted order, pruning excluded directories."""
+    for root, dirs, files in os.walk(dir_path):
+        dirs[:] = sorted(d for d in dirs if d not in EXCLUDED_PATTERNS)
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            if not is_excluded_file(file_path):
+                yield Path(file_path)
+
+def manifest_path(output_path):
+    return Path(f"{output_path}.manifest.json")
+
+def index_path(output_path):
+    return Path(f"{output_path}.index.json")
+
+def load_json(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def write_json(path, data):
+    tmp_path = Path(f"{path}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def read_document(file_path):
+    """Read, hash and normalize one source file. Runs in the worker pool."""
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    try:
+        content = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return digest, None
+    content = content.replace('\r\n', '\n').replace('\r', '\n').strip()
+    return digest, content
+
+def _indent(line):
+    return len(line) - len(line.lstrip())
+
+def _block_end(lines, start, indent):
+    """Index after the lines indented deeper than indent (or blank) from start on."""
+    end = start
+    while end < len(lines) and (not lines[end].strip() or _indent(lines[end]) > indent):
+        end += 1
+    return end
+
+def _rst_link(match):
+    text, url = match.group(1).strip(), match.group(2).strip()
+    return text if REFERENCE_URL_RE.match(url) or text == url else f'{text} <{url}>'
+
+def _rst_role(match):
+    return f'`{(match.group(1) or match.group(2) or match.group(3) or "").strip()}`'
+
+def strip_rst(text):
+    """Drop Sphinx-only markup (toctrees, index entries, targets, comments, section adornments)."""
+    lines = text.split('\n')
+    out = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        directive = DIRECTIVE_RE.match(line)
+        if directive:
+            indent, name, argument = directive.group(1), directive.group(2).lower(), directive.group(3).strip()
+            end = _block_end(lines, i + 1, len(indent))
+            body = lines[i + 1:end]
+            while body and OPTION_RE.match(body[0]):
+                body.pop(0)
+            i = end
+            if name in NOISE_DIRECTIVES:
+                out.append('')
+                continue
+            if name in ADMONITIONS:
+                out.append(f'{indent}{name.capitalize()}: {argument}'.rstrip())
+            elif ':' in name:
+                # Domain directives (py:function, py:exception, ...): keep the signature
+                out.append(f'{indent}{argument}')
+            else:
+                out.append(line)
+            out.extend(body)
+            continue
+        if TARGET_RE.match(line):
+            i += 1
+            continue
+        comment = COMMENT_RE.match(line)
+        if comment:
+            i = _block_end(lines, i + 1, len(comment.group(1)))
+            out.append('')
+            continue
+        if not ADORNMENT_RE.match(line):
+            out.append(line)
+        i += 1
+    text = '\n'.join(out)
+    text = RST_LINK_RE.sub(_rst_link, text)
+    text = RST_ROLE_RE.sub(_rst_role, text)
+    return text.replace('``', '`')
+
+def strip_markdown(text):
+    """Drop HTML comments, badge and image-only lines, bare HTML tags, rules and MyST toctrees."""
+    text = HTML_COMMENT_RE.sub('', text)
+    out = []
+    fence = None
+    skipping = False
+    for line in text.split('\n'):
+        match = FENCE_RE.match(line)
+        if fence is None and match:
+            fence = match.group(1)
+            skipping = match.group(2) == '{toctree}'
+            if not skipping:
+                out.append(line)
+            continue
+        if fence is not None:
+            if line.strip() == fence:
+                fence = None
+                if skipping:
+                    skipping = False
+                    continue
+            if not skipping:
+                out.append(line)
+            continue
+        if BADGE_LINE_RE.match(line) or HTML_LINE_RE.match(line) or ADORNMENT_RE.match(line):
+            continue
+        out.append(line)
+    return '\n'.join(out)
+
+def paragraphs(text):
+    """Split into (paragraph, is_prose) on blank lines, keeping fenced code blocks whole.
+
+    Indented paragraphs (literal blocks, directive bodies) and code blocks are not prose.
+    """
+    current = []
+    fence = None
+    code = False
+    for line in text.split('\n'):
+        match = FENCE_RE.match(line)
+        if fence is None and match:
+            if current:
+                yield '\n'.join(current), not code
+                current = []
+            fence, code = match.group(1), True
+            current.append(line)
+            continue
+        if fence is not None:
+            current.append(line)
+            if line.strip() == fence:
+                yield '\n'.join(current), False
+                current, fence, code = [], None, False
+            continue
+        if not line.strip():
+            if current:
+                yield '\n'.join(current), not code
+                current, code = [], False
+            continue
+        if not current:
+            code = line[:1].isspace()
+        current.append(line)
+    if current:
+        yield '\n'.join(current), not code and fence is None
+
+class Compactor:
+    """Shrinks documents for the prompt: markup noise, repeated paragraphs and opted-out files.
+
+    Only exact repeats (up to whitespace) of long prose paragraphs are removed, across the
+    whole build, so the first file (in output order) to contain a paragraph keeps it. A
+    paragraph that differs in a single word is kept: it is a different statement.
+    """
+
+    def __init__(self, drop_patterns=DROP_PATTERNS):
+        self.drop_patterns = tuple(pattern.lower() for pattern in drop_patterns)
+        self.seen = set()
+        self.report = {}
+
+    def drop_rule(self, rel_path):
+        name = os.path.basename(rel_path).lower()
+        return next((pattern for pattern in self.drop_patterns if fnmatch(name, pattern)), None)
+
+    def _seen(self, words):
+        """True if an earlier paragraph had the same words, remembering this one otherwise."""
+        digest = hashlib.sha1(' '.join(words).encode('utf-8')).digest()
+        if digest in self.seen:
+            return True
+        self.seen.add(digest)
+        return False
+
+    def compact(self, rel_path, content):
+        """Compacted content of one document ('' if it is dropped), recording its report entry."""
+        entry = {'bytes': [len(content.encode('utf-8')), 0], 'tokens': [estimate_tokens(content), 0],
+                 'duplicates': 0}
+        self.report[rel_path] = entry
+        rule = self.drop_rule(rel_path)
+        if rule:
+            entry['dropped'] = rule
+            return ''
+        suffix = os.path.splitext(rel_path)[1].lower()
+        if suffix in DOC_EXTENSIONS:
+            if suffix == '.rst':
+                content = strip_rst(content)
+            elif suffix == '.md':
+                content = strip_markdown(content)
+            kept = []
+            for paragraph, prose in paragraphs(content):
+                words = paragraph.split()
+                if prose and len(words) >= DEDUPE_MIN_WORDS and self._seen(words):
+                    entry['duplicates'] += 1
+                else:
+                    kept.append(paragraph.rstrip())
+            content = '\n\n'.join(kept)
+        content = '\n'.join(line.rstrip() for line in content.split('\n')).strip()
+        entry['bytes'][1] = len(content.encode('utf-8'))
+        entry['tokens'][1] = estimate_tokens(content)
+        return content
+
+    def totals(self):
+        return {key: [sum(entry[key][0] for entry in self.report.values()),
+                      sum(entry[key][1] for entry in self.report.values())] for key in ('bytes', 'tokens')}
+
+    def print_report(self, top=10):
+        totals = self.totals()
+        before, after = totals['tokens']
+        print(f"- Compaction: {totals['bytes'][0]} -> {totals['bytes'][1]} bytes, "
+              f"~{before} -> ~{after} tokens ({100 * (before - after) / max(before, 1):.0f}% smaller)")
+        largest = sorted(self.report.items(), key=lambda item: item[1]['tokens'][1] - item[1]['tokens'][0])[:top]
+        for rel_path, entry in largest:
+            note = f"dropped ({entry['dropped']})" if 'dropped' in entry else \
+                f"{entry['duplicates']} duplicate paragraphs"
+            print(f"    {rel_path}: ~{entry['tokens'][0]} -> ~{entry['tokens'][1]} tokens, {note}")
+
+def compaction_report_path(output_path):
+    return Path(f"{output_path}.compaction.json")
+
+def concatenate_files(dir_name, output_filename, incremental=True, workers=8, compact=False,
+                      drop_patterns=DROP_PATTERNS):
     """
     Concatenate all text files in a directory into a single knowledge base file.
-    
+
+    Unchanged files (same mtime and size as in the manifest) are copied from the
+    previous output instead of being re-read; changed files are read in a thread pool. Alongside the output it
+    writes a manifest (path -> mtime, size, sha256) and an offset index
+    (path -> byte range of the document) for slicing single documents out of the file.
+
+    With compact, documents go through a Compactor (markup noise, repeated long paragraphs,
+    files matching drop_patterns) and a per-file before/after report is written next to
+    the output. Paragraphs are deduplicated across files, so every file is read again.
+
     Args:
         dir_name (str): Source directory containing the files to concatenate
         output_filename (str): Output file path for the concatenated content
+        incremental (bool): Reuse unchanged documents from the previous build
+        workers (int): Threads used to read changed files
+        compact (bool): Compact documents before writing them
+        drop_patterns (tuple): File name patterns dropped when compacting
     """
     dir_path = Path(dir_name)
     output_path = Path(output_filename)
-    
+    tmp_path = Path(f"{output_path}.tmp")
+
     # Create output directory if it doesn't exist
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    
+
+    old_build = load_json(manifest_path(output_path)) if incremental and not compact else {}
+    # Spans from a compacted build are not the documents as they are on disk
+    old_manifest = old_build.get('files', {}) if not old_build.get('compact') else {}
+    old_index = load_json(index_path(output_path)).get('files', {}) if incremental else {}
+    old_output = None
+    if old_manifest and old_index and output_path.exists() and output_path.stat().st_size:
+        with open(output_path, 'rb') as f:
+            old_output = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    manifest = {}
+    index = {}
     processed_files = 0
+    reused_files = 0
     skipped_files = 0
-    
-    with open(output_path, 'w', encoding='utf-8') as output_file:
-        # Add header to the knowledge base
-        output_file.write(f"# Knowledge Base\nGenerated from: {dir_path.absolute()}\n\n")
-        
-        # Walk through directory
-        for file_path in sorted(dir_path.rglob('*')):
-            if not file_path.is_file() or is_excluded_file(str(file_path)):
-                continue
-                
-            rel_path = file_path.relative_to(dir_path)
-            
-            try:
-                if not is_text_file(str(file_path)):
+    compactor = Compactor(drop_patterns) if compact else None
+
+    def reusable(rel_path, stat):
+        entry = old_manifest.get(rel_path)
+        if old_output is None or entry is None or (rel_path not in old_index and entry.get('written', True)):
+            return False
+        return entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size
+
+    def plan():
+        """Yield (rel_path, stat, future or None) in output order, reading changed files ahead."""
+        nonlocal skipped_files
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for file_path in iter_source_files(dir_path):
+                rel_path = str(file_path.relative_to(dir_path))
+                if not is_text_file(file_path):
+                    skipped_files += 1
+                    continue
+                try:
+                    stat = file_path.stat()
+                except OSError as e:
+                    print(f"Error processing {rel_path}: {str(e)}")
                     skipped_files += 1
                     continue
-                    
-                # Try to read the file content
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read().strip()
-                    
-                    # Only write non-empty files
-                    if content:
-                        output_file.write(f'{"#" * 4} {rel_path}\n\n')
-                        output_file.write(f'{content}\n\n')
-                        processed_files += 1
-                        
-            except UnicodeDecodeError:
-                print(f"Skipping binary file: {rel_path}")
-                skipped_files += 1
-            except Exception as e:
-                print(f"Error processing {rel_path}: {str(e)}")
-                skipped_files += 1
-    
+                future = None if reusable(rel_path, stat) else executor.submit(read_document, file_path)
+                pending.append((rel_path, stat, future))
+                while len(pending) > READ_AHEAD:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+
+    try:
+        with open(tmp_path, 'wb') as output_file:
+            # Add header to the knowledge base
+            output_file.write(f"# Knowledge Base\nGenerated from: {dir_path.absolute()}\n\n".encode('utf-8'))
+
+            for rel_path, stat, future in plan():
+                entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+                if future is None:
+                    old_entry = old_manifest[rel_path]
+                    entry['sha256'] = old_entry['sha256']
+                    entry['written'] = old_entry.get('written', True)
+                    if entry['written']:
+                        span = old_index[rel_path]
+                        start = output_file.tell()
+                        output_file.write(old_output[span['start']:span['end']])
+                        index[rel_path] = {'start': start, 'content_start': start + span['content_start'] - span['start'],
+                                           'end': output_file.tell()}
+                    manifest[rel_path] = entry
+                    reused_files += 1
+                    continue
+
+                try:
+                    digest, content = future.result()
+                except Exception as e:
+                    print(f"Error processing {rel_path}: {str(e)}")
+                    skipped_files += 1
+                    continue
+                if content is None:
+                    print(f"Skipping binary file: {rel_path}")
+                    skipped_files += 1
+                    continue
+
+                entry['sha256'] = digest
+                if compactor is not None:
+                    content = compactor.compact(rel_path, content)
+                # Only write non-empty files
+                entry['written'] = bool(content)
+                if content:
+                    start = output_file.tell()
+                    output_file.write(f'{"#" * 4} {rel_path}\n\n'.encode('utf-8'))
+                    content_start = output_file.tell()
+                    output_file.write(f'{content}\n\n'.encode('utf-8'))
+                    index[rel_path] = {'start': start, 'content_start': content_start, 'end': output_file.tell()}
+                manifest[rel_path] = entry
+                processed_files += 1
+    finally:
+        if old_output is not None:
+            old_output.close()
+
+    os.replace(tmp_path, output_path)
+    write_json(index_path(output_path), {'output': output_path.name, 'files': index})
+    write_json(manifest_path(output_path), {'source': str(dir_path.absolute()), 'compact': compact, 'files': manifest})
+
     print(f"\nKnowledge Base Generation Complete:")
     print(f"- Processed files: {processed_files}")
+    print(f"- Reused unchanged files: {reused_files}")
     print(f"- Skipped files: {skipped_files}")
     print(f"- Output file: {output_path.absolute()}")
+    result = {'processed': processed_files, 'reused': reused_files, 'skipped': skipped_files}
+    if compactor is not None:
+        write_json(compaction_report_path(output_path), {'totals': compactor.totals(), 'files': compactor.report})
+        compactor.print_report()
+        result.update(compactor.totals())
+    return result
+
+def read_document_from_index(output_filename, rel_path, with_header=False):
+    """Slice a single document out of a built knowledge base using its offset index."""
+    span = load_json(index_path(output_filename))['files'][rel_path]
+    with open(output_filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = span['start'] if with_header else span['content_start']
+            return data[start:span['end']].decode('utf-8').rstrip('\n')
 
 if __name__ == '__main__':
-    # Example usage
-    concatenate_files('./knowledge-base', 'knowledge-base.txt')
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Build knowledge-base.txt from a directory of documents')
+    parser.add_argument('source', nargs='?', default='./knowledge-base', help='Source directory')
+    parser.add_argument('output', nargs='?', default='knowledge-base.txt', help='Output file')
+    parser.add_argument('--full', action='store_true', help='Rebuild every file instead of only changed ones')
+    parser.add_argument('-j', '--workers', type=int, default=8, help='Threads used to read files')
+    parser.add_argument('--compact', action='store_true',
+                        help='Strip markup noise and repeated paragraphs')
+    parser.add_argument('--drop', action='append', metavar='PATTERN',
+                        help='File name pattern dropped by --compact, e.g. "toctree.*", repeatable')
+    args = parser.parse_args()
+    concatenate_files(args.source, args.output, incremental=not args.full, workers=args.workers,
+                      compact=args.compact, drop_patterns=tuple(args.drop) if args.drop else DROP_PATTERNS)
@@ -0,0 +1,196 @@
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+from llm import build_request
+from retrieval import estimate_tokens
+from routing import MODELS
+from tokens import truncate_to_tokens
+
+# Conversations kept in memory (least recently used are dropped), and how long an idle one lives
+CONVERSATION_MAX_THREADS = int(os.getenv('CONVERSATION_MAX_THREADS', '1000'))
+CONVERSATION_TTL = float(os.getenv('CONVERSATION_TTL', str(6 * 3600)))
+# Recent turns sent verbatim, and their max estimated tokens; older turns are summarized
+CONVERSATION_KEEP_TURNS = int(os.getenv('CONVERSATION_KEEP_TURNS', '4'))
+CONVERSATION_MAX_TOKENS = int(os.getenv('CONVERSATION_MAX_TOKENS', '3000'))
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv('CONVERSATION_SUMMARY_TOKENS', '400'))
+# Rewrite the summary of older turns with the fast model, in the background
+CONVERSATION_MODEL_SUMMARIES = os.getenv('CONVERSATION_MODEL_SUMMARIES', 'true').lower() in ('1', 'true', 'yes')
+
+# Tokens of a folded turn's question and answer kept in the local summary
+SUMMARY_QUESTION_TOKENS = 40
+SUMMARY_ANSWER_TOKENS = 80
+
+SUMMARY_PROMPT = '''
+/- You summarize a conversation between a user and a bot that answers questions about Ape.
+/- Keep the facts, commands, code names, versions and decisions a follow-up question could refer to.
+/- Write plain sentences, at most 120 words, no preamble.
+'''
+
+ThreadKey = Tuple[str, int]
+
+
+@dataclass
+class Turn:
+    question: str
+    answer: str
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.question) + estimate_tokens(self.answer)
+
+
+@dataclass
+class Fold:
+    """Turns moved out of a conversation into its summary by ConversationStore.record."""
+    previous: str
+    turns: List[Turn]
+    summary: str
+
+
+@dataclass
+class Conversation:
+    key: ThreadKey
+    summary: str = ''
+    turns: List[Turn] = field(default_factory=list)
+    message_ids: List[int] = field(default_factory=list)
+    updated: float = 0.0
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.summary) + sum(turn.tokens for turn in self.turns)
+
+    def history(self) -> List[Dict[str, str]]:
+        """Earlier turns as messages for build_request, the summary first."""
+        messages = []
+        if self.summary:
+            messages += [{'role': 'user', 'content': f"Summary of our earlier conversation:\n{self.summary}"},
+                         {'role': 'assistant', 'content': 'Noted.'}]
+        for turn in self.turns:
+            messages += [{'role': 'user', 'content': turn.question},
+                         {'role': 'assistant', 'content': turn.answer}]
+        return messages
+
+    def retrieval_query(self, question: str) -> str:
+        """Follow-ups like "and on mainnet?" are retrieved together with the previous question."""
+        if not self.turns:
+            return question
+        return f"{self.turns[-1].question}\n{question}"
+
+
+def compact_turn(turn: Turn) -> str:
+    question = truncate_to_tokens(' '.join(turn.question.split()), SUMMARY_QUESTION_TOKENS)
+    answer = truncate_to_tokens(' '.join(turn.answer.split()), SUMMARY_ANSWER_TOKENS)
+    return f"- Q: {question}\n  A: {answer}"
+
+
+def cap_summary(summary: str, max_tokens: int) -> str:
+    """Drop the oldest summary lines until it fits max_tokens."""
+    lines = summary.split('\n')
+    while len(lines) > 1 and estimate_tokens('\n'.join(lines)) > max_tokens:
+        lines.pop(0)
+    return truncate_to_tokens('\n'.join(lines), max_tokens)
+
+
+class ConversationStore:
+    """Bounded per-thread conversation memory.
+
+    A thread starts at a question and is found again through the message ids of the
+    bot's answers, so replying to any answer continues it. At most max_turns recent turns
+    (and max_tokens) are kept verbatim; older ones are folded into a short summary.
+    Least recently used threads are dropped beyond max_threads.
+    """
+
+    def __init__(self, max_threads: int = CONVERSATION_MAX_THREADS, max_turns: int = CONVERSATION_KEEP_TURNS,
+                 max_tokens: int = CONVERSATION_MAX_TOKENS, summary_tokens: int = CONVERSATION_SUMMARY_TOKENS,
+                 ttl: float = CONVERSATION_TTL, clock=time.monotonic):
+        self.max_threads = max_threads
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = Lock()
+        self._threads: 'OrderedDict[ThreadKey, Conversation]' = OrderedDict()
+        # (chat, message id of a question or answer) -> thread
+        self._messages: Dict[ThreadKey, ThreadKey] = {}
+
+    def find(self, chat_id: str, message_id: int) -> Optional[Conversation]:
+        """The live conversation that message_id (a question or an answer) belongs to."""
+        with self._lock:
+            key = self._messages.get((chat_id, message_id))
+            conversation = self._threads.get(key) if key else None
+            if conversation is None:
+                return None
+            if self.clock() - conversation.updated > self.ttl:
+                self._drop(key)
+                return None
+            self._threads.move_to_end(key)
+            return conversation
+
+    def start(self, chat_id: str, message_id: int) -> Conversation:
+        with self._lock:
+            key = (chat_id, message_id)
+            conversation = self._threads.get(key)
+            if conversation is None:
+                conversation = self._threads[key] = Conversation(key, updated=self.clock())
+                self._link(conversation, message_id)
+            self._threads.move_to_end(key)
+            while len(self._threads) > self.max_threads:
+                self._drop(next(iter(self._threads)))
+            return conversation
+
+    def record(self, conversation: Conversation, question: str, answer: str,
+               message_ids: List[int] = ()) -> Optional[Fold]:
+        """Add a turn and link the answer's message ids to the thread.
+
+        Older turns over the limits are folded into the summary right away (a compact local
+        digest); the returned Fold lets a better summary be written with replace_summary.
+        """
+        with self._lock:
+            conversation.turns.append(Turn(question, answer))
+            conversation.updated = self.clock()
+            for message_id in message_ids:
+                self._link(conversation, message_id)
+            previous, folded = conversation.summary, []
+            while len(conversation.turns) > 1 and (len(conversation.turns) > self.max_turns
+                                                   or conversation.tokens > self.max_tokens):
+                folded.append(conversation.turns.pop(0))
+            if not folded:
+                return None
+            summary = '\n'.join(filter(None, [previous] + [compact_turn(turn) for turn in folded]))
+            conversation.summary = cap_summary(summary, self.summary_tokens)
+            return Fold(previous, folded, conversation.summary)
+
+    def replace_summary(self, conversation: Conversation, fold: Fold, summary: str) -> bool:
+        """Swap in a model-written summary of fold, unless more turns were folded meanwhile."""
+        with self._lock:
+            if conversation.summary != fold.summary:
+                return False
+            conversation.summary = cap_summary(summary.strip(), self.summary_tokens)
+            return True
+
+    def _link(self, conversation: Conversation, message_id: int) -> None:
+        self._messages[(conversation.key[0], message_id)] = conversation.key
+        conversation.message_ids.append(message_id)
+
+    def _drop(self, key: ThreadKey) -> None:
+        conversation = self._threads.pop(key, None)
+        if conversation is not None:
+            for message_id in conversation.message_ids:
+                self._messages.pop((key[0], message_id), None)
+
+    def __len__(self) -> int:
+        return len(self._threads)
+
+
+def summary_request(fold: Fold) -> Dict[str, Any]:
+    """Request for the fast model to fold turns into the running summary."""
+    turns = '\n\n'.join(f"User: {turn.question}\n\nBot: {truncate_to_tokens(turn.answer, 1000)}"
+                         for turn in fold.turns)
+    earlier = f"Summary so far:\n{fold.previous}\n\n" if fold.previous else ''
+    return build_request(SUMMARY_PROMPT, f"{earlier}Turns to add:\n\n{turns}", 'Write the updated summary.',
+                         cache_knowledge_base=False, model=MODELS['fast'], max_tokens=300)
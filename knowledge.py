@@ -0,0 +1,163 @@
+"""The live knowledge base: reloaded in the background when knowledge-base.txt changes.
+
+A reload builds a complete new KnowledgeSnapshot (text, index, rendered prompt prefixes)
+and then swaps it in with one assignment. Handlers take current() once per question, so
+questions already queued keep the version they started with.
+"""
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from prompts import KNOWLEDGE_BASE_PATH, KnowledgeBase, PromptTemplate
+from retrieval import CHUNK_TOKENS, KnowledgeIndex
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of knowledge-base.txt for changes, 0 disables reloading
+KB_RELOAD_INTERVAL = float(os.getenv('KB_RELOAD_INTERVAL', '30'))
+# Optional directory of documents (e.g. knowledge-base/) rebuilt into knowledge-base.txt with concat.py when it changes
+KB_SOURCE_DIR = os.getenv('KB_SOURCE_DIR', '')
+# Rebuild it with concat.py --compact
+KB_COMPACT = os.getenv('KB_COMPACT', 'false').lower() in ('1', 'true', 'yes')
+
+FileSignature = Tuple[int, int]
+
+
+@dataclass(frozen=True)
+class KnowledgeSnapshot:
+    """One knowledge base version and everything derived from it."""
+    knowledge_base: KnowledgeBase
+    index: KnowledgeIndex
+    loaded: float = field(default_factory=time.time)
+
+    @property
+    def version(self) -> str:
+        return self.knowledge_base.digest[:12]
+
+
+def file_signature(path: str) -> FileSignature:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def tree_signature(directory: str) -> Tuple[int, int, int]:
+    """(files, newest mtime, total size) of a directory tree, cheap enough to poll."""
+    files, newest, total = 0, 0, 0
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            files += 1
+            newest = max(newest, stat.st_mtime_ns)
+            total += stat.st_size
+    return files, newest, total
+
+
+class LiveKnowledgeBase:
+    """Current knowledge base snapshot, swapped atomically when the file changes.
+
+    Each swap re-indexes the text, renders the prefix of every template in templates, then
+    calls the on_swap callbacks with the new snapshot (e.g. to drop caches).
+    """
+
+    def __init__(self, path: str = KNOWLEDGE_BASE_PATH, source_dir: str = KB_SOURCE_DIR,
+                 templates: Sequence[PromptTemplate] = (), chunk_tokens: int = CHUNK_TOKENS,
+                 compact: bool = KB_COMPACT):
+        self.path = path
+        self.source_dir = source_dir
+        self.templates = list(templates)
+        self.chunk_tokens = chunk_tokens
+        self.compact = compact
+        self.on_swap: List[Callable[[KnowledgeSnapshot], None]] = []
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._tree: Optional[Tuple[int, int, int]] = None
+        self._signature = file_signature(path)
+        self._snapshot = self._build(KnowledgeBase.load(path))
+
+    def current(self) -> KnowledgeSnapshot:
+        return self._snapshot
+
+    @property
+    def version(self) -> str:
+        return self._snapshot.version
+
+    def _build(self, knowledge_base: KnowledgeBase) -> KnowledgeSnapshot:
+        snapshot = KnowledgeSnapshot(knowledge_base, KnowledgeIndex.from_text(knowledge_base.text, self.chunk_tokens))
+        for template in self.templates:
+            template.prefix(knowledge_base)
+        return snapshot
+
+    def reload(self, force: bool = False) -> bool:
+        """Swap in the file's contents if they changed. Returns True if a new version is live."""
+        with self._reload_lock:
+            signature = file_signature(self.path)
+            if signature == self._signature and not force:
+                return False
+            knowledge_base = KnowledgeBase.load(self.path)
+            if file_signature(self.path) != signature:
+                # Still being written, try again on the next check
+                return False
+            self._signature = signature
+            if knowledge_base.digest == self._snapshot.knowledge_base.digest:
+                return False
+            started = time.monotonic()
+            snapshot = self._build(knowledge_base)
+            previous, self._snapshot = self._snapshot, snapshot
+        logger.info("Knowledge base %s -> %s (%d chars, %d chunks) in %.2fs", previous.version, snapshot.version,
+                    len(knowledge_base), len(snapshot.index.chunks), time.monotonic() - started)
+        for callback in self.on_swap:
+            try:
+                callback(snapshot)
+            except Exception:
+                logger.exception("Knowledge base swap callback failed")
+        return True
+
+    def rebuild_sources(self) -> bool:
+        """Rebuild the file from source_dir with concat.py if any document changed."""
+        if not self.source_dir or not os.path.isdir(self.source_dir):
+            return False
+        tree = tree_signature(self.source_dir)
+        if tree == self._tree:
+            return False
+        if self._tree is None:
+            # The first look only records the tree; the file on disk is assumed current
+            self._tree = tree
+            return False
+        from concat import concatenate_files
+        concatenate_files(self.source_dir, self.path, incremental=True, compact=self.compact)
+        self._tree = tree
+        return True
+
+    def check(self) -> bool:
+        self.rebuild_sources()
+        return self.reload()
+
+    def start(self, interval: float = KB_RELOAD_INTERVAL) -> None:
+        """Check for changes every interval seconds in a daemon thread."""
+        if interval <= 0 or self._thread is not None:
+            return
+        self.rebuild_sources()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.check()
+                except Exception:
+                    logger.exception("Knowledge base reload failed, keeping version %s", self.version)
+
+        self._thread = threading.Thread(target=run, name='knowledge-reload', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
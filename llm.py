@@ -0,0 +1,241 @@
+import logging
+import time
+from threading import Lock
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from tokens import (MAX_INPUT_TOKENS, EXACT_TOKEN_COUNT, estimate_request_tokens, count_tokens,
+                    acount_tokens, check_budget, ledger)
+from retry import breaker, call_with_retries, acall_with_retries
+from metrics import CLAUDE_COST, CLAUDE_REQUESTS, CLAUDE_TOKENS, FIRST_TOKEN_SECONDS, observe_stage, timed
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "claude-3-opus-20240229"
+DEFAULT_MAX_TOKENS = 4000
+
+
+def build_request(system_prompt: str, knowledge_base: str, question: str,
+                  cache_knowledge_base: bool = True,
+                  history: Optional[List[Dict[str, str]]] = None,
+                  model: str = DEFAULT_MODEL,
+                  max_tokens: int = DEFAULT_MAX_TOKENS,
+                  temperature: float = 0) -> Dict[str, Any]:
+    """Build messages.create kwargs with the static part first and the question last.
+
+    With cache_knowledge_base the system prompt and knowledge base form a byte-identical
+    system prefix marked with cache_control, so repeat requests read it from the provider's
+    prompt cache. Otherwise (e.g. per-question retrieved excerpts) the knowledge goes into
+    the user turn and only the system prompt is part of the prefix.
+    """
+    system = [{"type": "text", "text": system_prompt.strip()}]
+    if cache_knowledge_base:
+        system.append({
+            "type": "text",
+            "text": knowledge_base,
+            "cache_control": {"type": "ephemeral"},
+        })
+        content = question
+    else:
+        content = f"{knowledge_base}\n\n{question}"
+
+    messages = list(history or [])
+    messages.append({"role": "user", "content": content})
+    return {
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "system": system,
+        "messages": messages,
+    }
+
+
+class CacheStats:
+    """Running prompt cache hit/miss counters, safe to update from handler threads."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+        self.input_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+        self.output_tokens = 0
+        self.hit_seconds = 0.0
+        self.miss_seconds = 0.0
+        self.hit_first_token_seconds = 0.0
+        self.miss_first_token_seconds = 0.0
+        self.hits_streamed = 0
+        self.misses_streamed = 0
+
+    def record(self, usage, elapsed: float, first_token: Optional[float] = None) -> str:
+        """Record one response's usage and return 'hit', 'miss' or 'uncached'."""
+        cache_read = getattr(usage, 'cache_read_input_tokens', 0) or 0
+        cache_write = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+        if cache_read:
+            outcome = 'hit'
+        elif cache_write:
+            outcome = 'miss'
+        else:
+            outcome = 'uncached'
+
+        with self._lock:
+            self.requests += 1
+            self.input_tokens += getattr(usage, 'input_tokens', 0) or 0
+            self.output_tokens += getattr(usage, 'output_tokens', 0) or 0
+            self.cache_read_tokens += cache_read
+            self.cache_write_tokens += cache_write
+            if outcome == 'hit':
+                self.hits += 1
+                self.hit_seconds += elapsed
+                if first_token is not None:
+                    self.hits_streamed += 1
+                    self.hit_first_token_seconds += first_token
+            elif outcome == 'miss':
+                self.misses += 1
+                self.miss_seconds += elapsed
+                if first_token is not None:
+                    self.misses_streamed += 1
+                    self.miss_first_token_seconds += first_token
+            else:
+                self.uncached += 1
+        return outcome
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hits': self.hits,
+                'misses': self.misses,
+                'uncached': self.uncached,
+                'hit_rate': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+                'input_tokens': self.input_tokens,
+                'cache_read_tokens': self.cache_read_tokens,
+                'cache_write_tokens': self.cache_write_tokens,
+                'output_tokens': self.output_tokens,
+                'avg_hit_seconds': self.hit_seconds / self.hits if self.hits else 0.0,
+                'avg_miss_seconds': self.miss_seconds / self.misses if self.misses else 0.0,
+                'avg_hit_first_token_seconds': (self.hit_first_token_seconds / self.hits_streamed
+                                                if self.hits_streamed else 0.0),
+                'avg_miss_first_token_seconds': (self.miss_first_token_seconds / self.misses_streamed
+                                                 if self.misses_streamed else 0.0),
+            }
+
+
+cache_stats = CacheStats()
+
+# Shared by every Claude call in the process, so an outage fails fast everywhere
+claude_circuit = breaker('claude')
+
+
+def enforce_budget(client, request: Dict[str, Any], budget: int = MAX_INPUT_TOKENS) -> int:
+    """Raise TokenBudgetExceeded before sending a request over budget; returns its input tokens.
+
+    The local estimate decides, unless EXACT_TOKEN_COUNT is on and the estimate is over
+    budget, in which case the API's count settles it.
+    """
+    tokens = estimate_request_tokens(request)
+    if EXACT_TOKEN_COUNT and budget > 0 and tokens > budget:
+        tokens = count_tokens(client, request)
+    check_budget(tokens, budget)
+    return tokens
+
+
+async def aenforce_budget(client, request: Dict[str, Any], budget: int = MAX_INPUT_TOKENS) -> int:
+    """Async variant of enforce_budget."""
+    tokens = estimate_request_tokens(request)
+    if EXACT_TOKEN_COUNT and budget > 0 and tokens > budget:
+        tokens = await acount_tokens(client, request)
+    check_budget(tokens, budget)
+    return tokens
+
+
+def create_message(client, request: Dict[str, Any], label: str = 'claude', account: str = 'default'):
+    """Send a request built by build_request and record its prompt cache metrics and cost.
+
+    Overloaded / rate limited / connection errors are retried with backoff; while Claude
+    keeps failing, retry.CircuitOpen is raised without calling it.
+    """
+    enforce_budget(client, request)
+    started = time.monotonic()
+    with timed('claude'):
+        response = call_with_retries(lambda: client.messages.create(**request), claude_circuit)
+    record_response(response, time.monotonic() - started, label, account=account)
+    return response
+
+
+async def acreate_message(client, request: Dict[str, Any], label: str = 'claude', account: str = 'default'):
+    """Async variant of create_message for an AsyncAnthropic client."""
+    await aenforce_budget(client, request)
+    started = time.monotonic()
+    with timed('claude'):
+        response = await acall_with_retries(lambda: client.messages.create(**request), claude_circuit)
+    record_response(response, time.monotonic() - started, label, account=account)
+    return response
+
+
+async def astream_message(client, request: Dict[str, Any],
+                          on_text: Callable[[str], Awaitable[None]], label: str = 'claude',
+                          account: str = 'default',
+                          on_start: Optional[Callable[[], Awaitable[None]]] = None):
+    """Stream a request, passing each text delta to on_text, and return the final message.
+
+    on_start, if given, runs once the request passed the budget check, before it is sent.
+    Failures are retried only until the first text has been passed on.
+    """
+    await aenforce_budget(client, request)
+    if on_start is not None:
+        await on_start()
+    started = time.monotonic()
+    first_token = None
+
+    async def stream_once():
+        nonlocal first_token
+        async with client.messages.stream(**request) as stream:
+            async for text in stream.text_stream:
+                if first_token is None:
+                    first_token = time.monotonic() - started
+                    observe_stage('first_token', first_token)
+                await on_text(text)
+            return await stream.get_final_message()
+
+    with timed('claude'):
+        response = await acall_with_retries(stream_once, claude_circuit,
+                                            should_retry=lambda e: first_token is None)
+    record_response(response, time.monotonic() - started, label, first_token, account=account)
+    return response
+
+
+def total_tokens(usage) -> int:
+    """Input (including cached prefix) plus output tokens of a response."""
+    return sum(getattr(usage, field, 0) or 0 for field in (
+        'input_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens', 'output_tokens'))
+
+
+def record_response(response, elapsed: float, label: str, first_token: Optional[float] = None,
+                    account: str = 'default') -> None:
+    usage = response.usage
+    outcome = cache_stats.record(usage, elapsed, first_token)
+    model = getattr(response, 'model', '')
+    amount = ledger.record(account, model, usage)
+    model = model if isinstance(model, str) else ''
+    CLAUDE_REQUESTS.inc(model=model, cache=outcome)
+    CLAUDE_COST.inc(amount, model=model)
+    for kind, field in (('input', 'input_tokens'), ('output', 'output_tokens'),
+                        ('cache_read', 'cache_read_input_tokens'), ('cache_write', 'cache_creation_input_tokens')):
+        tokens = getattr(usage, field, 0)
+        if isinstance(tokens, int) and tokens:
+            CLAUDE_TOKENS.inc(tokens, model=model, kind=kind)
+    if first_token is not None:
+        FIRST_TOKEN_SECONDS.observe(first_token, model=model)
+    logger.info(
+        "%s: cache=%s latency=%.2fs first_token=%s input=%s cache_read=%s cache_write=%s output=%s cost=$%.4f",
+        label, outcome, elapsed,
+        f"{first_token:.2f}s" if first_token is not None else '-',
+        getattr(usage, 'input_tokens', 0),
+        getattr(usage, 'cache_read_input_tokens', 0),
+        getattr(usage, 'cache_creation_input_tokens', 0),
+        getattr(usage, 'output_tokens', 0),
+        amount,
+    )
@@ -0,0 +1,423 @@
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter as Tally
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+# Port of the local /metrics endpoint, 0 disables it
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Serve /debug/profile?seconds=N (a sampling profile of every thread) on the metrics port
+PROFILE_ENDPOINT = os.getenv('PROFILE_ENDPOINT', 'false').lower() in ('1', 'true', 'yes')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+PROFILE_MAX_SECONDS = 60.0
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# 'text' or 'json' (one object per line, with the fields of request timing lines)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+
+# Seconds, from in-process work (splitting) up to slow Claude answers
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   60.0, 120.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(ABC):
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        ...
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        return '\n'.join(lines + self.samples())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        if amount < 0:
+            raise ValueError('Counters only go up')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in items]
+
+
+class Gauge(_Metric):
+    """Gauge set directly, or read from a callback when rendered (e.g. a queue length)."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def clear(self) -> None:
+        """Drop every labelled value, e.g. before setting an info gauge's new labels."""
+        with self._lock:
+            self._values.clear()
+
+    def value(self, **labels: str) -> float:
+        if self.function is not None:
+            return self.function()
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        if self.function is not None:
+            return [f'{self.name} {_format_value(self.function())}']
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # Per label set: count per bucket (not cumulative), sum, count
+        self._values: Dict[LabelValues, List] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            counts[index] += 1
+            self._values[key] = [counts, total + value, count + 1]
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[2] if entry else 0
+
+    def total(self, **labels: str) -> float:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[1] if entry else 0.0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    """Named metrics rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} is already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              function: Optional[Callable[[], float]] = None) -> Gauge:
+        gauge = self._register(Gauge(name, documentation, labelnames, function))
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    'bot_stage_seconds', 'Time spent per request stage (streamed stages overlap)', ['stage'])
+REQUEST_SECONDS = registry.histogram(
+    'bot_request_seconds', 'Time from receiving a command to its last reply', ['command', 'outcome'])
+REQUESTS = registry.counter('bot_requests_total', 'Commands handled, by outcome', ['command', 'outcome'])
+RATE_LIMITED = registry.counter('bot_rate_limited_total', 'Questions rejected by a rate limit', ['scope'])
+ERRORS = registry.counter('bot_errors_total', 'Failed requests, by kind of error', ['command', 'kind'])
+CLAUDE_REQUESTS = registry.counter(
+    'claude_requests_total', 'Claude responses, by prompt cache outcome', ['model', 'cache'])
+CLAUDE_TOKENS = registry.counter('claude_tokens_total', 'Claude tokens used', ['model', 'kind'])
+CLAUDE_COST = registry.counter('claude_cost_dollars_total', 'Estimated Claude cost in dollars', ['model'])
+TELEGRAM_RETRIES = registry.counter('telegram_retry_after_total', 'Telegram calls refused by flood control (429)')
+FIRST_TOKEN_SECONDS = registry.histogram(
+    'claude_first_token_seconds', 'Time to the first streamed token', ['model'])
+
+
+class RequestTrace:
+    """Per-request stage timings, logged as one structured line when the request finishes."""
+
+    def __init__(self, command: str, **fields: str):
+        self.command = command
+        self.fields = fields
+        self.started = time.monotonic()
+        self.checkpoint = self.started
+        self.stages: Dict[str, float] = {}
+        self.finished = False
+        self.outcome: Optional[str] = None
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def mark(self) -> None:
+        self.checkpoint = time.monotonic()
+
+    def lap(self, stage: str) -> None:
+        """Record the time since the last mark() as stage (e.g. waiting in the request queue)."""
+        observe_stage(stage, time.monotonic() - self.checkpoint, self)
+
+    def finish(self, outcome: str) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        self.outcome = outcome
+        elapsed = time.monotonic() - self.started
+        REQUESTS.inc(command=self.command, outcome=outcome)
+        REQUEST_SECONDS.observe(elapsed, command=self.command, outcome=outcome)
+        fields = {'command': self.command, **self.fields, 'outcome': outcome, 'total': round(elapsed, 4),
+                  **{stage: round(seconds, 4) for stage, seconds in self.stages.items()}}
+        logger.info("request %s", ' '.join(f'{key}={value}' for key, value in fields.items()),
+                    extra={'fields': fields})
+
+
+_trace: contextvars.ContextVar = contextvars.ContextVar('request_trace', default=None)
+
+
+def start_trace(command: str, **fields: str) -> RequestTrace:
+    """Start timing a request; tasks and threads started from here on record into it."""
+    trace = RequestTrace(command, **fields)
+    _trace.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _trace.get()
+
+
+def observe_stage(stage: str, seconds: float, trace: Optional[RequestTrace] = None) -> None:
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = trace or _trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Time the block as stage, in the histogram and the current request's trace."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.monotonic() - started)
+
+
+class SamplingProfiler:
+    """Samples the stacks of every other thread and counts them in collapsed (flamegraph) format.
+
+    The asyncio loop runs in the main thread, so its samples show where the loop is blocked.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks: Tally = Tally()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'SamplingProfiler':
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> 'SamplingProfiler':
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            names.update((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                self.stacks[';'.join([names.get(ident, str(ident))] + stack[::-1])] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def profile(seconds: float, interval: float = PROFILE_INTERVAL) -> SamplingProfiler:
+    profiler = SamplingProfiler(interval).start()
+    time.sleep(min(seconds, PROFILE_MAX_SECONDS))
+    return profiler.stop()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = registry
+    profiling: bool = PROFILE_ENDPOINT
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            self._send(200, self.registry.render(), 'text/plain; version=0.0.4')
+        elif url.path == '/debug/profile' and self.profiling:
+            try:
+                seconds = float(parse_qs(url.query).get('seconds', ['10'])[0])
+            except ValueError:
+                self._send(400, 'seconds must be a number\n')
+                return
+            self._send(200, profile(seconds).collapsed())
+        else:
+            self._send(404, 'not found\n')
+
+    def _send(self, status: int, body: str, content_type: str = 'text/plain') -> None:
+        payload = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format, *args)
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST, metrics: Registry = registry,
+                         profiling: bool = PROFILE_ENDPOINT) -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics (and /debug/profile if profiling) from a background thread; None if port is 0."""
+    if not port:
+        return None
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': metrics, 'profiling': profiling})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, server.server_address[1])
+    return server
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **getattr(record, 'fields', {}),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT) -> None:
+    handler = logging.StreamHandler()
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+    # Every Bot API call is logged at INFO by httpx
+    logging.getLogger('httpx').setLevel(logging.WARNING)
@@ -0,0 +1,242 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from clients import HTTP_CONNECT_TIMEOUT, http_session
+from llm import build_request, acreate_message, total_tokens
+from retry import breaker, call_with_retries
+from routing import Route, route_for
+from retrieval import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Max estimated tokens of source per audited chunk, and chunks audited at once
+PREAUDIT_CHUNK_TOKENS = int(os.getenv('PREAUDIT_CHUNK_TOKENS', '6000'))
+PREAUDIT_PARALLELISM = int(os.getenv('PREAUDIT_PARALLELISM', '4'))
+PREAUDIT_MAX_BYTES = int(os.getenv('PREAUDIT_MAX_BYTES', str(1024 * 1024)))
+PREAUDIT_FETCH_TIMEOUT = float(os.getenv('PREAUDIT_FETCH_TIMEOUT', '30'))
+PREAUDIT_CACHE_SIZE = int(os.getenv('PREAUDIT_CACHE_SIZE', '64'))
+# Model and max_tokens of the final report, configured with ROUTE_PREAUDIT (default: large tier)
+PREAUDIT_ROUTE = route_for('preaudit')
+# Output tokens allowed for the findings of one chunk
+CHUNK_MAX_TOKENS = 1500
+
+PREAUDIT_PROMPT = '''
+/- Read and match the natspec documentation made for each function in the code above with its code, for each important function list the differences if they don't match perfectly.
+/- Make a list with function signatures and assessments for parts that do not match according to your interpretation.
+/- You can NEVER say that code is too long to make a review, you have more context size than the source code to craft your answer so you are allowed to make big analysis.
+/- For large codebases it's ok to analyze only the most important functions (normally the external ones).
+/- You don't need to execute any part of the code, just read it.
+'''
+
+MERGE_PROMPT = '''
+/- Below are natspec review findings for consecutive parts of one source file, reviewed separately.
+/- Merge them into a single report: one list with function signatures and assessments for parts whose natspec does not match the code.
+/- Drop duplicates and "no issues" notes, keep every concrete mismatch, and order findings as they appear in the file.
+'''
+
+# Lines that start a new top-level unit in Solidity or Vyper
+# (Vyper decorators and defs are top level; indented '@' lines are natspec in docstrings)
+BOUNDARY_RE = re.compile(
+    r'^(?:@\w+|def\s)|^\s*(?:function\s|modifier\s|constructor\s*\(|fallback\s*\(|receive\s*\(|'
+    r'(?:abstract\s+)?contract\s|interface\s|library\s|event\s|struct\s)'
+)
+# Natspec / doc comment lines that belong to the declaration below them
+DOC_COMMENT_RE = re.compile(r'^\s*(?:///|/\*\*|\*|\*/)')
+DECORATOR_RE = re.compile(r'^@\w+')
+
+
+class SourceTooLarge(ValueError):
+    pass
+
+
+def _boundaries(lines: List[str]) -> List[int]:
+    """Line indexes where a declaration (with its natspec comment and decorators) starts."""
+    starts = []
+    for i, line in enumerate(lines):
+        if not BOUNDARY_RE.match(line):
+            continue
+        if i and DECORATOR_RE.match(lines[i - 1]):
+            continue  # def under a decorator starts at the decorator
+        start = i
+        while start > 0 and DOC_COMMENT_RE.match(lines[start - 1]):
+            start -= 1
+        if not starts or start > starts[-1]:
+            starts.append(start)
+    return starts
+
+
+def split_source(code: str, max_tokens: int = PREAUDIT_CHUNK_TOKENS) -> List[str]:
+    """Split source code into chunks of whole declarations, each under about max_tokens.
+
+    Consecutive functions are packed together; a single declaration larger than
+    max_tokens is split by lines.
+    """
+    lines = code.split('\n')
+    starts = _boundaries(lines)
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    units = ['\n'.join(lines[start:end]) for start, end in zip(starts, starts[1:] + [len(lines)])]
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for unit in units:
+        unit_tokens = estimate_tokens(unit)
+        if current and current_tokens + unit_tokens > max_tokens:
+            chunks.append('\n'.join(current))
+            current, current_tokens = [], 0
+        if unit_tokens > max_tokens:
+            for piece in _split_lines(unit, max_tokens):
+                chunks.append(piece)
+            continue
+        current.append(unit)
+        current_tokens += unit_tokens
+    if current:
+        chunks.append('\n'.join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def _split_lines(text: str, max_tokens: int) -> List[str]:
+    pieces, current, size = [], [], 0
+    for line in text.split('\n'):
+        line_tokens = estimate_tokens(line) + 1
+        if current and size + line_tokens > max_tokens:
+            pieces.append('\n'.join(current))
+            current, size = [], 0
+        current.append(line)
+        size += line_tokens
+    if current:
+        pieces.append('\n'.join(current))
+    return pieces
+
+
+@dataclass
+class CachedSource:
+    text: str
+    digest: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class LRUCache:
+    """Small thread-safe LRU mapping used for fetched sources and finished reports."""
+
+    def __init__(self, max_entries: int = PREAUDIT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._entries: 'OrderedDict[str, Any]' = OrderedDict()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Keep-alive connections reused across /preaudit fetches
+http = http_session()
+
+sources = LRUCache()
+# Final reports keyed by sha256 of the source, so an unchanged file is answered instantly
+reports = LRUCache()
+
+
+def _download(url: str, headers: Dict[str, str], session, max_bytes: int,
+              timeout: float) -> Tuple[int, bytes, Dict[str, str]]:
+    with session.get(url, headers=headers, timeout=(HTTP_CONNECT_TIMEOUT, timeout), stream=True) as response:
+        if response.status_code == 304:
+            return 304, b'', response.headers
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise SourceTooLarge(f"Source is {int(length)} bytes, the limit is {max_bytes}")
+        body = bytearray()
+        for block in response.iter_content(64 * 1024):
+            body.extend(block)
+            if len(body) > max_bytes:
+                raise SourceTooLarge(f"Source is larger than {max_bytes} bytes")
+        return response.status_code, bytes(body), response.headers
+
+
+def fetch_source(url: str, cache: LRUCache = sources, session=None,
+                 max_bytes: int = PREAUDIT_MAX_BYTES, timeout: float = PREAUDIT_FETCH_TIMEOUT) -> CachedSource:
+    """GET url with a timeout and size cap, revalidating a cached copy with ETag / Last-Modified.
+
+    Uses the pooled session and retries transient failures, behind a breaker per host.
+    """
+    cached = cache.get(url)
+    headers = {}
+    if cached is not None:
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+
+    status, body, response_headers = call_with_retries(
+        lambda: _download(url, headers, session or http, max_bytes, timeout),
+        breaker(urlparse(url).netloc or url))
+    if status == 304 and cached is not None:
+        return cached
+    source = CachedSource(
+        text=body.decode('utf-8', errors='replace'),
+        digest=hashlib.sha256(body).hexdigest(),
+        etag=response_headers.get('ETag'),
+        last_modified=response_headers.get('Last-Modified'),
+    )
+    cache.put(url, source)
+    return source
+
+
+def chunk_request(chunk: str, index: int, total: int, route: Route = PREAUDIT_ROUTE) -> Dict[str, Any]:
+    """Request auditing one chunk; with a single chunk this is the whole preaudit."""
+    note = f"This is part {index + 1} of {total} of the file." if total > 1 else ''
+    return build_request(PREAUDIT_PROMPT, chunk, note, cache_knowledge_base=False, model=route.model,
+                         max_tokens=min(CHUNK_MAX_TOKENS, route.max_tokens) if total > 1 else route.max_tokens)
+
+
+def merge_request(url: str, findings: List[str], route: Route = PREAUDIT_ROUTE) -> Dict[str, Any]:
+    parts = '\n\n'.join(f"## Part {i + 1}\n\n{text}" for i, text in enumerate(findings))
+    return build_request(MERGE_PROMPT, f"Source: {url}\n\n{parts}", "Write the merged report.",
+                         cache_knowledge_base=False, model=route.model, max_tokens=route.max_tokens)
+
+
+async def audit_chunks(client, chunks: List[str], parallelism: int = PREAUDIT_PARALLELISM,
+                       account: str = 'default', label: str = 'preaudit') -> Tuple[List[str], int]:
+    """Map step: audit every chunk, at most parallelism at once. Returns (findings in order, tokens used)."""
+    semaphore = asyncio.Semaphore(max(parallelism, 1))
+    tokens_used = 0
+
+    async def audit(index: int, chunk: str) -> str:
+        nonlocal tokens_used
+        async with semaphore:
+            try:
+                response = await acreate_message(client, chunk_request(chunk, index, len(chunks)),
+                                                 label=f"{label} part={index + 1}/{len(chunks)}",
+                                                 account=account)
+                tokens_used += total_tokens(response.usage)
+                return response.content[0].text
+            except Exception as e:
+                logger.warning("%s: part %d failed: %s", label, index + 1, e)
+                return f"(Review of this part failed: {e})"
+
+    findings = list(await asyncio.gather(*(audit(i, chunk) for i, chunk in enumerate(chunks))))
+    return findings, tokens_used
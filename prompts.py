@@ -0,0 +1,144 @@
+"""Prompt templates and the knowledge base they are rendered with.
+
+The knowledge base is read once through a memory map and decoded straight into one str.
+Each template renders its system prefix once per knowledge base version and requests
+reuse those blocks, so per-question work is limited to the question and any retrieved
+excerpts.
+"""
+import hashlib
+import mmap
+import os
+from typing import Any, Dict, List, Optional
+
+from llm import DEFAULT_MAX_TOKENS, DEFAULT_MODEL
+from retrieval import estimate_tokens
+
+KNOWLEDGE_BASE_PATH = 'knowledge-base.txt'
+
+# Rules shared by every prompt that answers questions about Ape
+APE_RULES = '''
+/- The answer must exist within the source files, otherwise don't answer.
+/- Do not invent anything about ape that is not in source files unless you said you were going creative.
+/- False certainty about what ape can do is the worse thing you can do, avoid it at all costs.
+/- ALWAYS Answer the user question using the source files and tell the source of your answer.
+/- ALWAYS provide a % score of how much of your answer matches the KNOWLEDGE BASE.
+/- If the task is of creative nature it's ok to go wild and beyond just the sources, but you MUST state that confidence score is -1 in that case.
+'''
+
+
+class KnowledgeBase:
+    """One version of the knowledge base: its text and a content digest."""
+
+    def __init__(self, text: str, digest: Optional[str] = None, path: Optional[str] = None):
+        self.text = text
+        self.path = path
+        self._digest = digest
+
+    @classmethod
+    def load(cls, path: str = KNOWLEDGE_BASE_PATH) -> 'KnowledgeBase':
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls('', path=path)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # Hashed and decoded straight from the mapping, without an intermediate bytes copy
+                digest = hashlib.sha256(mapped).hexdigest()
+                text = str(mapped, 'utf-8')
+        return cls(text, digest, path)
+
+    @property
+    def digest(self) -> str:
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.text.encode('utf-8')).hexdigest()
+        return self._digest
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.text)
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+
+class PromptTemplate:
+    """A system prompt and how knowledge and the question are framed around it.
+
+    With a KnowledgeBase, the system prompt and the framed knowledge base are a cacheable
+    system prefix, rendered once per knowledge base version. With excerpts (e.g. retrieved
+    chunks), they are framed at the start of the user turn instead.
+    """
+
+    def __init__(self, system: str, knowledge_header: str = '', knowledge_footer: str = '',
+                 question: str = '{question}'):
+        self.system = system.strip()
+        self.knowledge_header = knowledge_header
+        self.knowledge_footer = knowledge_footer
+        self.question = question
+        self._system_block = {"type": "text", "text": self.system}
+        # (knowledge base, rendered system blocks) of the last version used
+        self._prefix = (None, None)
+
+    def prefix(self, knowledge_base: KnowledgeBase) -> List[Dict[str, Any]]:
+        rendered_for, blocks = self._prefix
+        if rendered_for is not knowledge_base:
+            text = ''.join((self.knowledge_header, knowledge_base.text, self.knowledge_footer))
+            blocks = [self._system_block, {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+            self._prefix = (knowledge_base, blocks)
+        return blocks
+
+    def request(self, question: str, knowledge_base: Optional[KnowledgeBase] = None,
+                excerpts: Optional[str] = None,
+                history: Optional[List[Dict[str, str]]] = None,
+                model: str = DEFAULT_MODEL,
+                max_tokens: int = DEFAULT_MAX_TOKENS,
+                temperature: float = 0) -> Dict[str, Any]:
+        """messages.create kwargs, same shape as llm.build_request."""
+        question = self.question.format(question=question)
+        if knowledge_base is not None:
+            system = list(self.prefix(knowledge_base))
+            content = question
+        else:
+            system = [self._system_block]
+            content = question if excerpts is None else ''.join(
+                (self.knowledge_header, excerpts, self.knowledge_footer, '\n\n', question))
+
+        messages = list(history or [])
+        messages.append({"role": "user", "content": content})
+        return {
+            "model": model,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "system": system,
+            "messages": messages,
+        }
+
+
+# /p and /prompt in the Telegram bot
+ANSWER_PROMPT = PromptTemplate(
+    '''
+/- You are a bot helping people understand Ape.
+/- I have provided a KNOWLEDGE BASE (or its most relevant excerpts, each headed by its source file) that help you understand what is Ape.
+/- You can use ```language to write code that shows in a pretty way.
+''' + APE_RULES,
+    knowledge_header="---START OF KNOWLEDGE BASE---\n\n",
+    knowledge_footer="\n\n---END OF KNOWLEDGE BASE---",
+)
+
+# request.py
+CLI_PROMPT = PromptTemplate(
+    "/- You are a bot helping people understand Ape.\n" + APE_RULES,
+    knowledge_header="Knowledge Base:\n",
+    question="Question: {question}",
+)
+
+# ape-gpt-cli/gpt.py, over a concatenated source tree instead of the knowledge base
+SOURCES_PROMPT = PromptTemplate(
+    '''
+/- Analyze the provided source code and documentation.
+/- Base your answers solely on the provided content.
+/- If the answer cannot be found in the sources, state that clearly.
+/- When referencing specific parts of the code, cite the relevant file paths.
+/- Provide concrete examples when possible.
+''',
+    knowledge_header="Source Content:\n",
+    question="Question/Task: {question}",
+)
@@ -0,0 +1,195 @@
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from state import MemoryBackend, StateBackend
+
+DAY = 86400.0
+
+# Bucket sizes; each bucket refills fully over its period
+GROUP_MESSAGES_PER_DAY = int(os.getenv('GROUP_MESSAGES_PER_DAY', '10'))
+USER_MESSAGES_PER_HOUR = int(os.getenv('USER_MESSAGES_PER_HOUR', '5'))
+GLOBAL_MESSAGES_PER_MINUTE = int(os.getenv('GLOBAL_MESSAGES_PER_MINUTE', '30'))
+# Input + output tokens a group may spend per day, charged after each answer
+GROUP_TOKENS_PER_DAY = int(os.getenv('GROUP_TOKENS_PER_DAY', '1000000'))
+
+# Prefix of bucket keys in the state backend
+BUCKET = 'ratelimit:'
+
+
+class TokenBucket:
+    """Bucket of capacity tokens refilled continuously at rate tokens per second.
+
+    The level may go negative when actual usage is charged after the fact; the bucket
+    then refuses requests until it has refilled above zero.
+    """
+
+    __slots__ = ('capacity', 'rate', 'level', 'updated')
+
+    def __init__(self, capacity: float, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.level = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        if now > self.updated:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be taken (0 if it can be taken now)."""
+        if self.level >= amount and self.level > 0:
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (max(amount, 1e-9) - self.level) / self.rate
+
+    def time_to_full(self) -> float:
+        if self.rate <= 0:
+            return DAY
+        return max((self.capacity - self.level) / self.rate, 1.0)
+
+    def dump(self) -> Tuple[str, float]:
+        """Backend value and ttl: an idle bucket expires once it would have refilled anyway."""
+        return f'{self.level!r} {self.updated!r}', self.time_to_full()
+
+    @classmethod
+    def load(cls, value: Optional[str], capacity: float, rate: float, now: float) -> 'TokenBucket':
+        bucket = cls(capacity, rate, now)
+        if value is not None:
+            level, updated = value.split()
+            bucket.level, bucket.updated = float(level), float(updated)
+            bucket.refill(now)
+        return bucket
+
+
+@dataclass
+class Decision:
+    allowed: bool
+    scope: Optional[str] = None
+    retry_after: float = 0.0
+
+
+class RateLimiter:
+    """Per-group, per-user and global message buckets plus a per-group token budget.
+
+    Buckets live in a state backend, shared by every replica using it. Each check reads a
+    handful of buckets and either takes from all of them or from none in one backend
+    transaction, so concurrent handlers (in any process) cannot race past a quota.
+    """
+
+    def __init__(self, group_messages: int = GROUP_MESSAGES_PER_DAY, group_period: float = DAY,
+                 user_messages: int = USER_MESSAGES_PER_HOUR, user_period: float = 3600.0,
+                 global_messages: int = GLOBAL_MESSAGES_PER_MINUTE, global_period: float = 60.0,
+                 group_tokens: int = GROUP_TOKENS_PER_DAY, group_tokens_period: float = DAY,
+                 clock: Callable[[], float] = time.time, backend: Optional[StateBackend] = None):
+        self.limits: Dict[str, Tuple[float, float]] = {
+            'group': (group_messages, group_period),
+            'user': (user_messages, user_period),
+            'global': (global_messages, global_period),
+            'group_tokens': (group_tokens, group_tokens_period),
+        }
+        # Wall clock by default, since replicas compare each other's timestamps
+        self.clock = clock
+        self.backend = backend or MemoryBackend()
+
+    def _key(self, scope: str, key: str) -> Optional[str]:
+        capacity, _ = self.limits[scope]
+        if capacity <= 0:
+            return None  # Disabled
+        return f'{BUCKET}{scope}:{key}'
+
+    def _bucket(self, scope: str, value: Optional[str], now: float) -> TokenBucket:
+        capacity, period = self.limits[scope]
+        return TokenBucket.load(value, capacity, capacity / period, now)
+
+    def _message_keys(self, group_id: str, user_id: str) -> List[Tuple[str, str]]:
+        keys = [
+            ('global', self._key('global', '')),
+            ('group', self._key('group', group_id)),
+            ('user', self._key('user', f"{group_id}:{user_id}")),
+        ]
+        return [(scope, key) for scope, key in keys if key is not None]
+
+    def acquire(self, group_id: str, user_id: str) -> Decision:
+        """Take one message from every applicable bucket, or none if any is empty."""
+        token_key = self._key('group_tokens', group_id)
+        message_keys = self._message_keys(group_id, user_id)
+
+        def take(current):
+            now = self.clock()
+            if token_key is not None:
+                token_bucket = self._bucket('group_tokens', current[token_key], now)
+                if token_bucket.level <= 0:
+                    return {}, Decision(False, 'group_tokens', token_bucket.wait_time(1))
+            buckets = [(key, self._bucket(scope, current[key], now)) for scope, key in message_keys]
+            for (scope, _), (_, bucket) in zip(message_keys, buckets):
+                wait = bucket.wait_time(1)
+                if wait > 0:
+                    return {}, Decision(False, scope, wait)
+            for _, bucket in buckets:
+                bucket.level -= 1
+            return {key: bucket.dump() for key, bucket in buckets}, Decision(True)
+
+        keys = [key for _, key in message_keys] + ([token_key] if token_key else [])
+        return self.backend.transact(keys, take)
+
+    def refund(self, group_id: str, user_id: str) -> None:
+        """Give back a message taken by acquire, e.g. when the request failed."""
+        message_keys = self._message_keys(group_id, user_id)
+
+        def give_back(current):
+            now = self.clock()
+            writes = {}
+            for scope, key in message_keys:
+                bucket = self._bucket(scope, current[key], now)
+                bucket.level = min(bucket.capacity, bucket.level + 1)
+                writes[key] = bucket.dump()
+            return writes, None
+
+        if message_keys:
+            self.backend.transact([key for _, key in message_keys], give_back)
+
+    def charge_tokens(self, group_id: str, tokens: int) -> None:
+        """Charge the actual input + output tokens of an answer to the group's budget."""
+        key = self._key('group_tokens', group_id)
+
+        def charge(current):
+            bucket = self._bucket('group_tokens', current[key], self.clock())
+            bucket.level -= tokens
+            return {key: bucket.dump()}, None
+
+        if key is not None:
+            self.backend.transact([key], charge)
+
+    def describe(self, decision: Decision) -> str:
+        """User-facing explanation of a rejected request."""
+        wait = decision.retry_after
+        if wait == float('inf'):
+            when = 'later'
+        elif wait >= 3600:
+            when = f'in {wait / 3600:.0f}h'
+        elif wait >= 60:
+            when = f'in {wait / 60:.0f} min'
+        else:
+            when = f'in {max(wait, 1):.0f}s'
+        group_messages, group_period = self.limits['group']
+        user_messages, user_period = self.limits['user']
+        reasons = {
+            'group': f'GPT limit for this group has been reached ({group_messages:g} msgs per {_period(group_period)})',
+            'group_tokens': 'GPT token budget for this group has been used up',
+            'user': f'You have reached your limit ({user_messages:g} msgs per {_period(user_period)})',
+            'global': 'The bot is busy right now',
+        }
+        return f"{reasons.get(decision.scope, 'Rate limit reached')}, try again {when}."
+
+
+def _period(seconds: float) -> str:
+    for name, length in (('day', DAY), ('hour', 3600.0), ('minute', 60.0)):
+        if seconds == length:
+            return name
+        if seconds > length:
+            return f'{seconds / length:g} {name}s'
+    return f'{seconds:g}s'
@@ -0,0 +1,371 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+
+from metrics import TELEGRAM_RETRIES, timed
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4000
+# Seconds between edits of a streamed reply, Telegram rate limits edits per chat
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+PLACEHOLDER = '…'
+# Appended to a streamed answer cut off by an error
+INTERRUPTED = '(answer interrupted)'
+# Outgoing messages and edits: Telegram allows about one per second in a chat, 20 a minute in a group
+# and 30 a second overall before answering 429 Too Many Requests
+TELEGRAM_CHAT_INTERVAL = float(os.getenv('TELEGRAM_CHAT_INTERVAL', '1'))
+TELEGRAM_GROUP_PER_MINUTE = float(os.getenv('TELEGRAM_GROUP_PER_MINUTE', '20'))
+TELEGRAM_GLOBAL_PER_SECOND = float(os.getenv('TELEGRAM_GLOBAL_PER_SECOND', '30'))
+# Times a call is retried after a 429 before giving up
+TELEGRAM_SEND_RETRIES = int(os.getenv('TELEGRAM_SEND_RETRIES', '5'))
+
+# Closes a code block cut by a split (the part may end inside a line)
+CLOSE_FENCE = '\n```\n'
+
+T = TypeVar('T')
+
+
+def _block_length(lines: List[str], start: int) -> int:
+    """Characters of the code block opening at lines[start], up to and including its closing fence."""
+    length = len(lines[start]) + 1
+    for line in lines[start + 1:]:
+        length += len(line) + 1
+        if line.startswith('```'):
+            break
+    return length
+
+
+def safe_split_message(text, max_length=MAX_MESSAGE_LENGTH):
+    """Split text into messages of at most max_length characters, preserving Markdown code blocks.
+
+    Splits fall between lines, and before a code block that does not fit in the current
+    message but fits in one of its own. A longer code block is closed at the split and
+    reopened with the same fence in the next message; a single line longer than a message
+    is cut. Each character is looked at a bounded number of times.
+    """
+    with timed('split'):
+        lines = text.split('\n')
+        messages = []
+        current = []
+        size = 0
+        # Opening line of the code block we are in, where it starts in current, and the size
+        # of a part holding nothing but a reopened fence
+        fence = None
+        opened = -1
+        base = 0
+
+        def add(piece):
+            nonlocal size
+            current.append(piece)
+            size += len(piece)
+
+        def split():
+            nonlocal current, size, opened, base
+            if fence is not None and opened == len(current) - 1:
+                # The block has no lines in this part yet, it starts in the next one instead
+                current.pop()
+            elif fence is not None:
+                current.append(CLOSE_FENCE[current[-1].endswith('\n'):])
+            part = ''.join(current)
+            if part.strip():
+                messages.append(part)
+            current, size, base = [], 0, 0
+            if fence is not None:
+                opened = 0
+                add(fence + '\n')
+                base = size
+
+        for i, line in enumerate(lines):
+            piece = line + '\n'
+            fenced = line.startswith('```')
+            if fence is None and fenced and size > base:
+                block = _block_length(lines, i)
+                if size + block > max_length >= block:
+                    split()
+            # Leave room for closing the block if it is still open after this line
+            open_after = (fence is not None) != fenced
+            limit = max_length - (len(CLOSE_FENCE) if open_after else 0)
+            while size + len(piece) > limit:
+                if size > base:
+                    split()
+                    continue
+                cut = max(limit - size, 1)
+                add(piece[:cut])
+                piece = piece[cut:]
+                split()
+            if fenced and fence is None:
+                fence, opened = line, len(current)
+            elif fenced:
+                fence, base = None, 0
+            add(piece)
+
+        if size > base and ''.join(current).strip() or not messages and current:
+            messages.append(''.join(current))
+
+    return messages
+
+
+def is_parse_error(e: BadRequest) -> bool:
+    return "can't parse" in str(e).lower()
+
+
+class _Chat:
+    __slots__ = ('buckets', 'lock', 'hold_until', 'waiting')
+
+    def __init__(self, buckets: List[TokenBucket]):
+        self.buckets = buckets
+        self.lock = asyncio.Lock()
+        self.hold_until = 0.0
+        self.waiting = 0
+
+    def idle(self, now: float, full: bool = True) -> bool:
+        """Nothing waiting and (full) every bucket refilled, or (not full) one more call allowed."""
+        if self.waiting or now < self.hold_until:
+            return False
+        for bucket in self.buckets:
+            bucket.refill(now)
+        if full:
+            return all(bucket.level >= bucket.capacity for bucket in self.buckets)
+        return all(bucket.wait_time(1) <= 0 for bucket in self.buckets)
+
+
+class SendQueue:
+    """Paces outgoing Telegram calls per chat and overall, in the order they were made.
+
+    Calls for one chat run one at a time, at most one per chat_interval and, in groups,
+    group_per_minute a minute; all chats together make at most global_per_second calls a
+    second. A call refused with RetryAfter holds its chat for retry_after seconds and is
+    retried, so an answer that was already paid for is still delivered.
+    """
+
+    def __init__(self, chat_interval: float = TELEGRAM_CHAT_INTERVAL,
+                 group_per_minute: float = TELEGRAM_GROUP_PER_MINUTE,
+                 global_per_second: float = TELEGRAM_GLOBAL_PER_SECOND,
+                 retries: int = TELEGRAM_SEND_RETRIES, clock=time.monotonic, sleep=asyncio.sleep):
+        self.chat_interval = chat_interval
+        self.group_per_minute = group_per_minute
+        self.retries = retries
+        self.clock = clock
+        self.sleep = sleep
+        self._global = TokenBucket(global_per_second, global_per_second, clock()) if global_per_second > 0 else None
+        self._chats: Dict[object, _Chat] = {}
+
+    def _chat(self, chat_id) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            now = self.clock()
+            if len(self._chats) >= 1000:
+                # Forget idle chats whose buckets have refilled
+                for key in [key for key, state in self._chats.items() if state.idle(now)]:
+                    del self._chats[key]
+            buckets = []
+            if self.chat_interval > 0:
+                buckets.append(TokenBucket(1, 1 / self.chat_interval, now))
+            if self.group_per_minute > 0 and isinstance(chat_id, int) and chat_id < 0:
+                buckets.append(TokenBucket(self.group_per_minute, self.group_per_minute / 60, now))
+            chat = self._chats[chat_id] = _Chat(buckets)
+        return chat
+
+    def _wait_time(self, chat: _Chat) -> float:
+        now = self.clock()
+        buckets = chat.buckets + ([self._global] if self._global is not None else [])
+        for bucket in buckets:
+            bucket.refill(now)
+        wait = max([chat.hold_until - now] + [bucket.wait_time(1) for bucket in buckets])
+        if wait <= 0:
+            for bucket in buckets:
+                bucket.level -= 1
+        return wait
+
+    async def call(self, chat_id, fn: Callable[[], Awaitable[T]], retry: bool = True) -> T:
+        """Run fn (one Telegram call) when chat_id may send again.
+
+        Without retry a RetryAfter is raised at once, still holding the chat.
+        """
+        chat = self._chat(chat_id)
+        chat.waiting += 1
+        try:
+            async with chat.lock:
+                for attempt in range(self.retries + 1):
+                    with timed('send_wait'):
+                        while (wait := self._wait_time(chat)) > 0:
+                            await self.sleep(wait)
+                    try:
+                        with timed('telegram'):
+                            return await fn()
+                    except RetryAfter as e:
+                        retry_after = float(e.retry_after)
+                        TELEGRAM_RETRIES.inc()
+                        chat.hold_until = self.clock() + retry_after
+                        if not retry or attempt == self.retries:
+                            raise
+                        logger.info("Telegram flood control in chat %s, retrying in %ss", chat_id, retry_after)
+        finally:
+            chat.waiting -= 1
+
+    def ready(self, chat_id) -> bool:
+        """Whether the chat allows a call right now (nothing is taken)."""
+        chat = self._chats.get(chat_id)
+        return chat is None or chat.idle(self.clock(), full=False)
+
+
+# Shared by every reply of the process
+send_queue = SendQueue()
+
+
+async def reply(message, text: str, markdown: bool = False, queue: Optional[SendQueue] = None):
+    """Reply to message through the send queue. Markdown Telegram cannot parse is sent as plain text."""
+    queue = queue or send_queue
+    if markdown:
+        try:
+            return await queue.call(message.chat_id, lambda: message.reply_text(text, parse_mode=ParseMode.MARKDOWN))
+        except BadRequest as e:
+            if not is_parse_error(e):
+                raise
+            logger.info("Markdown rejected by Telegram (%s), sending plain text", e)
+    return await queue.call(message.chat_id, lambda: message.reply_text(text))
+
+
+async def send_markdown(message, text: str, queue: Optional[SendQueue] = None) -> list:
+    """Reply with text split into Telegram sized Markdown messages; returns the sent messages."""
+    sent = []
+    for part in safe_split_message(text):
+        sent.append(await reply(message, part, markdown=True, queue=queue))
+    return sent
+
+
+def close_open_code_block(text: str) -> str:
+    """Close a code block left open by a partial answer so Markdown still parses."""
+    fences = sum(1 for line in text.split('\n') if line.startswith('```'))
+    if fences % 2:
+        return text + '\n```'
+    return text
+
+
+class StreamingReply:
+    """Reply that grows as text streams in, by editing a placeholder message.
+
+    Edits are throttled to one per edit_interval, and skipped while the send queue holds
+    the chat (or after a RetryAfter). Once the current message outgrows max_length it is
+    split like safe_split_message, the full parts are finalized and the rest continues in
+    a new message. Final edits and new messages wait for their turn in the queue.
+
+    Messages in reuse (an earlier answer being replaced) are edited over instead of posting
+    new ones; those left over are deleted once the reply is finished.
+    """
+
+    def __init__(self, message, edit_interval: float = STREAM_EDIT_INTERVAL,
+                 max_length: int = MAX_MESSAGE_LENGTH, queue: Optional[SendQueue] = None,
+                 reuse: Optional[list] = None):
+        self.message = message
+        self.queue = queue or send_queue
+        self.edit_interval = edit_interval
+        self.max_length = max_length
+        self.current = None
+        self.segment = ''
+        self.shown = None
+        self.next_edit = 0.0
+        self.messages_sent = 0
+        self.sent = []
+        self.reuse = list(reuse or [])
+        # Whether current was posted by this reply, rather than taken from reuse
+        self.fresh = False
+
+    async def start(self) -> None:
+        await self._new_message()
+
+    async def append(self, text: str) -> None:
+        self.segment += text
+        if len(self.segment) > self.max_length:
+            await self._roll_over()
+        if time.monotonic() >= self.next_edit:
+            await self._edit(close_open_code_block(self.segment[:self.max_length]))
+
+    async def finish(self) -> None:
+        """Write the final text of the current message, with full Markdown."""
+        if self.current is None:
+            await self.start()
+        if not self.segment.strip():
+            self.segment = '(empty response)'
+        await self._roll_over()
+        await self._edit(self.segment, force=True)
+        await self._delete_leftovers()
+
+    async def abort(self) -> None:
+        """Clean up after the stream failed: delete a placeholder that never got text,
+        or mark the partial answer as cut off. A reused message that never got text keeps
+        the answer it held. Telegram errors are logged, not raised, so they do not hide
+        the original failure.
+        """
+        if self.current is None:
+            return
+        chat_id = self.message.chat_id
+        try:
+            if not self.segment.strip():
+                if self.fresh:
+                    await self.queue.call(chat_id, self.current.delete)
+                self.sent.remove(self.current)
+                self.current = None
+            else:
+                text = close_open_code_block(self.segment[:self.max_length - len(INTERRUPTED) - 6])
+                await self._edit(f'{text}\n\n{INTERRUPTED}', force=True)
+                await self._delete_leftovers()
+        except Exception as e:
+            logger.warning("Could not clean up streamed reply in chat %s: %s", chat_id, e)
+
+    async def _roll_over(self) -> None:
+        parts = safe_split_message(self.segment, self.max_length)
+        if len(parts) < 2:
+            return
+        # The splitter ends every part with a newline, the segment may not have one yet
+        rest = parts[-1][:-1]
+        for part in parts[:-1]:
+            await self._edit(part, force=True)
+            await self._new_message()
+        self.segment = rest
+
+    async def _new_message(self) -> None:
+        self.fresh = not self.reuse
+        if self.fresh:
+            self.current = await reply(self.message, PLACEHOLDER, queue=self.queue)
+            self.messages_sent += 1
+        else:
+            self.current = self.reuse.pop(0)
+        self.shown = None
+        self.sent.append(self.current)
+
+    async def _delete_leftovers(self) -> None:
+        # Reused messages the new text did not need
+        while self.reuse:
+            await self.queue.call(self.message.chat_id, self.reuse.pop(0).delete)
+
+    async def _edit(self, text: str, force: bool = False) -> None:
+        if not text.strip() or text == self.shown:
+            return
+        chat_id = self.message.chat_id
+        if not force and not self.queue.ready(chat_id):
+            # The next delta tries again, rather than holding up the stream
+            return
+        try:
+            await self.queue.call(chat_id, lambda: self._edit_text(text), retry=force)
+        except RetryAfter as e:
+            self.next_edit = time.monotonic() + float(e.retry_after)
+            return
+        self.shown = text
+        self.next_edit = time.monotonic() + self.edit_interval
+
+    async def _edit_text(self, text: str) -> None:
+        try:
+            await self.current.edit_text(text, parse_mode=ParseMode.MARKDOWN)
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                return
+            # Partial answers often have unbalanced Markdown, show them as plain text
+            await self.current.edit_text(text)
+
@@ -1,13 +1,22 @@
 import os
+import sys
 import argparse
-from typing import List, Dict
+import asyncio
+import logging
+from typing import Any, Dict, Union
 from anthropic import Anthropic, APIError, APIConnectionError, APITimeoutError
+from retrieval import KnowledgeIndex, CHUNK_TOKENS, CONTEXT_TOKENS, TOP_K, KB_MODE
+from llm import create_message, cache_stats, DEFAULT_MODEL, DEFAULT_MAX_TOKENS
+from tokens import TokenBudgetExceeded, estimate_request_tokens, count_tokens, ledger
+from clients import anthropic_client, async_anthropic_client
+from routing import COMMAND_ROUTES, route_for, should_escalate, escalate
+from prompts import CLI_PROMPT, KnowledgeBase
+import batch
 
-def load_knowledge_base(filepath: str) -> str:
+def load_knowledge_base(filepath: str) -> KnowledgeBase:
     """Load knowledge base from file."""
     try:
-        with open(filepath, 'r', encoding="utf-8") as file:
-            return file.read()
+        return KnowledgeBase.load(filepath)
     except FileNotFoundError:
         print(f"Error: Knowledge base file '{filepath}' not found.")
         exit(1)
@@ -15,32 +24,26 @@ def load_knowledge_base(filepath: str) -> str:
         print(f"Error reading knowledge base: {str(e)}")
         exit(1)
 
-def create_messages(knowledge_base: str, question: str) -> List[Dict[str, str]]:
-    """Create message structure for Claude API."""
-    system_prompt = """
-/- You are a bot helping people understand Ape.
-/- The answer must exist within the source files, otherwise don't answer.
-/- Do not invent anything about ape that is not in source files unless you said you were going creative.
-/- False certainty about what ape can do is the worse thing you can do, avoid it at all costs.
-/- ALWAYS Answer the user question using the source files and tell the source of your answer.
-/- ALWAYS provide a % score of how much of your answer matches the KNOWLEDGE BASE.
-/- If the task is of creative nature it's ok to go wild and beyond just the sources, but you MUST state that confidence score is -1 in that case.
-"""
-    return [{
-        "role": "user",
-        "content": f"{system_prompt}\n\nKnowledge Base:\n{knowledge_base}\n\nQuestion: {question}"
-    }]
-
-def query_claude(client: Anthropic, messages: List[Dict[str, str]], temperature: float = 0) -> str:
+def create_request(knowledge: Union[KnowledgeBase, str], question: str, temperature: float = 0,
+                   model: str = DEFAULT_MODEL, max_tokens: int = DEFAULT_MAX_TOKENS) -> Dict[str, Any]:
+    """Create request for Claude API.
+
+    A KnowledgeBase is sent whole as a cacheable prefix; a str holds per-question retrieved excerpts.
+    """
+    if isinstance(knowledge, KnowledgeBase):
+        return CLI_PROMPT.request(question, knowledge_base=knowledge, temperature=temperature,
+                                  model=model, max_tokens=max_tokens)
+    return CLI_PROMPT.request(question, excerpts=knowledge, temperature=temperature,
+                              model=model, max_tokens=max_tokens)
+
+def query_claude(client: Anthropic, request: Dict[str, Any]) -> str:
     """Send query to Claude API and handle errors."""
     try:
-        response = client.messages.create(
-            model="claude-3-opus-20240229",
-            max_tokens=4000,
-            temperature=temperature,
-            messages=messages
-        )
+        response = create_message(client, request, label='request.py', account='request.py')
         return response.content[0].text
+    except TokenBudgetExceeded as e:
+        print(f"Error: {str(e)}, use fewer --context-tokens or drop --full")
+        exit(1)
     except (APIError, APIConnectionError, APITimeoutError) as e:
         print(f"Claude API error: {str(e)}")
         exit(1)
@@ -48,28 +51,114 @@ def query_claude(client: Anthropic, messages: List[Dict[str, str]], temperature:
         print(f"Unexpected error: {str(e)}")
         exit(1)
 
-def main():
-    # Set up argument parser
-    parser = argparse.ArgumentParser(description='Query Claude about ApeWorX')
-    parser.add_argument('question', nargs='?', default=None, help='Question to ask Claude')
+def add_query_arguments(parser: argparse.ArgumentParser) -> None:
+    """Knowledge base and model options shared by single questions and batch mode."""
     parser.add_argument('-f', '--file', default='knowledge-base.txt', help='Path to knowledge base file')
     parser.add_argument('-t', '--temperature', type=float, default=0, help='Temperature for Claude response (0-1)')
-    parser.add_argument('-i', '--interactive', action='store_true', help='Run in interactive mode')
-    args = parser.parse_args()
+    parser.add_argument('-k', '--top-k', type=int, default=TOP_K, help='Number of knowledge base chunks to retrieve')
+    parser.add_argument('--chunk-tokens', type=int, default=CHUNK_TOKENS, help='Max estimated tokens per knowledge base chunk')
+    parser.add_argument('--context-tokens', type=int, default=CONTEXT_TOKENS, help='Max estimated tokens of knowledge base sent per question')
+    parser.add_argument('--full', action='store_true', default=(KB_MODE == 'cached'),
+                        help='Send the whole knowledge base as a cached prefix instead of retrieved chunks')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log token usage and prompt cache hits per request')
+    parser.add_argument('-m', '--model', default=COMMAND_ROUTES['cli'],
+                        help="'auto' (pick by question), fast, standard, large or a model id")
 
-    # Initialize Claude client
+def claude_key() -> str:
     api_key = os.getenv('CLAUDE_KEY')
     if not api_key:
         print("Error: CLAUDE_KEY environment variable not set")
         exit(1)
-    
-    client = Anthropic(api_key=api_key)
+    return api_key
+
+def request_builder(args, knowledge_base: KnowledgeBase, knowledge_index: KnowledgeIndex):
+    """question -> (request, route), with the knowledge base and model options of args."""
+    def build(question: str):
+        if args.full:
+            context = knowledge_base
+        else:
+            context = knowledge_index.context_for(question, args.top_k, args.context_tokens)
+        route = route_for('cli', question, knowledge_index, choice=args.model)
+        request = create_request(context, question, args.temperature,
+                                 model=route.model, max_tokens=route.max_tokens)
+        return request, route
+    return build
+
+def batch_main(argv):
+    """`request.py batch`: answer every question of a JSONL file into another JSONL file."""
+    parser = argparse.ArgumentParser(prog='request.py batch',
+                                     description='Answer the questions of a JSONL file, resuming where a previous run stopped')
+    parser.add_argument('input', help="JSONL file, one question per line (a string, or an object with a "
+                                      "'question', 'prompt' or 'body' field and optionally an 'id')")
+    parser.add_argument('-o', '--output', help='JSONL file results are appended to (default: <input>.answers.jsonl)')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='Questions asked at the same time')
+    parser.add_argument('--provider-batch', action='store_true',
+                        help='Submit through the Message Batches API (half price, results within 24h) and wait')
+    parser.add_argument('--poll-interval', type=float, default=30, help='Seconds between Message Batch status checks')
+    parser.add_argument('--question-field', help='Input field holding the question')
+    parser.add_argument('--id-field', help='Input field holding a unique id (default: id, request_id or line number)')
+    add_query_arguments(parser)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(message)s')
+    output = args.output or f"{os.path.splitext(args.input)[0]}.answers.jsonl"
+    knowledge_base = load_knowledge_base(args.file)
+    knowledge_index = KnowledgeIndex.from_text(knowledge_base.text, args.chunk_tokens)
+    build = request_builder(args, knowledge_base, knowledge_index)
+
+    done = batch.answered_ids(output)
+    if done:
+        print(f"Resuming: {len(done)} questions already answered in {output}")
+    questions = batch.pending_questions(batch.read_questions(args.input, args.question_field, args.id_field), done)
+    writer = batch.ResultWriter(output)
+    try:
+        if args.provider_batch:
+            batch.run_provider_batches(anthropic_client(claude_key()), questions, build, writer,
+                                       f"{output}.batch", poll_interval=args.poll_interval)
+        else:
+            asyncio.run(batch.run_concurrent(async_anthropic_client(claude_key()), questions, build, writer,
+                                             concurrency=args.concurrency, warm_first=args.full))
+    except KeyboardInterrupt:
+        print("Interrupted, run the same command again to resume")
+    finally:
+        writer.close()
+        print(f"{output}: {writer.summary()}")
+
+def main():
+    if sys.argv[1:2] == ['batch']:
+        return batch_main(sys.argv[2:])
+
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Query Claude about ApeWorX',
+                                     epilog='Run `request.py batch --help` to answer a JSONL file of questions')
+    parser.add_argument('question', nargs='?', default=None, help='Question to ask Claude')
+    parser.add_argument('-i', '--interactive', action='store_true', help='Run in interactive mode')
+    parser.add_argument('--count-tokens', action='store_true', help='Print the estimated and exact input tokens before sending')
+    add_query_arguments(parser)
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # Initialize Claude client
+    client = anthropic_client(claude_key())
     knowledge_base = load_knowledge_base(args.file)
+    knowledge_index = KnowledgeIndex.from_text(knowledge_base.text, args.chunk_tokens)
+    build = request_builder(args, knowledge_base, knowledge_index)
 
     def process_question(question: str):
         """Process a single question and print response."""
-        messages = create_messages(knowledge_base, question)
-        response = query_claude(client, messages, args.temperature)
+        request, route = build(question)
+        if args.verbose:
+            print(f"Model: {route.model} ({route.reason})")
+        if args.count_tokens:
+            print(f"Input tokens: ~{estimate_request_tokens(request)} estimated, "
+                  f"{count_tokens(client, request)} counted")
+        response = query_claude(client, request)
+        while should_escalate(route, response):
+            route = escalate(route)
+            print(f"Low knowledge base match, asking {route.model}...")
+            response = query_claude(client, {**request, 'model': route.model, 'max_tokens': route.max_tokens})
         print("\nClaude's Response:")
         print("-" * 80)
         print(response)
@@ -83,6 +172,9 @@ def main():
                 break
             if question:
                 process_question(question)
+        if args.verbose:
+            print(f"Prompt cache: {cache_stats.snapshot()}")
+            print(f"Usage: {ledger.totals()}")
     elif args.question:
         process_question(args.question)
     else:
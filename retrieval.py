@@ -0,0 +1,166 @@
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+# Max estimated tokens per chunk, and total tokens of knowledge sent per request
+CHUNK_TOKENS = int(os.getenv('KB_CHUNK_TOKENS', '800'))
+CONTEXT_TOKENS = int(os.getenv('KB_CONTEXT_TOKENS', '12000'))
+TOP_K = int(os.getenv('KB_TOP_K', '8'))
+# 'retrieval' sends the top-k chunks per question, 'cached' sends the whole knowledge
+# base as a cacheable prompt prefix (cheaper when the same prefix is reused within minutes)
+KB_MODE = os.getenv('KB_MODE', 'retrieval')
+
+# concat.py writes "#### path", older builds and gpt.py use "######## path"; markdown
+# headings like "#### Inlining" are not file headers, so "####" needs a file extension
+FILE_HEADER_RE = re.compile(r'^(?:#{8} (\S+)|#{4} (\S+\.\w+))[ \t]*$', re.MULTILINE)
+WORD_RE = re.compile(r'[a-z0-9_]+')
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token)."""
+    return (len(text) + 3) // 4
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens used for indexing and querying."""
+    return WORD_RE.findall(text.lower())
+
+
+@dataclass
+class Chunk:
+    source: str
+    part: int
+    text: str
+
+    @property
+    def label(self) -> str:
+        return self.source if self.part == 0 else f"{self.source} (part {self.part + 1})"
+
+
+def split_sections(text: str) -> List[Tuple[str, str]]:
+    """Split concatenated knowledge base text into (source path, content) pairs."""
+    headers = list(FILE_HEADER_RE.finditer(text))
+    if not headers:
+        return [('knowledge-base', text.strip())] if text.strip() else []
+
+    sections = []
+    for i, match in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(text)
+        content = text[match.end():end].strip()
+        if content:
+            sections.append((match.group(1) or match.group(2), content))
+    return sections
+
+
+def split_paragraphs(text: str, max_tokens: int) -> List[str]:
+    """Split a section into pieces of at most max_tokens, on blank lines outside code blocks."""
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+
+    pieces = []
+    current: List[str] = []
+    current_tokens = 0
+    code_block = False
+    for line in text.split('\n'):
+        if line.lstrip().startswith('```'):
+            code_block = not code_block
+        line_tokens = estimate_tokens(line) + 1
+        if current and current_tokens + line_tokens > max_tokens and (not code_block or current_tokens > 2 * max_tokens):
+            pieces.append('\n'.join(current).strip())
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+        if not line.strip() and not code_block and current_tokens >= max_tokens // 2:
+            pieces.append('\n'.join(current).strip())
+            current, current_tokens = [], 0
+    if current:
+        pieces.append('\n'.join(current).strip())
+    return [piece for piece in pieces if piece]
+
+
+class KnowledgeIndex:
+    """BM25 index over knowledge base chunks, built locally from the concatenated file."""
+
+    def __init__(self, chunks: List[Chunk]):
+        self.chunks = chunks
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.lengths: List[int] = []
+        for idx, chunk in enumerate(chunks):
+            # Index the source path too, so questions naming a file or module hit it
+            terms = Counter(tokenize(chunk.source) + tokenize(chunk.text))
+            self.lengths.append(sum(terms.values()))
+            for term, freq in terms.items():
+                self.postings[term].append((idx, freq))
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+
+    @classmethod
+    def from_text(cls, text: str, chunk_tokens: int = CHUNK_TOKENS) -> 'KnowledgeIndex':
+        chunks = []
+        for source, content in split_sections(text):
+            for part, piece in enumerate(split_paragraphs(content, chunk_tokens)):
+                chunks.append(Chunk(source, part, piece))
+        return cls(chunks)
+
+    @classmethod
+    def from_file(cls, filepath: str, chunk_tokens: int = CHUNK_TOKENS) -> 'KnowledgeIndex':
+        with open(filepath, 'r', encoding='utf-8') as file:
+            return cls.from_text(file.read(), chunk_tokens)
+
+    def idf(self, term: str) -> float:
+        doc_freq = len(self.postings.get(term, ()))
+        n = len(self.chunks)
+        return math.log(1 + (n - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def coverage(self, query: str) -> float:
+        """Share of the query's terms (weighted by idf) that occur in the knowledge base."""
+        terms = set(tokenize(query))
+        if not terms or not self.chunks:
+            return 0.0
+        weights = {term: self.idf(term) for term in terms}
+        total = sum(weights.values())
+        found = sum(weight for term, weight in weights.items() if term in self.postings)
+        return found / total if total else 0.0
+
+    def search(self, query: str, k: int = TOP_K) -> List[Tuple[Chunk, float]]:
+        """Return the top-k chunks for the query with their BM25 scores."""
+        return [(self.chunks[idx], score) for idx, score in self._rank(query, k)]
+
+    def _rank(self, query: str, k: int) -> List[Tuple[int, float]]:
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(term)
+            for idx, freq in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[idx] / self.avg_length)
+                scores[idx] += idf * freq * (BM25_K1 + 1) / (freq + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def select(self, query: str, k: int = TOP_K, max_tokens: int = CONTEXT_TOKENS) -> List[Chunk]:
+        """Top-k chunks for the query that fit in max_tokens, in knowledge base order."""
+        selected = []
+        used = 0
+        for idx, _ in self._rank(query, k):
+            tokens = estimate_tokens(self.chunks[idx].text)
+            if used + tokens > max_tokens:
+                continue
+            selected.append(idx)
+            used += tokens
+        return [self.chunks[idx] for idx in sorted(selected)]
+
+    def context_for(self, query: str, k: int = TOP_K, max_tokens: int = CONTEXT_TOKENS) -> str:
+        """Relevant knowledge base excerpts for the query, each headed by its source path."""
+        return format_chunks(self.select(query, k, max_tokens))
+
+
+def format_chunks(chunks: List[Chunk]) -> str:
+    if not chunks:
+        return 'No relevant knowledge base entries found.'
+    return '\n\n'.join(f"#### {chunk.label}\n\n{chunk.text}" for chunk in chunks)
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from threading import Lock
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', '4'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '20'))
+# Consecutive failures that open a circuit, and seconds before it lets a probe through
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+BREAKER_RESET = float(os.getenv('BREAKER_RESET', '30'))
+
+# Rate limited, overloaded (529) or a gateway/server hiccup
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+# Connection level failures of the HTTP clients that are installed
+TRANSIENT_ERRORS = [ConnectionError, TimeoutError]
+try:
+    import requests
+    TRANSIENT_ERRORS += [requests.ConnectionError, requests.Timeout]
+except ImportError:
+    pass
+try:
+    import anthropic
+    TRANSIENT_ERRORS.append(anthropic.APIConnectionError)
+except ImportError:
+    pass
+TRANSIENT_ERRORS = tuple(TRANSIENT_ERRORS)
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a dependency that has been failing."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def status_of(exc: BaseException) -> Optional[int]:
+    status = getattr(exc, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(exc: BaseException) -> bool:
+    status = status_of(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return isinstance(exc, TRANSIENT_ERRORS)
+
+
+def retry_after(exc: BaseException) -> float:
+    """Seconds from a Retry-After header on the error's response, 0 if there is none."""
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    try:
+        return max(float(headers.get('retry-after', 0)), 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY,
+                  rng: Callable[[], float] = random.random) -> float:
+    """Full jitter: uniform in [0, min(cap, base * 2**attempt)]."""
+    return rng() * min(cap, base * (2 ** attempt))
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures and fails fast for reset_timeout seconds.
+
+    After that a single probe call is let through (half-open); its success closes the
+    circuit, its failure opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURES,
+                 reset_timeout: float = BREAKER_RESET, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._lock = Lock()
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if self.clock() >= self.opened_at + self.reset_timeout else 'open'
+
+    def retry_in(self) -> float:
+        """Seconds until an open circuit lets a call through, 0 when calls are allowed."""
+        if self.opened_at is None:
+            return 0.0
+        return max(self.opened_at + self.reset_timeout - self.clock(), 0.0)
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.opened_at is None:
+                return
+            wait = self.opened_at + self.reset_timeout - self.clock()
+            if wait > 0:
+                raise CircuitOpen(self.name, wait)
+            if self._probing:
+                raise CircuitOpen(self.name, 1.0)
+            self._probing = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("Circuit %s closed", self.name)
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+                logger.warning("Circuit %s opened after %d failures", self.name, self.failures)
+                self.opened_at = self.clock()
+            self._probing = False
+
+    def release(self) -> None:
+        """Forget an in-flight probe that was cancelled before it finished."""
+        with self._lock:
+            self._probing = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = Lock()
+
+
+def breaker(name: str) -> CircuitBreaker:
+    """Shared breaker per dependency name (e.g. 'claude' or a host)."""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def _delay(exc: BaseException, attempt: int, base: float, cap: float) -> float:
+    return min(max(backoff_delay(attempt, base, cap), retry_after(exc)), cap)
+
+
+def call_with_retries(fn: Callable[[], T], circuit: Optional[CircuitBreaker] = None,
+                      attempts: int = RETRY_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY,
+                      max_delay: float = RETRY_MAX_DELAY,
+                      should_retry: Callable[[BaseException], bool] = lambda e: True,
+                      sleep: Callable[[float], None] = time.sleep) -> T:
+    """Call fn, retrying transient errors with jittered exponential backoff behind a breaker.
+
+    should_retry can veto a retry (e.g. once a streamed answer has started); the error
+    still counts against the breaker.
+    """
+    for attempt in range(attempts):
+        if circuit is not None:
+            circuit.before_call()
+        try:
+            result = fn()
+        except Exception as e:
+            transient = is_retryable(e)
+            if circuit is not None and transient:
+                circuit.record_failure()
+            elif circuit is not None:
+                circuit.record_success()  # A 400 and the like means the dependency itself is up
+            if not transient or not should_retry(e) or attempt == attempts - 1:
+                raise
+            delay = _delay(e, attempt, base_delay, max_delay)
+            logger.info("Retrying in %.2fs after %s", delay, e)
+            sleep(delay)
+            continue
+        except BaseException:
+            if circuit is not None:
+                circuit.release()
+            raise
+        if circuit is not None:
+            circuit.record_success()
+        return result
+    raise RuntimeError('attempts must be at least 1')
+
+
+async def acall_with_retries(fn: Callable[[], Awaitable[T]], circuit: Optional[CircuitBreaker] = None,
+                             attempts: int = RETRY_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY,
+                             max_delay: float = RETRY_MAX_DELAY,
+                             should_retry: Callable[[BaseException], bool] = lambda e: True) -> T:
+    """Async variant of call_with_retries; fn is called again for every attempt."""
+    for attempt in range(attempts):
+        if circuit is not None:
+            circuit.before_call()
+        try:
+            result = await fn()
+        except Exception as e:
+            transient = is_retryable(e)
+            if circuit is not None and transient:
+                circuit.record_failure()
+            elif circuit is not None:
+                circuit.record_success()  # A 400 and the like means the dependency itself is up
+            if not transient or not should_retry(e) or attempt == attempts - 1:
+                raise
+            delay = _delay(e, attempt, base_delay, max_delay)
+            logger.info("Retrying in %.2fs after %s", delay, e)
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            if circuit is not None:
+                circuit.release()
+            raise
+        if circuit is not None:
+            circuit.record_success()
+        return result
+    raise RuntimeError('attempts must be at least 1')
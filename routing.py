@@ -0,0 +1,117 @@
+import os
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+from llm import DEFAULT_MODEL
+from retrieval import KnowledgeIndex, estimate_tokens
+
+# Model and max_tokens of each tier, cheapest first
+TIERS = ('fast', 'standard', 'large')
+MODELS = {
+    'fast': os.getenv('MODEL_FAST', 'claude-3-5-haiku-20241022'),
+    'standard': os.getenv('MODEL_STANDARD', 'claude-3-5-sonnet-20241022'),
+    'large': os.getenv('MODEL_LARGE', DEFAULT_MODEL),
+}
+MAX_TOKENS = {
+    'fast': int(os.getenv('MAX_TOKENS_FAST', '1024')),
+    'standard': int(os.getenv('MAX_TOKENS_STANDARD', '2048')),
+    'large': int(os.getenv('MAX_TOKENS_LARGE', '4000')),
+}
+
+# Per command: 'auto' (classify each question), a tier name, or a model id
+COMMAND_ROUTES = {
+    'prompt': os.getenv('ROUTE_PROMPT', 'auto'),
+    'preaudit': os.getenv('ROUTE_PREAUDIT', 'large'),
+    'cli': os.getenv('ROUTE_CLI', 'auto'),
+}
+# Answers whose knowledge base match score is below this are retried on the next tier
+ESCALATE_BELOW = float(os.getenv('ESCALATE_BELOW', '60'))
+
+# Questions up to this many tokens are short; above LONG_QUESTION they need the large tier
+SHORT_QUESTION = 40
+LONG_QUESTION = 1500
+# Share of the question's terms found in the knowledge base for a question to count as "covered"
+COVERED = 0.6
+
+CODE_RE = re.compile(
+    r'```|^\s*(?:def|function)\s+\w+\s*\(|^\s*class\s+\w+\s*[:(]|^\s*from\s+[\w.]+\s+import\s'
+    r'|^\s*@(?:external|internal|view|pure|payable)\b|\w+\([^)]*\)\s*[:{;]', re.MULTILINE)
+COMPLEX_RE = re.compile(
+    r'\b(?:why|compare|comparison|difference|design|architecture|trade-?offs?|debug|traceback|error|'
+    r'implement|write|refactor|optimi[sz]e|step[- ]by[- ]step|in detail|explain how)\b', re.IGNORECASE)
+# The score the system prompt asks for: "Knowledge base match score: 85%", "confidence score is -1",
+# "85% match with the knowledge base". Other percentages ("a 5% fee") are not scores.
+SCORE_RE = re.compile(
+    r'(?:score|match(?:es|ing)?|confidence|knowledge base)\b[^\n\d%-]{0,30}?(-1\b|\d{1,3}(?:\.\d+)?\s*%)'
+    r'|(?<![\w.])(\d{1,3}(?:\.\d+)?\s*%)\s*(?:match|score|confidence|of (?:the |this |my )?answer|knowledge base)',
+    re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class Route:
+    tier: Optional[str]
+    model: str
+    max_tokens: int
+    reason: str
+
+    @property
+    def can_escalate(self) -> bool:
+        return self.tier in TIERS[:-1]
+
+
+def tier_route(tier: str, reason: str) -> Route:
+    return Route(tier, MODELS[tier], MAX_TOKENS[tier], reason)
+
+
+def classify(question: str, index: Optional[KnowledgeIndex] = None) -> Route:
+    """Pick a tier from local features: length, code, complexity keywords and knowledge base coverage."""
+    tokens = estimate_tokens(question)
+    if tokens > LONG_QUESTION:
+        return tier_route('large', f'long question ({tokens} tokens)')
+    has_code = bool(CODE_RE.search(question))
+    is_complex = bool(COMPLEX_RE.search(question))
+    if has_code and is_complex:
+        return tier_route('large', 'code and a complex ask')
+    if has_code or is_complex or tokens > SHORT_QUESTION:
+        reasons = [name for name, flag in (('code', has_code), ('complex', is_complex),
+                                           ('long', tokens > SHORT_QUESTION)) if flag]
+        return tier_route('standard', ', '.join(reasons))
+    coverage = index.coverage(question) if index is not None else 1.0
+    if coverage < COVERED:
+        return tier_route('standard', f'low knowledge base coverage ({coverage:.0%})')
+    return tier_route('fast', f'short, covered question ({coverage:.0%})')
+
+
+def route_for(command: str, question: str = '', index: Optional[KnowledgeIndex] = None,
+              choice: Optional[str] = None) -> Route:
+    """Route for a command: choice (or the command's configured route) is 'auto', a tier or a model id."""
+    choice = choice or COMMAND_ROUTES.get(command, 'auto')
+    if choice == 'auto':
+        return classify(question, index)
+    if choice in TIERS:
+        return tier_route(choice, f'{command} uses {choice}')
+    tier = next((name for name in TIERS if MODELS[name] == choice), None)
+    return Route(tier, choice, MAX_TOKENS[tier or 'large'], f'{command} uses {choice}')
+
+
+def escalate(route: Route) -> Route:
+    tier = TIERS[TIERS.index(route.tier) + 1]
+    return tier_route(tier, f'escalated from {route.tier}')
+
+
+def confidence_score(answer: str) -> Optional[float]:
+    """The % knowledge base match score the system prompt asks for; the last one mentioned wins."""
+    matches = SCORE_RE.findall(answer)
+    if not matches:
+        return None
+    value = float(next(group for group in matches[-1] if group).rstrip('% '))
+    return value if value <= 100 else None
+
+
+def should_escalate(route: Route, answer: str, threshold: float = ESCALATE_BELOW) -> bool:
+    """True when a cheaper tier answered with a low (but not creative, -1) match score."""
+    if not route.can_escalate:
+        return False
+    score = confidence_score(answer)
+    return score is not None and 0 <= score < threshold
@@ -0,0 +1,475 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import unquote, urlparse
+
+logger = logging.getLogger(__name__)
+
+# 'sqlite' (BOT_DB, shared by processes on one machine), 'memory' (one process) or redis://host:port/db
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')
+# Seconds between checks for notifications published by other processes (SQLite backend)
+STATE_POLL_INTERVAL = float(os.getenv('STATE_POLL_INTERVAL', '1'))
+# Optimistic transactions retried this often when another replica wrote the same keys first
+TRANSACT_ATTEMPTS = 100
+
+# A value to write: a string, a (string, ttl seconds) pair, or None to delete the key
+Value = Union[None, str, Tuple[str, float]]
+Transaction = Callable[[Dict[str, Optional[str]]], Tuple[Dict[str, Value], Any]]
+
+
+class StateConflict(RuntimeError):
+    """A transaction kept losing to concurrent writers."""
+
+
+def _entry(value: Value) -> Tuple[Optional[str], Optional[float]]:
+    if isinstance(value, tuple):
+        return value
+    return value, None
+
+
+class StateBackend(ABC):
+    """Shared key/value state with atomic updates and change notifications.
+
+    transact(keys, fn) is the primitive: fn gets the current values of keys and returns
+    (writes, result); the writes are applied only if no one changed those keys meanwhile.
+    incr and compare_and_set are built on it unless a backend has a native version.
+    """
+
+    def get(self, key: str) -> Optional[str]:
+        return self.get_many([key])[0]
+
+    @abstractmethod
+    def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        ...
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        self.transact([key], lambda current: ({key: (value, ttl) if ttl else value}, None))
+
+    def delete(self, key: str) -> None:
+        self.transact([key], lambda current: ({key: None}, None))
+
+    @abstractmethod
+    def transact(self, keys: List[str], fn: Transaction) -> Any:
+        ...
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        def add(current):
+            value = int(current[key] or 0) + amount
+            return {key: (str(value), ttl) if ttl else str(value)}, value
+        return self.transact([key], add)
+
+    def compare_and_set(self, key: str, expected: Optional[str], value: Optional[str]) -> bool:
+        """Write value (None deletes) only if key currently holds expected (None: is absent)."""
+        def swap(current):
+            if current[key] != expected:
+                return {}, False
+            return {key: value}, True
+        return self.transact([key], swap)
+
+    @abstractmethod
+    def scan(self, prefix: str) -> Dict[str, str]:
+        """All live keys starting with prefix, with their values."""
+
+    @abstractmethod
+    def publish(self, channel: str, message: str) -> None:
+        ...
+
+    @abstractmethod
+    def subscribe(self, channel: str, callback: Callable[[str], None]) -> None:
+        """Call callback(message) for every message published on channel, from any process."""
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """Single process state, e.g. for tests or one polling bot."""
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._data: Dict[str, Tuple[str, Optional[float]]] = {}
+        self._subscribers: Dict[str, List[Callable[[str], None]]] = {}
+        self._writes = 0
+
+    def _live(self, key: str, now: float) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= now:
+            del self._data[key]
+            return None
+        return value
+
+    def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        with self._lock:
+            now = self.clock()
+            return [self._live(key, now) for key in keys]
+
+    def transact(self, keys: List[str], fn: Transaction) -> Any:
+        with self._lock:
+            now = self.clock()
+            writes, result = fn({key: self._live(key, now) for key in keys})
+            for key, value in writes.items():
+                value, ttl = _entry(value)
+                if value is None:
+                    self._data.pop(key, None)
+                else:
+                    self._data[key] = (value, now + ttl if ttl else None)
+            self._writes += len(writes)
+            if self._writes >= 10000:
+                self._writes = 0
+                for key in list(self._data):
+                    self._live(key, now)
+            return result
+
+    def scan(self, prefix: str) -> Dict[str, str]:
+        with self._lock:
+            now = self.clock()
+            return {key: value for key in list(self._data) if key.startswith(prefix)
+                    for value in [self._live(key, now)] if value is not None}
+
+    def publish(self, channel: str, message: str) -> None:
+        for callback in list(self._subscribers.get(channel, ())):
+            callback(message)
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]) -> None:
+        self._subscribers.setdefault(channel, []).append(callback)
+
+
+class SQLiteBackend(StateBackend):
+    """State in a SQLite (WAL) file shared by the processes of one machine.
+
+    Transactions take the write lock up front (BEGIN IMMEDIATE). Notifications are rows
+    in an events table that each subscriber polls every poll_interval seconds.
+    """
+
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL);
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, message TEXT NOT NULL, created REAL NOT NULL
+    );
+    '''
+    # Events older than this are deleted
+    EVENT_RETENTION = 3600.0
+
+    def __init__(self, path: str, poll_interval: float = STATE_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._subscribers: Dict[str, List[Callable[[str], None]]] = {}
+        self._poller: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(self.SCHEMA)
+        self._last_event = conn.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        conn = self._connection()
+        now = time.time()
+        values = {}
+        for key in keys:
+            row = conn.execute('SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)',
+                               (key, now)).fetchone()
+            values[key] = row[0] if row else None
+        return [values[key] for key in keys]
+
+    def transact(self, keys: List[str], fn: Transaction) -> Any:
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            current = {}
+            for key in keys:
+                row = conn.execute('SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)',
+                                   (key, now)).fetchone()
+                current[key] = row[0] if row else None
+            writes, result = fn(current)
+            for key, value in writes.items():
+                value, ttl = _entry(value)
+                if value is None:
+                    conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+                else:
+                    conn.execute('INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)',
+                                 (key, value, now + ttl if ttl else None))
+            conn.execute('COMMIT')
+            return result
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def scan(self, prefix: str) -> Dict[str, str]:
+        # Escape LIKE wildcards in the prefix
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        rows = self._connection().execute(
+            "SELECT key, value FROM kv WHERE key LIKE ? ESCAPE '\\' AND (expires IS NULL OR expires > ?)",
+            (pattern, time.time()))
+        return dict(rows)
+
+    def publish(self, channel: str, message: str) -> None:
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('INSERT INTO events (channel, message, created) VALUES (?, ?, ?)', (channel, message, now))
+            # Old events and expired keys are cleaned up here, writes are rare
+            conn.execute('DELETE FROM events WHERE created < ?', (now - self.EVENT_RETENTION,))
+            conn.execute('DELETE FROM kv WHERE expires IS NOT NULL AND expires <= ?', (now,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]) -> None:
+        self._subscribers.setdefault(channel, []).append(callback)
+        if self._poller is None:
+            self._poller = threading.Thread(target=self._poll, name='state-events', daemon=True)
+            self._poller.start()
+
+    def poll(self) -> int:
+        """Deliver events published since the last poll; returns how many were delivered."""
+        rows = self._connection().execute(
+            'SELECT id, channel, message FROM events WHERE id > ? ORDER BY id', (self._last_event,)).fetchall()
+        for event_id, channel, message in rows:
+            self._last_event = event_id
+            for callback in list(self._subscribers.get(channel, ())):
+                try:
+                    callback(message)
+                except Exception:
+                    logger.exception("State notification handler failed")
+        return len(rows)
+
+    def _poll(self) -> None:
+        while not self._closed.wait(self.poll_interval):
+            try:
+                self.poll()
+            except sqlite3.Error as e:
+                logger.warning("Polling state events failed: %s", e)
+
+    def close(self) -> None:
+        self._closed.set()
+        # Its database may be removed right after, e.g. a temporary directory in tests
+        if self._poller is not None and self._poller is not threading.current_thread():
+            self._poller.join()
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection:
+    """Minimal RESP2 client: enough for GET/SET/INCRBY, WATCH/MULTI/EXEC, SCAN and pub/sub."""
+
+    def __init__(self, host: str, port: int, db: int = 0, password: Optional[str] = None,
+                 timeout: Optional[float] = 10.0):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        if password:
+            self.command('AUTH', password)
+        if db:
+            self.command('SELECT', db)
+
+    def send(self, *args) -> None:
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        self.sock.sendall(b''.join(parts))
+
+    def read(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError('Redis closed the connection')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode()
+        if kind == b'-':
+            raise RedisError(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2].decode()
+        if kind == b'*':
+            length = int(rest)
+            return None if length < 0 else [self.read() for _ in range(length)]
+        raise RedisError(f'Unexpected reply {line!r}')
+
+    def command(self, *args):
+        self.send(*args)
+        return self.read()
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisBackend(StateBackend):
+    """State in Redis (or anything speaking its protocol), shared by replicas on any machine.
+
+    Transactions use WATCH / MULTI / EXEC and are retried when a watched key changed.
+    """
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.strip('/') or 0)
+        self.password = unquote(parsed.password) if parsed.password else None
+        self._local = threading.local()
+        self._subscribers: Dict[str, List[Callable[[str], None]]] = {}
+        self._subscriber: Optional[RedisConnection] = None
+        self._subscribed = threading.Event()
+        self._closed = threading.Event()
+
+    def _connect(self, timeout: Optional[float] = 10.0) -> RedisConnection:
+        return RedisConnection(self.host, self.port, self.db, self.password, timeout)
+
+    def _command(self, *args):
+        """Run a command on this thread's connection, reconnecting once if it was dropped."""
+        for attempt in range(2):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = self._connect()
+            try:
+                return conn.command(*args)
+            except (ConnectionError, OSError):
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+
+    def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        return self._command('MGET', *keys) if keys else []
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        if ttl:
+            self._command('SET', key, value, 'PX', max(int(ttl * 1000), 1))
+        else:
+            self._command('SET', key, value)
+
+    def delete(self, key: str) -> None:
+        self._command('DEL', key)
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        if not ttl:
+            return self._command('INCRBY', key, amount)
+        self._command('MULTI')
+        self._command('INCRBY', key, amount)
+        self._command('PEXPIRE', key, max(int(ttl * 1000), 1))
+        return self._command('EXEC')[0]
+
+    def transact(self, keys: List[str], fn: Transaction) -> Any:
+        for _ in range(TRANSACT_ATTEMPTS):
+            self._command('WATCH', *keys)
+            try:
+                writes, result = fn(dict(zip(keys, self._command('MGET', *keys))))
+            except BaseException:
+                self._command('UNWATCH')
+                raise
+            if not writes:
+                self._command('UNWATCH')
+                return result
+            self._command('MULTI')
+            for key, value in writes.items():
+                value, ttl = _entry(value)
+                if value is None:
+                    self._command('DEL', key)
+                elif ttl:
+                    self._command('SET', key, value, 'PX', max(int(ttl * 1000), 1))
+                else:
+                    self._command('SET', key, value)
+            if self._command('EXEC') is not None:
+                return result
+        raise StateConflict(f"Transaction on {keys} kept conflicting")
+
+    def scan(self, prefix: str) -> Dict[str, str]:
+        pattern = ''.join('\\' + char if char in '*?[]\\' else char for char in prefix) + '*'
+        keys, cursor = [], '0'
+        while True:
+            cursor, batch = self._command('SCAN', cursor, 'MATCH', pattern, 'COUNT', 500)
+            keys.extend(batch)
+            if cursor == '0':
+                break
+        keys = list(dict.fromkeys(keys))
+        return {key: value for key, value in zip(keys, self.get_many(keys)) if value is not None}
+
+    def publish(self, channel: str, message: str) -> None:
+        self._command('PUBLISH', channel, message)
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]) -> None:
+        first = channel not in self._subscribers
+        self._subscribers.setdefault(channel, []).append(callback)
+        if self._subscriber is None and not self._subscribed.is_set():
+            self._subscribed.set()
+            threading.Thread(target=self._listen, name='state-events', daemon=True).start()
+        elif first and self._subscriber is not None:
+            self._subscriber.send('SUBSCRIBE', channel)
+
+    def _listen(self) -> None:
+        delay = 0.5
+        while not self._closed.is_set():
+            try:
+                self._subscriber = self._connect(timeout=None)
+                self._subscriber.send('SUBSCRIBE', *self._subscribers)
+                delay = 0.5
+                while True:
+                    reply = self._subscriber.read()
+                    if isinstance(reply, list) and reply[0] == 'message':
+                        for callback in list(self._subscribers.get(reply[1], ())):
+                            try:
+                                callback(reply[2])
+                            except Exception:
+                                logger.exception("State notification handler failed")
+            except (ConnectionError, OSError, RedisError) as e:
+                if self._closed.is_set():
+                    return
+                logger.warning("State subscription lost (%s), reconnecting in %.1fs", e, delay)
+                self._subscriber = None
+                self._closed.wait(delay)
+                delay = min(delay * 2, 30.0)
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._subscriber is not None:
+            self._subscriber.close()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+
+
+def open_backend(spec: str = STATE_BACKEND, path: Optional[str] = None) -> StateBackend:
+    """Backend for 'memory', 'sqlite' (at path), 'sqlite:///file.db' or 'redis://host:port/db'."""
+    if spec == 'memory':
+        return MemoryBackend()
+    if spec.startswith(('redis://', 'rediss://')):
+        if spec.startswith('rediss://'):
+            raise ValueError('TLS (rediss://) is not supported, use a local TLS tunnel')
+        return RedisBackend(spec)
+    if spec == 'sqlite':
+        return SQLiteBackend(path or os.getenv('BOT_DB', 'bot.db'))
+    if spec.startswith('sqlite:///'):
+        return SQLiteBackend(spec[len('sqlite:///'):])
+    raise ValueError(f"Unknown STATE_BACKEND {spec!r}")
+
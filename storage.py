@@ -0,0 +1,162 @@
+import datetime
+import json
+import logging
+import os
+import sqlite3
+from typing import Any, Callable, Dict, Optional, Tuple
+import yaml
+
+from state import STATE_BACKEND, StateBackend, open_backend
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv('BOT_DB', 'bot.db')
+
+# Keys in the state backend
+ADMIN = 'admin:'
+GROUP = 'group:'
+MESSAGES = 'messages:'  # messages:<group>:<day>, a counter that expires after two days
+USAGE = 'usage:'
+META = 'meta:'
+# Channel announcing changed admin / group keys to the other replicas
+CHANGES = 'state-changes'
+DAY = 86400.0
+
+
+def today() -> str:
+    return str(datetime.date.today())
+
+
+class Storage:
+    """Admins, whitelisted groups and usage data, kept in a shared state backend.
+
+    Writes are single-key and atomic: message counters are backend increments and admin or
+    group additions are compare-and-set, so replicas never lose each other's updates.
+    Changes to admins and groups are announced on CHANGES for the other replicas.
+    """
+
+    def __init__(self, path: str = DB_PATH, backend: Optional[StateBackend] = None):
+        self.path = path
+        self.backend = backend or open_backend(STATE_BACKEND, path)
+
+    def load(self) -> Tuple[Dict[str, bool], Dict[str, Dict[str, Any]], Dict[str, Any]]:
+        """Return (admins, groups, usage_data) in the shape the bot keeps in memory."""
+        admins = {key[len(ADMIN):]: True for key in self.backend.scan(ADMIN)}
+        records = {key[len(GROUP):]: json.loads(value) for key, value in self.backend.scan(GROUP).items()}
+        day = today()
+        counters = self.backend.get_many([f'{MESSAGES}{group_id}:{day}' for group_id in records])
+        groups = {group_id: self._group(record, counter, day)
+                  for (group_id, record), counter in zip(records.items(), counters)}
+        usage_data = {key[len(USAGE):]: json.loads(value) for key, value in self.backend.scan(USAGE).items()}
+        return admins, groups, usage_data
+
+    def group(self, group_id: str) -> Optional[Dict[str, Any]]:
+        day = today()
+        record, counter = self.backend.get_many([f'{GROUP}{group_id}', f'{MESSAGES}{group_id}:{day}'])
+        return self._group(json.loads(record), counter, day) if record is not None else None
+
+    @staticmethod
+    def _group(record: Dict[str, Any], counter: Optional[str], day: str) -> Dict[str, Any]:
+        if counter is not None:
+            return {'messages_today': int(counter), 'last_reset': day}
+        return {'messages_today': 0, 'last_reset': record.get('last_reset', day)}
+
+    def add_admin(self, user_id: str) -> bool:
+        """Add an admin; returns False if they already were one."""
+        added = self.backend.compare_and_set(f'{ADMIN}{user_id}', None, '1')
+        if added:
+            self.backend.publish(CHANGES, f'{ADMIN}{user_id}')
+        return added
+
+    def set_group(self, group_id: str, messages_today: int = 0, last_reset: str = None) -> None:
+        last_reset = last_reset or today()
+        self.backend.set(f'{GROUP}{group_id}', json.dumps({'last_reset': last_reset}))
+        counter = f'{MESSAGES}{group_id}:{today()}'
+        if last_reset == today():
+            self.backend.set(counter, str(messages_today), ttl=2 * DAY)
+        else:
+            self.backend.delete(counter)
+        self.backend.publish(CHANGES, f'{GROUP}{group_id}')
+
+    def add_group_if_missing(self, group_id: str) -> bool:
+        added = self.backend.compare_and_set(f'{GROUP}{group_id}', None, json.dumps({'last_reset': today()}))
+        if added:
+            self.backend.publish(CHANGES, f'{GROUP}{group_id}')
+        return added
+
+    def increment_messages(self, group_id: str, amount: int = 1) -> Dict[str, Any]:
+        """Atomically count messages for a group; each day has its own counter."""
+        if self.backend.get(f'{GROUP}{group_id}') is None:
+            raise KeyError(group_id)
+        day = today()
+        count = self.backend.incr(f'{MESSAGES}{group_id}:{day}', amount, ttl=2 * DAY)
+        return {'messages_today': count, 'last_reset': day}
+
+    def set_usage(self, key: str, value: Any) -> None:
+        self.backend.set(f'{USAGE}{key}', json.dumps(value, default=str))
+
+    def watch(self, callback: Callable[[str, str], None]) -> None:
+        """Call callback(kind, id) with kind 'admin' or 'group' when any replica changes one."""
+        def changed(message: str) -> None:
+            kind, _, key = message.partition(':')
+            callback(kind, key)
+        self.backend.subscribe(CHANGES, changed)
+
+    def _migrate_once(self, name: str) -> bool:
+        """Claim a one-time migration; only the first replica to get here runs it."""
+        return self.backend.compare_and_set(f'{META}{name}', None, datetime.datetime.now().isoformat())
+
+    def _import(self, admins: Dict[str, Any], groups: Dict[str, Dict[str, Any]], usage_data: Dict[str, Any]) -> None:
+        for user_id, enabled in admins.items():
+            if enabled:
+                self.backend.compare_and_set(f'{ADMIN}{user_id}', None, '1')
+        for group_id, data in groups.items():
+            data = data or {}
+            self.set_group(str(group_id), int(data.get('messages_today', 0)), str(data.get('last_reset', today())))
+        for key, value in usage_data.items():
+            self.set_usage(str(key), value)
+
+    def migrate_from_yaml(self, admins_path: str = 'admins.yml', groups_path: str = 'groups.yml',
+                          usage_path: str = 'usage.yml') -> bool:
+        """One-time import of the YAML files written by older versions. Returns True if it ran."""
+        if not self._migrate_once('yaml_migrated'):
+            return False
+
+        def read(path):
+            try:
+                with open(path, 'r') as f:
+                    return yaml.safe_load(f) or {}
+            except FileNotFoundError:
+                return {}
+
+        admins, groups, usage_data = read(admins_path), read(groups_path), read(usage_path)
+        self._import(admins, groups, usage_data)
+        if admins or groups or usage_data:
+            logger.info("Migrated %d admins, %d groups and %d usage entries from YAML",
+                        len(admins), len(groups), len(usage_data))
+        return True
+
+    def migrate_from_tables(self, path: Optional[str] = None) -> bool:
+        """One-time import of the admins / groups / usage tables of older bot.db files."""
+        path = path or self.path
+        if not os.path.exists(path):
+            return False
+        conn = sqlite3.connect(path, timeout=30)
+        try:
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if not {'admins', 'groups', 'usage'} <= tables or not self._migrate_once('tables_migrated'):
+                return False
+            admins = {row[0]: True for row in conn.execute('SELECT user_id FROM admins')}
+            groups = {group_id: {'messages_today': messages_today, 'last_reset': last_reset}
+                      for group_id, messages_today, last_reset in conn.execute(
+                          'SELECT group_id, messages_today, last_reset FROM groups')}
+            usage_data = {key: json.loads(value) for key, value in conn.execute('SELECT key, value FROM usage')}
+            meta = dict(conn.execute('SELECT key, value FROM meta')) if 'meta' in tables else {}
+        finally:
+            conn.close()
+        self._import(admins, groups, usage_data)
+        for key, value in meta.items():
+            self.backend.compare_and_set(f'{META}{key}', None, value)
+        logger.info("Migrated %d admins, %d groups and %d usage entries from %s tables",
+                    len(admins), len(groups), len(usage_data), path)
+        return True
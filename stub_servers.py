@@ -0,0 +1,440 @@
+"""Local stand-ins for the Anthropic messages API, the Telegram Bot API and Redis.
+
+They run on 127.0.0.1 in a background thread. Point the clients at them with
+ANTHROPIC_BASE_URL / base_url / STATE_BACKEND=redis://... and no request leaves the machine.
+"""
+import hashlib
+import json
+import random
+import socketserver
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from fnmatch import fnmatchcase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from retrieval import estimate_tokens
+
+
+class StubServer(ABC):
+    """Background HTTP server that counts requests per path."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        handler = type('Handler', (_Handler,), {'stub': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'StubServer':
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+
+    @abstractmethod
+    def handle(self, handler: '_Handler', method: str) -> None:
+        ...
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    stub: StubServer = None
+
+    def do_GET(self):
+        self.stub.handle(self, 'GET')
+
+    def do_POST(self):
+        self.stub.handle(self, 'POST')
+
+    def log_message(self, format, *args):
+        pass
+
+    def body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send_json(self, status: int, data, headers=None) -> None:
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class StubAnthropic(StubServer):
+    """Messages API with configurable latency, streaming speed and error rate.
+
+    Also serves generated Vyper sources at /sources/<name>.vy (with an ETag) for /preaudit.
+    """
+
+    def __init__(self, latency: float = 0.2, token_delay: float = 0.0, answer_tokens: int = 200,
+                 error_rate: float = 0.0, match_score: int = 90, source_functions: int = 40, seed: int = 0):
+        super().__init__()
+        self.latency = latency
+        self.token_delay = token_delay
+        self.answer_tokens = answer_tokens
+        self.error_rate = error_rate
+        self.match_score = match_score
+        self.source_functions = source_functions
+        self.random = random.Random(seed)
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def answer(self) -> str:
+        words = ' '.join(['word'] * max(self.answer_tokens - 8, 1))
+        return f"{words}\n\nKnowledge base match score: {self.match_score}%"
+
+    def source(self) -> str:
+        return '\n\n'.join(
+            f'@external\ndef f{i}(amount: uint256) -> uint256:\n    """\n    @notice Function {i}\n    """\n'
+            + '\n'.join(f'    amount += {j}' for j in range(20)) + '\n    return amount'
+            for i in range(self.source_functions))
+
+    def handle(self, handler: _Handler, method: str) -> None:
+        path = urlparse(handler.path).path
+        if method == 'GET' and path.startswith('/sources/'):
+            self.count('source')
+            body = self.source().encode()
+            etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+            if handler.headers.get('If-None-Match') == etag:
+                handler.send_response(304)
+                handler.send_header('ETag', etag)
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return
+            handler.send_response(200)
+            handler.send_header('ETag', etag)
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+            return
+
+        request = json.loads(handler.body() or b'{}')
+        if path.endswith('/count_tokens'):
+            self.count('count_tokens')
+            handler.send_json(200, {'input_tokens': self._input_tokens(request)})
+            return
+        if path != '/v1/messages':
+            handler.send_json(404, {'type': 'error', 'error': {'type': 'not_found_error', 'message': path}})
+            return
+
+        self.count('messages')
+        time.sleep(self.latency)
+        with self._lock:
+            fail = self.random.random() < self.error_rate
+        if fail:
+            self.count('errors')
+            handler.send_json(529, {'type': 'error', 'error': {'type': 'overloaded_error', 'message': 'Overloaded'}})
+            return
+
+        input_tokens = self._input_tokens(request)
+        text = self.answer()
+        output_tokens = estimate_tokens(text)
+        with self._lock:
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+        message = {
+            'id': f'msg_{self.calls["messages"]}', 'type': 'message', 'role': 'assistant',
+            'model': request.get('model', 'stub'), 'stop_reason': 'end_turn', 'stop_sequence': None,
+            'usage': {'input_tokens': input_tokens, 'output_tokens': output_tokens,
+                      'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0},
+        }
+        if not request.get('stream'):
+            handler.send_json(200, {**message, 'content': [{'type': 'text', 'text': text}]})
+            return
+        self._stream(handler, message, text)
+
+    def _stream(self, handler: _Handler, message, text: str) -> None:
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        handler.close_connection = True
+
+        def event(name, data):
+            handler.wfile.write(f'event: {name}\ndata: {json.dumps(data)}\n\n'.encode())
+            handler.wfile.flush()
+
+        start = {**message, 'content': [], 'stop_reason': None,
+                 'usage': {**message['usage'], 'output_tokens': 1}}
+        event('message_start', {'type': 'message_start', 'message': start})
+        event('content_block_start', {'type': 'content_block_start', 'index': 0,
+                                      'content_block': {'type': 'text', 'text': ''}})
+        # One delta per ~10 words, token_delay apart
+        words = text.split(' ')
+        for i in range(0, len(words), 10):
+            piece = ' '.join(words[i:i + 10]) + (' ' if i + 10 < len(words) else '')
+            event('content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                          'delta': {'type': 'text_delta', 'text': piece}})
+            if self.token_delay:
+                time.sleep(self.token_delay)
+        event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+        event('message_delta', {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                'usage': {'output_tokens': message['usage']['output_tokens']}})
+        event('message_stop', {'type': 'message_stop'})
+
+    @staticmethod
+    def _input_tokens(request) -> int:
+        return estimate_tokens(json.dumps(request.get('system', '')) + json.dumps(request.get('messages', [])))
+
+
+class StubTelegram(StubServer):
+    """Bot API answering getMe, sendMessage and editMessageText, optionally with a fixed latency."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self._message_id = 0
+
+    def handle(self, handler: _Handler, method: str) -> None:
+        api_method = urlparse(handler.path).path.rsplit('/', 1)[-1]
+        body = handler.body()
+        if handler.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(body or b'{}')
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        self.count(api_method)
+        if self.latency:
+            time.sleep(self.latency)
+
+        if api_method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'stub', 'username': 'stub_bot',
+                      'can_join_groups': True, 'can_read_all_group_messages': False,
+                      'supports_inline_queries': False}
+        elif api_method in ('sendMessage', 'editMessageText'):
+            with self._lock:
+                if api_method == 'sendMessage':
+                    self._message_id += 1
+                message_id = int(params.get('message_id') or self._message_id)
+            result = {'message_id': message_id, 'date': int(time.time()),
+                      'chat': {'id': int(params.get('chat_id', 0)), 'type': 'group', 'title': 'bench'},
+                      'text': params.get('text', '')}
+        else:
+            result = True
+        handler.send_json(200, {'ok': True, 'result': result})
+
+
+class StubRedis:
+    """In-memory server for the subset of the Redis protocol that state.RedisBackend uses.
+
+    Supports GET/MGET/SET (PX)/DEL/INCRBY/PEXPIRE, WATCH/MULTI/EXEC, SCAN and PUBLISH/SUBSCRIBE.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.lock = threading.RLock()
+        self.data = {}  # key -> (value, expires at or None)
+        self.versions = Counter()  # bumped on every write, for WATCH
+        self.subscribers = {}  # channel -> set of handlers
+        handler = type('Handler', (_RedisHandler,), {'stub': self})
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), handler, bind_and_activate=False)
+        self.server.allow_reuse_address = True
+        self.server.daemon_threads = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'redis://{host}:{port}/0'
+
+    def start(self) -> 'StubRedis':
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def live(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.monotonic():
+            del self.data[key]
+            self.versions[key] += 1
+            return None
+        return value
+
+    def write(self, key, value, expires=None):
+        if value is None:
+            self.data.pop(key, None)
+        else:
+            self.data[key] = (value, expires)
+        self.versions[key] += 1
+
+    def execute(self, handler, command, args):
+        """Run one command (under self.lock) and return its reply."""
+        self.calls[command] += 1
+        if command == 'PING':
+            return 'PONG'
+        if command in ('AUTH', 'SELECT'):
+            return 'OK'
+        if command == 'GET':
+            return self.live(args[0])
+        if command == 'MGET':
+            return [self.live(key) for key in args]
+        if command == 'SET':
+            expires = None
+            if len(args) > 2 and args[2].upper() == 'PX':
+                expires = time.monotonic() + int(args[3]) / 1000
+            self.write(args[0], args[1], expires)
+            return 'OK'
+        if command == 'DEL':
+            existing = [key for key in args if self.live(key) is not None]
+            for key in args:
+                self.write(key, None)
+            return len(existing)
+        if command == 'INCRBY':
+            value = int(self.live(args[0]) or 0) + int(args[1])
+            self.write(args[0], str(value), self.data.get(args[0], (None, None))[1])
+            return value
+        if command == 'PEXPIRE':
+            value = self.live(args[0])
+            if value is None:
+                return 0
+            self.write(args[0], value, time.monotonic() + int(args[1]) / 1000)
+            return 1
+        if command == 'SCAN':
+            pattern = args[args.index('MATCH') + 1] if 'MATCH' in args else '*'
+            return ['0', [key for key in list(self.data) if fnmatchcase(key, pattern) and self.live(key) is not None]]
+        if command == 'PUBLISH':
+            receivers = list(self.subscribers.get(args[0], ()))
+            for receiver in receivers:
+                receiver.push(['message', args[0], args[1]])
+            return len(receivers)
+        return RedisReplyError(f'ERR unknown command {command}')
+
+
+class RedisReplyError(str):
+    pass
+
+
+class _RedisHandler(socketserver.StreamRequestHandler):
+    stub: StubRedis = None
+
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+        self.watched = {}
+        self.queued = None
+        self.channels = set()
+
+    def handle(self):
+        while True:
+            command = self.read_command()
+            if command is None:
+                break
+            name, args = command[0].upper(), command[1:]
+            self.push(self.dispatch(name, args))
+
+    def finish(self):
+        with self.stub.lock:
+            for channel in self.channels:
+                self.stub.subscribers.get(channel, set()).discard(self)
+        super().finish()
+
+    def dispatch(self, name, args):
+        stub = self.stub
+        if name == 'SUBSCRIBE':
+            with stub.lock:
+                for channel in args:
+                    self.channels.add(channel)
+                    stub.subscribers.setdefault(channel, set()).add(self)
+            for i, channel in enumerate(args[:-1]):
+                self.push(['subscribe', channel, i + 1])
+            return ['subscribe', args[-1], len(args)]
+        if name == 'WATCH':
+            with stub.lock:
+                self.watched.update((key, stub.versions[key]) for key in args)
+            return 'OK'
+        if name == 'UNWATCH':
+            self.watched = {}
+            return 'OK'
+        if name == 'MULTI':
+            self.queued = []
+            return 'OK'
+        if name == 'DISCARD':
+            self.queued, self.watched = None, {}
+            return 'OK'
+        if name == 'EXEC':
+            queued, watched = self.queued or [], self.watched
+            self.queued, self.watched = None, {}
+            with stub.lock:
+                stub.calls['EXEC'] += 1
+                for key in watched:
+                    stub.live(key)  # an expiry counts as a change
+                if any(stub.versions[key] != version for key, version in watched.items()):
+                    stub.calls['conflicts'] += 1
+                    return None
+                return [stub.execute(self, command, command_args) for command, command_args in queued]
+        if self.queued is not None:
+            self.queued.append((name, args))
+            return 'QUEUED'
+        with stub.lock:
+            return stub.execute(self, name, args)
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2].decode())
+        return args
+
+    def push(self, reply):
+        with self.write_lock:
+            try:
+                self.wfile.write(encode_reply(reply))
+            except OSError:
+                pass
+
+
+def encode_reply(reply) -> bytes:
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, RedisReplyError):
+        return b'-%s\r\n' % reply.encode()
+    if isinstance(reply, bool) or isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, list):
+        return b'*%d\r\n' % len(reply) + b''.join(encode_reply(item) for item in reply)
+    if reply in ('OK', 'QUEUED', 'PONG'):
+        return b'+%s\r\n' % reply.encode()
+    data = str(reply).encode()
+    return b'$%d\r\n%s\r\n' % (len(data), data)
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+from answer_cache import AnswerCache, file_hash, normalize
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestAnswerCache(unittest.TestCase):
+    def setUp(self):
+        self.version = 'v1'
+        self.clock = FakeClock()
+        self.cache = AnswerCache(lambda: self.version, max_entries=3, ttl=100, clock=self.clock)
+
+    def test_exact_hit_after_normalization(self):
+        self.cache.put("How do I deploy a contract with ape?", "Use ape run.")
+        self.assertEqual(normalize("  how do I DEPLOY a contract with ape "), normalize("How do I deploy a contract with ape?"))
+        self.assertEqual(self.cache.get("how do i deploy a contract with APE"), "Use ape run.")
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_near_duplicate_hit(self):
+        self.cache.put("How do I deploy a contract with ape?", "Use ape run.")
+        self.assertEqual(self.cache.get("how to deploy contracts with ape"), "Use ape run.")
+        self.assertEqual(self.cache.near_hits, 1)
+        self.assertIsNone(self.cache.get("how do I test a contract with ape"))
+
+    def test_near_duplicate_lookup_follows_eviction(self):
+        self.cache.put("deploy contracts with ape", "old")
+        self.cache.put("how to deploy a contract with ape", "new")
+        self.assertEqual(self.cache.get("with ape, how to deploy contracts"), "new")
+        for question in ("first", "second", "third"):
+            self.cache.put(question, question)
+        self.assertIsNone(self.cache.get("with ape, how to deploy contracts"))
+        self.assertEqual(set(self.cache._by_terms), {frozenset([word]) for word in ("first", "second", "third")})
+
+    def test_questions_differing_in_one_term_miss(self):
+        self.cache.put("How do I deploy to mainnet with ape?", "Use --network ethereum:mainnet.")
+        self.cache.put("How do I install ape?", "pip install eth-ape")
+        for question in ("How do I deploy to sepolia with ape?",
+                         "How do I deploy to mainnet with ape without using a hardware wallet?",
+                         "How do I not deploy to mainnet with ape?",
+                         "Why should I install ape?", "Where do I install ape?", "When should I install ape?"):
+            self.assertIsNone(self.cache.get(question), question)
+        self.assertEqual(self.cache.near_hits, 0)
+
+    def test_ttl_and_lru_eviction(self):
+        self.cache.put("first question", "1")
+        self.clock.now = 50
+        self.cache.put("second question", "2")
+        self.cache.put("third question", "3")
+        self.cache.get("first question")  # most recently used now
+        self.cache.put("fourth question", "4")
+        self.assertIsNone(self.cache.get("second question"))
+        self.assertEqual(self.cache.get("first question"), "1")
+        self.clock.now = 120
+        self.assertIsNone(self.cache.get("first question"))
+        self.assertEqual(self.cache.get("third question"), "3")
+
+    def test_invalidated_when_knowledge_base_changes(self):
+        self.cache.put("what is ape", "A framework.")
+        self.version = 'v2'
+        self.assertIsNone(self.cache.get("what is ape"))
+        self.assertEqual(len(self.cache), 0)
+        # An answer written for the old version is not cached under the new one
+        self.cache.put("what is ape", "A framework.", version='v1')
+        self.assertEqual(len(self.cache), 0)
+
+
+class TestFileHash(unittest.TestCase):
+    def test_changes_with_content(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'knowledge-base.txt')
+            with open(path, 'w') as f:
+                f.write('one')
+            first = file_hash(path)
+            self.assertEqual(file_hash(path), first)
+            with open(path, 'w') as f:
+                f.write('two!')
+            self.assertNotEqual(file_hash(path), first)
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
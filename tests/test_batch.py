@@ -0,0 +1,189 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+import batch
+
+
+def usage(input_tokens=100, output_tokens=20):
+    return SimpleNamespace(input_tokens=input_tokens, output_tokens=output_tokens,
+                           cache_creation_input_tokens=0, cache_read_input_tokens=0)
+
+
+def message(text, model='claude-3-5-haiku-20241022'):
+    return SimpleNamespace(content=[SimpleNamespace(text=text)], usage=usage(), model=model)
+
+
+def build(question):
+    return {'model': 'claude-3-5-haiku-20241022', 'max_tokens': 10, 'system': [],
+            'messages': [{'role': 'user', 'content': question}]}, None
+
+
+class FakeMessages:
+    def __init__(self, fail_on=()):
+        self.fail_on = fail_on
+        self.calls = []
+        self.running = 0
+        self.peak = 0
+
+    async def create(self, **request):
+        question = request['messages'][-1]['content']
+        self.calls.append(question)
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        if question in self.fail_on:
+            raise ValueError('bad question')
+        return message(f'answer to {question}')
+
+
+class FakeBatches:
+    def __init__(self):
+        self.submitted = []
+        self.polls = 0
+
+    def create(self, requests):
+        self.submitted.append(requests)
+        return SimpleNamespace(id=f'batch{len(self.submitted)}')
+
+    def retrieve(self, batch_id):
+        self.polls += 1
+        status = 'ended' if self.polls > 1 else 'in_progress'
+        return SimpleNamespace(processing_status=status, request_counts=SimpleNamespace(
+            processing=1, succeeded=0, errored=0))
+
+    def results(self, batch_id):
+        requests = self.submitted[int(batch_id[len('batch'):]) - 1]
+        for request in requests:
+            question = request['params']['messages'][-1]['content']
+            if question == 'expired':
+                yield SimpleNamespace(custom_id=request['custom_id'], result=SimpleNamespace(type='expired'))
+            else:
+                yield SimpleNamespace(custom_id=request['custom_id'], result=SimpleNamespace(
+                    type='succeeded', message=message(f'answer to {question}')))
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.tmp.name, 'questions.jsonl')
+        self.output = os.path.join(self.tmp.name, 'answers.jsonl')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_input(self, rows):
+        with open(self.input, 'w') as f:
+            for row in rows:
+                # Strings are written as they are, to include lines that are not JSON objects
+                f.write((row if isinstance(row, str) else json.dumps(row)) + '\n')
+
+    def rows(self):
+        with open(self.output) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def test_read_questions(self):
+        self.write_input([{'request_id': 'r1', 'title': 'T', 'body': 'from body'},
+                          {'id': 7, 'question': 'with id'}, '"plain"', 'not json', {'other': 'x'}])
+        questions = list(batch.read_questions(self.input))
+        self.assertEqual([(q.id, q.text) for q in questions], [('r1', 'from body'), ('7', 'with id'), ('3', 'plain')])
+        self.assertEqual([q.text for q in batch.read_questions(self.input, question_field='title')], ['T', 'plain'])
+
+    def test_concurrent_run_resumes_after_failures_and_truncation(self):
+        self.write_input([{'id': str(i), 'question': f'q{i}'} for i in range(6)] + [{'id': '0', 'question': 'q0'}])
+        client = SimpleNamespace(messages=FakeMessages(fail_on={'q3'}))
+        writer = batch.ResultWriter(self.output)
+        asyncio.run(batch.run_concurrent(client, batch.pending_questions(batch.read_questions(self.input), set()),
+                                         build, writer, concurrency=2, warm_first=True))
+        writer.close()
+        self.assertEqual(client.messages.peak, 2)
+        self.assertEqual(writer.errors, 1)
+        rows = {row['id']: row for row in self.rows()}
+        self.assertEqual(rows['1']['answer'], 'answer to q1')
+        self.assertEqual((rows['1']['input_tokens'], rows['1']['output_tokens']), (100, 20))
+        self.assertGreater(rows['1']['cost'], 0)
+        self.assertIn('ValueError', rows['3']['error'])
+        self.assertEqual(len(client.messages.calls), 6)
+
+        # An interrupted write leaves half a row behind
+        with open(self.output, 'a') as f:
+            f.write('{"id": "5", "answ')
+        done = batch.answered_ids(self.output)
+        self.assertEqual(done, {'0', '1', '2', '4', '5'})
+        client = SimpleNamespace(messages=FakeMessages())
+        writer = batch.ResultWriter(self.output)
+        asyncio.run(batch.run_concurrent(client, batch.pending_questions(batch.read_questions(self.input), done),
+                                         build, writer))
+        writer.close()
+        self.assertEqual(client.messages.calls, ['q3'])
+        self.assertEqual(batch.answered_ids(self.output), {str(i) for i in range(6)})
+
+    def test_provider_batches_are_collected_once(self):
+        self.write_input([{'id': 'a', 'question': 'one'}, {'id': 'b', 'question': 'expired'},
+                          {'id': 'c', 'question': 'three'}])
+        batches = FakeBatches()
+        client = SimpleNamespace(messages=SimpleNamespace(batches=batches))
+        state = self.output + '.batch'
+        writer = batch.ResultWriter(self.output)
+        batch.run_provider_batches(client, batch.read_questions(self.input), build, writer, state,
+                                   batch_size=2, sleep=lambda seconds: None)
+        writer.close()
+        self.assertEqual([len(requests) for requests in batches.submitted], [2, 1])
+        self.assertEqual(batches.submitted[0][1]['custom_id'], 'line-2')
+        rows = {row['id']: row for row in self.rows()}
+        self.assertEqual(rows['a']['answer'], 'answer to one')
+        self.assertEqual(rows['b']['error'], 'expired')
+        self.assertEqual(rows['c']['answer'], 'answer to three')
+        self.assertFalse(os.path.exists(state))
+
+    def test_provider_batch_rerun_does_not_resubmit(self):
+        self.write_input([{'id': 'a', 'question': 'one'}])
+        batches = FakeBatches()
+        batches.create([{'custom_id': 'line-1', 'params': build('one')[0]}])
+        state = self.output + '.batch'
+        batch.save_state(state, {'batches': [{'batch_id': 'batch1', 'questions': {'line-1': ['a', 'one']}}]})
+        client = SimpleNamespace(messages=SimpleNamespace(batches=batches))
+        writer = batch.ResultWriter(self.output)
+        batch.run_provider_batches(client, batch.read_questions(self.input), build, writer, state,
+                                   sleep=lambda seconds: None)
+        writer.close()
+        self.assertEqual(len(batches.submitted), 1)
+        self.assertEqual(self.rows()[0]['answer'], 'answer to one')
+
+    def test_provider_batches_are_saved_as_they_are_submitted(self):
+        self.write_input([{'id': 'a', 'question': 'one'}, {'id': 'b', 'question': 'two'},
+                          {'id': 'c', 'question': 'three'}])
+        batches = FakeBatches()
+        create = batches.create
+
+        def create_once(requests):
+            if batches.submitted:
+                raise ConnectionError('crashed')
+            return create(requests)
+
+        state = self.output + '.batch'
+        client = SimpleNamespace(messages=SimpleNamespace(batches=SimpleNamespace(create=create_once)))
+        writer = batch.ResultWriter(self.output)
+        with self.assertRaises(ConnectionError):
+            batch.run_provider_batches(client, batch.read_questions(self.input), build, writer, state,
+                                       batch_size=2, sleep=lambda seconds: None)
+        writer.close()
+        self.assertEqual([entry['batch_id'] for entry in batch.load_state(state)['batches']], ['batch1'])
+
+        client = SimpleNamespace(messages=SimpleNamespace(batches=batches))
+        writer = batch.ResultWriter(self.output)
+        batch.run_provider_batches(client, batch.read_questions(self.input), build, writer, state,
+                                   batch_size=2, sleep=lambda seconds: None)
+        writer.close()
+        self.assertEqual([[request['custom_id'] for request in requests] for requests in batches.submitted],
+                         [['line-1', 'line-2'], ['line-3']])
+        self.assertEqual({row['id']: row['answer'] for row in self.rows()},
+                         {'a': 'answer to one', 'b': 'answer to two', 'c': 'answer to three'})
+        self.assertFalse(os.path.exists(state))
+
+
+if __name__ == '__main__':
+    unittest.main()
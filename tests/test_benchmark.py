@@ -0,0 +1,61 @@
+import json
+import unittest
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from benchmark import percentile, questions
+from stub_servers import StubAnthropic, StubTelegram
+
+
+def post(url, data):
+    request = Request(url, json.dumps(data).encode(), {'Content-Type': 'application/json'})
+    with urlopen(request, timeout=5) as response:
+        return json.loads(response.read())
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual(percentile(values, 50), 51.0)
+        self.assertEqual(percentile(values, 99), 99.0)
+        self.assertEqual(percentile([], 95), 0.0)
+
+    def test_questions_repeat(self):
+        self.assertEqual(len(set(questions(50, 0.0, seed=1))), 50)
+        self.assertLessEqual(len(set(questions(50, 1.0, seed=1))), 5)
+        self.assertEqual(questions(10, 0.5, seed=2), questions(10, 0.5, seed=2))
+
+    def test_stub_anthropic(self):
+        with StubAnthropic(latency=0, answer_tokens=20, match_score=75) as stub:
+            message = post(f'{stub.url}/v1/messages',
+                           {'model': 'stub', 'messages': [{'role': 'user', 'content': 'hello'}]})
+            self.assertIn('match score: 75%', message['content'][0]['text'])
+            self.assertGreater(message['usage']['input_tokens'], 0)
+            with urlopen(f'{stub.url}/sources/a.vy', timeout=5) as response:
+                etag = response.headers['ETag']
+                self.assertIn('@external', response.read().decode())
+            with self.assertRaises(HTTPError) as raised:
+                urlopen(Request(f'{stub.url}/sources/a.vy', headers={'If-None-Match': etag}), timeout=5)
+            self.assertEqual(raised.exception.code, 304)
+        self.assertEqual(stub.calls['messages'], 1)
+        self.assertEqual(stub.calls['source'], 2)
+
+    def test_stub_anthropic_errors(self):
+        with StubAnthropic(latency=0, error_rate=1.0) as stub:
+            with self.assertRaises(HTTPError) as raised:
+                post(f'{stub.url}/v1/messages', {'messages': []})
+            self.assertEqual(raised.exception.code, 529)
+        self.assertEqual(stub.calls['errors'], 1)
+
+    def test_stub_telegram(self):
+        with StubTelegram() as stub:
+            sent = post(f'{stub.url}/bot123:x/sendMessage', {'chat_id': -5, 'text': 'hi'})
+            edited = post(f'{stub.url}/bot123:x/editMessageText',
+                          {'chat_id': -5, 'message_id': sent['result']['message_id'], 'text': 'hello'})
+        self.assertEqual(edited['result']['message_id'], sent['result']['message_id'])
+        self.assertEqual(edited['result']['text'], 'hello')
+        self.assertEqual(dict(stub.calls), {'sendMessage': 1, 'editMessageText': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
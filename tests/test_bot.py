@@ -0,0 +1,111 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import storage
+
+# Other tests may have imported storage already, so point it at a temp database directly
+os.environ.setdefault('CLAUDE_KEY', 'test')
+storage.DB_PATH = os.path.join(tempfile.mkdtemp(), 'test.db')
+
+import bot
+
+
+def update_for(group_id):
+    return SimpleNamespace(message=SimpleNamespace(chat_id=int(group_id), from_user=SimpleNamespace(id=7)))
+
+
+class BotTestCase(unittest.IsolatedAsyncioTestCase):
+    def patch(self, target, value):
+        patcher = mock.patch.object(bot, target, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestSharedAnswers(BotTestCase):
+    def setUp(self):
+        self.rate_limiter = mock.MagicMock()
+        self.answer_cache = mock.MagicMock()
+        self.answer_cache.get.return_value = None
+        self.increment = mock.MagicMock(return_value=1)
+        for target, value in (('rate_limiter', self.rate_limiter), ('answer_cache', self.answer_cache),
+                              ('send_markdown', mock.AsyncMock(return_value=[])),
+                              ('storage', SimpleNamespace(increment_messages=self.increment)), ('groups', {})):
+            self.patch(target, value)
+
+    async def test_every_group_sharing_a_call_is_charged(self):
+        release = asyncio.Event()
+        calls = []
+
+        async def ask_claude(update, group_id, *args):
+            calls.append(group_id)
+            await release.wait()
+            return 'answer', 100
+
+        with mock.patch.object(bot, 'ask_claude', ask_claude):
+            tasks = [asyncio.create_task(bot.answer_message(update_for(group_id), group_id, {'model': 'm'}, False,
+                                                            cache_question='how do I deploy?', kb_version='v1'))
+                     for group_id in ('1', '2')]
+            await asyncio.sleep(0)
+            release.set()
+            await asyncio.gather(*tasks)
+
+        self.assertEqual(calls, ['1'])
+        # Each group pays its message and the answer's tokens, as if it had asked alone
+        self.assertEqual(sorted(self.rate_limiter.charge_tokens.call_args_list),
+                         [mock.call('1', 100), mock.call('2', 100)])
+        self.assertEqual(sorted(call.args[0] for call in self.increment.call_args_list), ['1', '2'])
+        self.rate_limiter.refund.assert_not_called()
+        # Only the group that made the call caches the answer
+        self.answer_cache.put.assert_called_once()
+
+
+class TestPreaudit(BotTestCase):
+    def setUp(self):
+        self.rate_limiter = mock.MagicMock()
+        self.increment = mock.MagicMock(return_value=1)
+        self.reply = mock.AsyncMock()
+        self.submitted = []
+        for target, value in (('rate_limiter', self.rate_limiter), ('reply', self.reply), ('admins', {}),
+                              ('storage', SimpleNamespace(increment_messages=self.increment)),
+                              ('groups', {'1': {}}), ('preaudit_reports', mock.MagicMock(get=lambda digest: None)),
+                              ('fetch_source', lambda url: SimpleNamespace(digest=url))):
+            self.patch(target, value)
+        self.patch('request_queue', SimpleNamespace(submit=lambda group_id, job: self.submitted.append(job) or True))
+
+    async def run_preaudit(self, group_id='1'):
+        await bot.preaudit(update_for(group_id), SimpleNamespace(args=['https://example.com/a.vy']))
+        for job in self.submitted:
+            await job()
+
+    async def test_only_whitelisted_groups(self):
+        await self.run_preaudit('2')
+        self.assertEqual(self.submitted, [])
+        self.reply.assert_not_called()
+
+    async def test_rate_limited(self):
+        self.rate_limiter.acquire.return_value = SimpleNamespace(allowed=False, scope='group')
+        self.rate_limiter.describe.return_value = 'Slow down.'
+        await self.run_preaudit()
+        self.assertEqual(self.submitted, [])
+        self.reply.assert_called_once_with(mock.ANY, 'Slow down.')
+
+    async def test_charged_when_answered_and_refunded_on_failure(self):
+        with mock.patch.object(bot, 'audit_source', mock.AsyncMock(return_value=('report', 500))):
+            await self.run_preaudit()
+        self.rate_limiter.charge_tokens.assert_called_once_with('1', 500)
+        self.increment.assert_called_once_with('1')
+        self.rate_limiter.refund.assert_not_called()
+
+        self.submitted.clear()
+        with mock.patch.object(bot, 'audit_source', mock.AsyncMock(side_effect=RuntimeError('boom'))):
+            await self.run_preaudit()
+        self.rate_limiter.refund.assert_called_once_with('1', '7')
+        self.assertEqual(self.rate_limiter.charge_tokens.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from concat import (concatenate_files, read_document_from_index, is_excluded_file, is_text_file,
+                    is_known_binary, load_json, looks_like_text, strip_markdown, strip_rst,
+                    compaction_report_path, SNIFF_BYTES)
+
+
+class TestConcatenateFiles(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.temp_dir, 'knowledge-base')
+        self.output = os.path.join(self.temp_dir, 'knowledge-base.txt')
+        os.makedirs(os.path.join(self.src, 'guides'))
+        os.makedirs(os.path.join(self.src, 'node_modules'))
+        self.write('a.md', '# A\n\nFirst document\r\n')
+        self.write('guides/b.md', 'Second document')
+        self.write('empty.md', '   ')
+        self.write('node_modules/skip.md', 'excluded')
+        with open(os.path.join(self.src, 'logo.png'), 'wb') as f:
+            f.write(b'\x89PNG')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, rel_path, content):
+        with open(os.path.join(self.src, rel_path), 'w', encoding='utf-8', newline='') as f:
+            f.write(content)
+
+    def build(self, **kwargs):
+        with redirect_stdout(io.StringIO()):
+            return concatenate_files(self.src, self.output, **kwargs)
+
+    def read_output(self):
+        with open(self.output, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def test_output_and_offset_index(self):
+        self.assertEqual(self.build(), {'processed': 3, 'reused': 0, 'skipped': 1})
+        output = self.read_output()
+        self.assertIn('#### a.md\n\n# A\n\nFirst document\n\n', output)
+        self.assertIn(f'#### {os.path.join("guides", "b.md")}\n\nSecond document\n\n', output)
+        self.assertNotIn('excluded', output)
+        self.assertNotIn('empty.md', output)
+        self.assertEqual(read_document_from_index(self.output, 'a.md'), '# A\n\nFirst document')
+
+    def test_incremental_build_matches_full_build(self):
+        self.build()
+        self.write('guides/b.md', 'Second document, edited')
+        os.utime(os.path.join(self.src, 'guides', 'b.md'), ns=(1, 1))
+        self.assertEqual(self.build(), {'processed': 1, 'reused': 2, 'skipped': 1})
+        incremental = self.read_output()
+        self.assertIn('Second document, edited', incremental)
+        self.assertEqual(self.build(incremental=False)['processed'], 3)
+        self.assertEqual(self.read_output(), incremental)
+        self.assertEqual(read_document_from_index(self.output, os.path.join('guides', 'b.md')),
+                         'Second document, edited')
+
+    def test_only_text_extensions_are_built(self):
+        self.write('lib.rs', 'fn main() {}')
+        self.write('LICENSE', 'MIT License')
+        self.write('Makefile', 'all:\n\ttrue')
+        self.assertEqual(self.build(), {'processed': 3, 'reused': 0, 'skipped': 4})
+        output = self.read_output()
+        for name in ('lib.rs', 'LICENSE', 'Makefile'):
+            self.assertNotIn(f'#### {name}', output)
+
+    def test_compact_build(self):
+        paragraph = ('Every contract is compiled to bytecode before it is deployed to the chain, and the compiler '
+                     'checks types, overflow and reentrancy rules while it runs over the whole source tree.')
+        self.write('a.md', f'# A\n\n{paragraph}\n\n<!-- draft -->\n[![ci](https://ci/badge.svg)](https://ci)\n')
+        # The same paragraph wrapped differently is still a repeat
+        rewrapped = paragraph.replace(', and', ',\nand')
+        self.write('guides/b.md', f'{rewrapped}\n\n{paragraph.replace("Every", "Each")}\n\nSecond document')
+        self.write('changelog.md', 'v1: everything')
+        result = self.build(compact=True)
+        self.assertEqual(result['processed'], 4)
+        output = self.read_output()
+        self.assertEqual(output.count('compiled to bytecode'), 2)
+        self.assertNotIn('badge', output)
+        self.assertNotIn('draft', output)
+        self.assertIn('v1: everything', output)
+        self.assertEqual(read_document_from_index(self.output, os.path.join('guides', 'b.md')),
+                         f'{paragraph.replace("Every", "Each")}\n\nSecond document')
+
+        report = load_json(compaction_report_path(self.output))
+        self.assertEqual(report['files'][os.path.join('guides', 'b.md')]['duplicates'], 1)
+        self.assertLess(result['bytes'][1], result['bytes'][0])
+        self.assertEqual(report['totals']['tokens'], result['tokens'])
+
+        # Dropping files by name is opt-in
+        self.build(compact=True, drop_patterns=('changelog*',))
+        self.assertNotIn('changelog.md', self.read_output())
+        report = load_json(compaction_report_path(self.output))
+        self.assertEqual(report['files']['changelog.md']['dropped'], 'changelog*')
+
+        # A plain build after a compacted one rereads every file
+        self.assertEqual(self.build(), {'processed': 4, 'reused': 0, 'skipped': 1})
+        self.assertEqual(self.read_output().count('compiled to bytecode'), 3)
+
+    def test_compact_keeps_every_unique_paragraph(self):
+        steps = ('Install the plugin with pip before running the tests, then add it to the plugins list in '
+                 'ape-config.yaml so that ape loads it on start and the network choices include the new chain.')
+        table = '| Network | Chain id |\n| --- | --- |\n| mainnet | 1 |\n| sepolia | 11155111 |'
+        documents = {
+            'ethereum.md': ['Run this on mainnet only.', steps, table],
+            'arbitrum.md': ['Run this on mainnet only.', steps.replace('pip', 'pipx'),
+                            table.replace('sepolia | 11155111', 'sepolia | 421614')],
+            'base.md': ['Run this on mainnet only.', steps, table],
+        }
+        for name, blocks in documents.items():
+            self.write(name, '\n\n'.join(blocks))
+        self.build(compact=True)
+        output = self.read_output()
+        for blocks in documents.values():
+            for block in blocks:
+                self.assertIn(block, output)
+        self.assertEqual(output.count(steps), 1)
+        self.assertEqual(output.count('Run this on mainnet only.'), 3)
+
+    def test_strip_markup(self):
+        rst = ('.. _types:\n\nTypes\n=====\n\n.. toctree::\n    :maxdepth: 2\n\n    types\n\n'
+               '.. note::\n\n    See :ref:`the guide <guide>` and `#12 <https://github.com/o/r/pull/12>`_.\n\n'
+               '.. py:function:: len(b)\n\n    Length of ``b``.\n\n.. a comment\n   spanning lines\n\nEnd')
+        self.assertEqual(strip_rst(rst).split(),
+                         ['Types', 'Note:', 'See', '`the', 'guide`', 'and', '#12.', 'len(b)', 'Length', 'of', '`b`.',
+                          'End'])
+        markdown = '<div align="center">\n\n```{toctree}\nintro\n```\n\n```python\n<b>\n```\n---\nText'
+        self.assertEqual(strip_markdown(markdown).split(), ['```python', '<b>', '```', 'Text'])
+
+    def test_filters(self):
+        self.assertTrue(is_excluded_file(os.path.join('repo', '.git', 'config')))
+        self.assertTrue(is_excluded_file('poetry.lock'))
+        self.assertFalse(is_excluded_file(os.path.join('repo', 'src', 'main.py')))
+        self.assertTrue(is_text_file('notes.rst'))
+        self.assertFalse(is_text_file('logo.png'))
+
+    def test_sniffing(self):
+        self.assertTrue(is_known_binary('logo.png'))
+        self.assertFalse(is_known_binary('contract.vy'))
+        self.assertFalse(is_known_binary('LICENSE'))
+        for name in ('lib.rs', 'pom.xml', 'schema.sql', 'app.rb', 'icon.svg', 'data.json'):
+            self.assertFalse(is_known_binary(name), name)
+        for name in ('song.mp3', 'font.woff2', 'dist.zip', 'paper.pdf', 'module.wasm', 'logs.gz'):
+            self.assertTrue(is_known_binary(name), name)
+        self.assertTrue(looks_like_text(b'@external\ndef f():\n    pass\n'))
+        self.assertFalse(looks_like_text(b'ELF\x00\x01'))
+        self.assertFalse(looks_like_text(b'\xff\xfe'))
+        # A full sniff block may cut a multi-byte character in half
+        self.assertTrue(looks_like_text(b'a' * (SNIFF_BYTES - 1) + '\u00e9'.encode('utf-8')[:1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
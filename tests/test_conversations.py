@@ -0,0 +1,96 @@
+import unittest
+from conversations import ConversationStore, Turn, cap_summary, compact_turn, summary_request
+from routing import MODELS
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestConversationStore(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = ConversationStore(max_threads=2, max_turns=2, max_tokens=1000, summary_tokens=100,
+                                       ttl=60, clock=self.clock)
+
+    def test_replies_to_answers_continue_the_thread(self):
+        conversation = self.store.start('g', 1)
+        self.store.record(conversation, 'how do I import an account?', 'Use `ape accounts import`.', [2, 3])
+        self.assertIs(self.store.find('g', 3), conversation)
+        self.assertIs(self.store.find('g', 1), conversation)
+        self.assertIsNone(self.store.find('other', 3))
+        self.assertEqual(conversation.history(), [
+            {'role': 'user', 'content': 'how do I import an account?'},
+            {'role': 'assistant', 'content': 'Use `ape accounts import`.'},
+        ])
+        self.assertEqual(conversation.retrieval_query('and on mainnet?'), 'how do I import an account?\nand on mainnet?')
+
+    def test_older_turns_are_folded_into_a_summary(self):
+        conversation = self.store.start('g', 1)
+        self.assertIsNone(self.store.record(conversation, 'q1', 'a1'))
+        self.assertIsNone(self.store.record(conversation, 'q2', 'a2'))
+        fold = self.store.record(conversation, 'q3', 'a3')
+        self.assertEqual([turn.question for turn in fold.turns], ['q1'])
+        self.assertEqual(fold.previous, '')
+        self.assertEqual([turn.question for turn in conversation.turns], ['q2', 'q3'])
+        self.assertIn('q1', conversation.summary)
+        history = conversation.history()
+        self.assertEqual(len(history), 6)
+        self.assertIn(conversation.summary, history[0]['content'])
+
+    def test_token_cap_folds_long_turns(self):
+        store = ConversationStore(max_turns=10, max_tokens=50, summary_tokens=100, clock=self.clock)
+        conversation = store.start('g', 1)
+        store.record(conversation, 'q1', 'word ' * 100)
+        fold = store.record(conversation, 'q2', 'short')
+        self.assertEqual([turn.question for turn in fold.turns], ['q1'])
+        self.assertLessEqual(conversation.tokens, 100)
+
+    def test_model_summary_only_replaces_the_summary_it_covers(self):
+        conversation = self.store.start('g', 1)
+        for i in range(3):
+            fold = self.store.record(conversation, f'q{i}', f'a{i}')
+        self.assertTrue(self.store.replace_summary(conversation, fold, ' The user asked q0. '))
+        self.assertEqual(conversation.summary, 'The user asked q0.')
+        newer = self.store.record(conversation, 'q3', 'a3')
+        self.assertFalse(self.store.replace_summary(conversation, fold, 'stale'))
+        self.assertEqual(newer.previous, 'The user asked q0.')
+
+    def test_lru_eviction_and_ttl(self):
+        first = self.store.start('g', 1)
+        self.store.record(first, 'q', 'a', [10])
+        self.store.start('g', 2)
+        self.store.find('g', 10)
+        self.store.start('g', 3)
+        self.assertEqual(len(self.store), 2)
+        self.assertIs(self.store.find('g', 10), first)
+        self.assertIsNone(self.store.find('g', 2))
+        self.clock.now = 61
+        self.assertIsNone(self.store.find('g', 10))
+        self.assertEqual(len(self.store), 1)
+
+
+class TestSummaries(unittest.TestCase):
+    def test_compact_turn_and_cap(self):
+        line = compact_turn(Turn('  what\n is ape? ', 'word ' * 500))
+        self.assertTrue(line.startswith('- Q: what is ape?'))
+        self.assertLess(len(line), 1000)
+        summary = cap_summary('\n'.join(f'line {i} ' + 'x ' * 20 for i in range(50)), 50)
+        self.assertIn('line 49', summary)
+        self.assertNotIn('line 0 ', summary)
+
+    def test_summary_request_uses_fast_model(self):
+        store = ConversationStore(max_turns=1)
+        conversation = store.start('g', 1)
+        store.record(conversation, 'q1', 'a1')
+        request = summary_request(store.record(conversation, 'q2', 'a2'))
+        self.assertEqual(request['model'], MODELS['fast'])
+        self.assertIn('q1', request['messages'][-1]['content'])
+
+
+if __name__ == '__main__':
+    unittest.main()
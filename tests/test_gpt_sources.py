@@ -0,0 +1,188 @@
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+import io
+
+
+class TestConcatenateSources(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        # gpt.py creates sources/ and responses/ in the working directory on import
+        os.chdir(self.temp_dir)
+        sys.path.insert(0, os.path.join(self.cwd, 'ape-gpt-cli'))
+        self.gpt = importlib.import_module('gpt')
+        self.gpt.SOURCES_DIR = 'sources'
+        repo = os.path.join('sources', 'repo')
+        for rel_path, data in {
+            'README.md': b'# Repo\n',
+            'contracts/token.vy': b'@external\ndef f():\n    pass\n',
+            'logo.png': b'\x89PNG\r\n\x1a\n\x00',
+            'blob': b'\x00\x01\x02',
+            'poetry.lock': b'lock',
+            '.git/HEAD': b'ref: refs/heads/main\n',
+            'node_modules/dep/index.js': b'module.exports = 1\n',
+        }.items():
+            path = os.path.join(repo, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        sys.path.remove(os.path.join(self.cwd, 'ape-gpt-cli'))
+        shutil.rmtree(self.temp_dir)
+
+    def test_filters_and_reports(self):
+        report = self.gpt.SourceReport()
+        content = self.gpt.concatenate_sources(['repo'], report=report)
+        readme = os.path.join('sources', 'repo', 'README.md')
+        self.assertTrue(content.startswith(f'######## {readme}\n\n# Repo\n'))
+        self.assertIn('@external', content)
+        self.assertNotIn('refs/heads', content)
+        self.assertNotIn('module.exports', content)
+        self.assertEqual([os.path.basename(path) for path, _ in report.included], ['README.md', 'token.vy'])
+        self.assertEqual(sorted((os.path.basename(path), reason) for path, reason in report.dropped),
+                         [('blob', 'binary'), ('logo.png', 'binary')])
+        self.assertEqual(report.tokens, sum(tokens for _, tokens in report.included))
+
+    def test_token_budget(self):
+        report = self.gpt.SourceReport()
+        content = self.gpt.concatenate_sources(['repo'], token_budget=1, report=report)
+        self.assertEqual(len(report.included), 1)
+        self.assertEqual(content.count('########'), 1)
+        self.assertIn('token budget', report.summary())
+
+    def test_missing_directory_exits(self):
+        with redirect_stdout(io.StringIO()), self.assertRaises(SystemExit):
+            self.gpt.concatenate_sources(['missing'])
+
+
+def git(*args, cwd=None):
+    subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args],
+                   cwd=cwd, check=True, capture_output=True)
+
+
+@unittest.skipUnless(shutil.which('git'), 'git is not installed')
+class TestRepoCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        sys.path.insert(0, os.path.join(self.cwd, 'ape-gpt-cli'))
+        self.gpt = importlib.import_module('gpt')
+        self.gpt.SOURCES_DIR = 'sources'
+        # A working repository pushing to a bare one, which is what gets cloned
+        git('init', '--quiet', '--initial-branch', 'main', 'work')
+        git('init', '--quiet', '--bare', '--initial-branch', 'main', 'ape.git')
+        self.url = f"file://{os.path.join(self.temp_dir, 'ape.git')}"
+        self.commit('README.md', '# Ape\n')
+        self.commit('contracts/token.vy', '@external\ndef f():\n    pass\n')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        sys.path.remove(os.path.join(self.cwd, 'ape-gpt-cli'))
+        shutil.rmtree(self.temp_dir)
+
+    def commit(self, rel_path, content):
+        path = os.path.join('work', rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        git('add', rel_path, cwd='work')
+        git('commit', '--quiet', '-m', f'Add {rel_path}', cwd='work')
+        git('push', '--quiet', self.url, 'main', cwd='work')
+
+    def clone(self, branch=None):
+        with redirect_stdout(io.StringIO()):
+            return self.gpt.clone_repository(self.url, branch=branch)
+
+    def rev_parse(self, *args, cwd=os.path.join('sources', 'ape')):
+        return subprocess.run(['git', 'rev-parse', *args], cwd=cwd, capture_output=True, text=True).stdout.strip()
+
+    def test_shallow_clone_and_incremental_update(self):
+        self.assertEqual(self.clone(), 'ape')
+        repo = os.path.join('sources', 'ape')
+        log = subprocess.run(['git', 'log', '--oneline'], cwd=repo, capture_output=True, text=True).stdout
+        self.assertEqual(len(log.splitlines()), 1)
+
+        self.commit('docs/usage.md', 'ape test\n')
+        self.clone()
+        self.assertTrue(os.path.exists(os.path.join(repo, 'docs', 'usage.md')))
+        head = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd='work', capture_output=True, text=True).stdout
+        self.assertEqual(importlib.import_module('repo_cache').head_commit(repo), head.strip())
+
+    def test_pinned_tag_is_not_moved_to_the_default_branch(self):
+        git('tag', 'v1', cwd='work')
+        git('push', '--quiet', self.url, 'v1', cwd='work')
+        tagged = self.rev_parse('HEAD', cwd='work')
+        self.clone(branch='v1')
+        self.commit('docs/usage.md', 'ape test\n')
+        self.clone()
+        self.assertEqual(self.rev_parse('HEAD'), tagged)
+        self.assertFalse(os.path.exists(os.path.join('sources', 'ape', 'docs', 'usage.md')))
+
+        # Switching to a branch checks it out under its own name, and later updates follow it
+        git('checkout', '--quiet', '-b', 'dev', cwd='work')
+        self.commit('docs/dev.md', 'dev\n')
+        git('push', '--quiet', self.url, 'dev', cwd='work')
+        self.clone(branch='dev')
+        self.assertEqual(self.rev_parse('--abbrev-ref', 'HEAD'), 'dev')
+        self.commit('docs/more.md', 'more\n')
+        git('push', '--quiet', self.url, 'dev', cwd='work')
+        self.clone()
+        self.assertEqual(self.rev_parse('HEAD'), self.rev_parse('HEAD', cwd='work'))
+
+        # A commit is checked out detached
+        self.clone(branch=tagged)
+        self.assertEqual(self.rev_parse('HEAD'), tagged)
+        self.assertEqual(self.rev_parse('--abbrev-ref', 'HEAD'), 'HEAD')
+
+    def test_cached_corpus_skips_the_walk(self):
+        self.clone()
+        report = self.gpt.SourceReport()
+        content = self.gpt.concatenate_sources(['ape'], report=report)
+        self.assertIn('@external', content)
+        self.assertFalse(report.cached)
+
+        cached_report = self.gpt.SourceReport()
+        with mock.patch.object(self.gpt, 'iter_source_files', side_effect=AssertionError('walked')):
+            self.assertEqual(self.gpt.concatenate_sources(['ape'], report=cached_report), content)
+        self.assertTrue(cached_report.cached)
+        self.assertEqual((cached_report.included, cached_report.tokens), (report.included, report.tokens))
+
+        # A new commit or other filter settings build a new corpus
+        self.commit('docs/usage.md', 'ape test\n')
+        self.clone()
+        self.assertIn('ape test', self.gpt.concatenate_sources(['ape']))
+        report = self.gpt.SourceReport()
+        self.gpt.concatenate_sources(['ape'], token_budget=1, report=report)
+        self.assertFalse(report.cached)
+        self.assertEqual(len(report.included), 1)
+
+    def test_local_changes_are_not_cached_or_overwritten(self):
+        self.clone()
+        self.gpt.concatenate_sources(['ape'])
+        token = os.path.join('sources', 'ape', 'contracts', 'token.vy')
+        with open(token, 'a', encoding='utf-8') as f:
+            f.write('# edited by hand\n')
+        report = self.gpt.SourceReport()
+        self.assertIn('edited by hand', self.gpt.concatenate_sources(['ape'], report=report))
+        self.assertFalse(report.cached)
+
+        # Updating would discard the edit
+        self.commit('docs/usage.md', 'ape test\n')
+        with self.assertRaises(SystemExit):
+            self.clone()
+        with open(token, 'r', encoding='utf-8') as f:
+            self.assertIn('edited by hand', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import time
+import unittest
+from knowledge import LiveKnowledgeBase
+from prompts import PromptTemplate
+
+FIRST = '#### accounts.md\n\nImport an account with `ape accounts import`.\n'
+SECOND = '#### networks.md\n\nConnect with `--network ethereum:mainnet`.\n'
+
+
+class TestLiveKnowledgeBase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'knowledge-base.txt')
+        self.write(FIRST)
+        self.template = PromptTemplate('system')
+        self.live = LiveKnowledgeBase(self.path, templates=[self.template])
+
+    def tearDown(self):
+        self.live.stop()
+        self.tmp.cleanup()
+
+    def write(self, text, mtime=None):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(self.path, ns=(mtime, mtime))
+
+    def test_swaps_in_a_new_version(self):
+        before = self.live.current()
+        swaps = []
+        self.live.on_swap.append(swaps.append)
+        self.assertFalse(self.live.reload())
+        self.write(SECOND, mtime=time.time_ns() + 10**9)
+        self.assertTrue(self.live.reload())
+        after = self.live.current()
+        self.assertNotEqual(after.version, before.version)
+        self.assertEqual(swaps, [after])
+        self.assertIn('networks.md', after.index.context_for('network'))
+        # The template's prefix was rendered during the swap
+        self.assertIs(self.template._prefix[0], after.knowledge_base)
+        # Snapshots taken earlier are untouched
+        self.assertIn('accounts.md', before.knowledge_base.text)
+        self.assertIn('accounts.md', before.index.context_for('import account'))
+
+    def test_same_content_is_not_a_new_version(self):
+        version = self.live.version
+        self.write(FIRST, mtime=time.time_ns() + 10**9)
+        self.assertFalse(self.live.reload())
+        self.assertEqual(self.live.version, version)
+
+    def test_rebuilds_from_source_directory(self):
+        source = os.path.join(self.tmp.name, 'knowledge-base')
+        os.makedirs(source)
+        with open(os.path.join(source, 'accounts.md'), 'w') as f:
+            f.write('Import an account.')
+        live = LiveKnowledgeBase(self.path, source_dir=source)
+        self.assertFalse(live.rebuild_sources())
+        with open(os.path.join(source, 'networks.md'), 'w') as f:
+            f.write('Connect to mainnet.')
+        self.assertTrue(live.check())
+        self.assertIn('#### networks.md', live.current().knowledge_base.text)
+
+
+if __name__ == '__main__':
+    unittest.main()
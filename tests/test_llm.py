@@ -0,0 +1,64 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+from llm import astream_message, build_request, create_message, CacheStats
+from tokens import MAX_INPUT_TOKENS, TokenBudgetExceeded
+
+
+class TestPromptCaching(unittest.TestCase):
+    def test_static_prefix_is_identical_across_questions(self):
+        first = build_request("system", "knowledge", "first question")
+        second = build_request("system", "knowledge", "second question")
+        self.assertEqual(first['system'], second['system'])
+        self.assertEqual(first['system'][-1]['cache_control'], {"type": "ephemeral"})
+        self.assertEqual(first['messages'][-1], {"role": "user", "content": "first question"})
+
+    def test_uncached_knowledge_goes_before_question(self):
+        request = build_request("system", "excerpts", "question", cache_knowledge_base=False)
+        self.assertEqual(len(request['system']), 1)
+        self.assertNotIn('cache_control', request['system'][0])
+        self.assertEqual(request['messages'][-1]['content'], "excerpts\n\nquestion")
+
+    def test_cache_stats_counts_hits_and_misses(self):
+        stats = CacheStats()
+        self.assertEqual(stats.record(SimpleNamespace(input_tokens=10, output_tokens=5,
+                                                      cache_creation_input_tokens=2000,
+                                                      cache_read_input_tokens=0), 3.0), 'miss')
+        self.assertEqual(stats.record(SimpleNamespace(input_tokens=10, output_tokens=5,
+                                                      cache_creation_input_tokens=0,
+                                                      cache_read_input_tokens=2000), 1.0), 'hit')
+        self.assertEqual(stats.record(SimpleNamespace(input_tokens=10, output_tokens=5), 1.0), 'uncached')
+        snapshot = stats.snapshot()
+        self.assertEqual((snapshot['hits'], snapshot['misses'], snapshot['uncached']), (1, 1, 1))
+        self.assertEqual(snapshot['hit_rate'], 0.5)
+        self.assertEqual(snapshot['cache_read_tokens'], 2000)
+
+    def test_create_message_sends_request(self):
+        client = MagicMock()
+        client.messages.create.return_value = SimpleNamespace(
+            content=[SimpleNamespace(text="answer")],
+            usage=SimpleNamespace(input_tokens=1, output_tokens=1))
+        request = build_request("system", "knowledge", "question")
+        response = create_message(client, request)
+        self.assertEqual(response.content[0].text, "answer")
+        client.messages.create.assert_called_once_with(**request)
+
+
+class TestStreaming(unittest.IsolatedAsyncioTestCase):
+    async def test_on_start_waits_for_the_budget_check(self):
+        started = []
+
+        async def on_start():
+            started.append(True)
+
+        async def on_text(text):
+            pass
+
+        request = build_request("system", "word " * (MAX_INPUT_TOKENS * 2), "question")
+        with self.assertRaises(TokenBudgetExceeded):
+            await astream_message(MagicMock(), request, on_text, on_start=on_start)
+        self.assertEqual(started, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,10 +26,15 @@ def test_telegram_token():
     """Test Telegram token validity"""
     print("\n🤖 Testing Telegram token...")
     
+    import asyncio
     import telegram
+
+    async def get_me():
+        async with telegram.Bot(token=os.getenv('TELEGRAM_TOKEN')) as bot:
+            return await bot.get_me()
+
     try:
-        bot = telegram.Bot(token=os.getenv('TELEGRAM_TOKEN'))
-        bot_info = bot.get_me()
+        bot_info = asyncio.run(get_me())
         print("✅ Telegram token valid!")
         print(f"Bot username: @{bot_info.username}")
     except Exception as e:
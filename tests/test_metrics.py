@@ -0,0 +1,81 @@
+import asyncio
+import socket
+import time
+import unittest
+from urllib.request import urlopen
+
+from metrics import STAGE_SECONDS, Registry, SamplingProfiler, current_trace, start_metrics_server, start_trace, timed
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        registry = Registry()
+        counter = registry.counter('requests_total', 'Requests', ['outcome'])
+        counter.inc(outcome='ok')
+        counter.inc(2, outcome='ok')
+        histogram = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        registry.gauge('queue', 'Queued', function=lambda: 4)
+        text = registry.render()
+        self.assertIn('# TYPE requests_total counter\nrequests_total{outcome="ok"} 3', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count 3', text)
+        self.assertIn('queue 4', text)
+        with self.assertRaises(ValueError):
+            counter.inc(kind='missing')
+
+    def test_trace_follows_tasks(self):
+        async def job():
+            with timed('work'):
+                await asyncio.sleep(0.01)
+            current_trace().finish('answered')
+
+        async def handler():
+            trace = start_trace('test', group='1')
+            await asyncio.create_task(job())
+            return trace
+
+        before = STAGE_SECONDS.count(stage='work')
+        with self.assertLogs('metrics') as logs:
+            trace = asyncio.run(handler())
+        self.assertGreaterEqual(trace.stages['work'], 0.01)
+        self.assertEqual(trace.outcome, 'answered')
+        self.assertEqual(STAGE_SECONDS.count(stage='work'), before + 1)
+        self.assertIn('command=test group=1 outcome=answered', logs.output[0])
+
+    def test_server_and_profiler(self):
+        registry = Registry()
+        registry.counter('hits_total', 'Hits').inc()
+        self.assertIsNone(start_metrics_server(port=0, metrics=registry))
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        server = start_metrics_server(port=port, metrics=registry, profiling=True)
+        try:
+            with urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+                self.assertIn('hits_total 1', response.read().decode())
+            with urlopen(f'http://127.0.0.1:{port}/debug/profile?seconds=0.1', timeout=5) as response:
+                self.assertIn('MainThread', response.read().decode())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_profiler_sees_busy_thread(self):
+        def spin():
+            end = time.monotonic() + 0.2
+            while time.monotonic() < end:
+                pass
+
+        profiler = SamplingProfiler(interval=0.001).start()
+        spin()
+        profiler.stop()
+        self.assertGreater(profiler.samples, 0)
+        self.assertIn('test_metrics.py:spin', profiler.collapsed())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from preaudit import LRUCache, SourceTooLarge, split_source, fetch_source, audit_chunks
+
+SOLIDITY = '''pragma solidity ^0.8.0;
+
+contract Token {
+    uint256 public total;
+
+    /// @notice Mint tokens
+    /// @param amount How many
+    function mint(uint256 amount) external {
+        total += amount;
+    }
+
+    /**
+     * @notice Burn tokens
+     */
+    function burn(uint256 amount) external {
+        total -= amount;
+    }
+}
+'''
+
+VYPER = '''# @version 0.3.10
+
+total: public(uint256)
+
+@external
+@nonpayable
+def mint(amount: uint256):
+    """
+    @notice Mint tokens
+    @param amount How many
+    """
+    self.total += amount
+
+@external
+def burn(amount: uint256):
+    self.total -= amount
+'''
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=b'', headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        for i in range(0, len(self.body), size):
+            yield self.body[i:i + size]
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        self.calls.append(headers)
+        return self.responses.pop(0)
+
+
+class TestSplitSource(unittest.TestCase):
+    def test_solidity_functions_keep_their_natspec(self):
+        chunks = split_source(SOLIDITY, max_tokens=30)
+        mint = next(chunk for chunk in chunks if 'function mint' in chunk)
+        burn = next(chunk for chunk in chunks if 'function burn' in chunk)
+        self.assertIn('@notice Mint tokens', mint)
+        self.assertIn('@notice Burn tokens', burn)
+        self.assertNotIn('function burn', mint)
+        self.assertEqual('\n'.join(chunks), SOLIDITY)
+
+    def test_vyper_splits_at_decorators_not_docstrings(self):
+        chunks = split_source(VYPER, max_tokens=45)
+        mint = next(chunk for chunk in chunks if 'def mint' in chunk)
+        self.assertTrue(mint.startswith('@external\n@nonpayable\ndef mint'))
+        self.assertIn('@param amount How many', mint)
+        self.assertNotIn('def burn', mint)
+        self.assertEqual('\n'.join(chunks), VYPER)
+
+    def test_small_source_is_one_chunk(self):
+        self.assertEqual(split_source(VYPER), [VYPER])
+
+    def test_oversized_declaration_is_split_by_lines(self):
+        body = '\n'.join(f'    x += {i}' for i in range(400))
+        chunks = split_source(f'@external\ndef big():\n{body}\n', max_tokens=200)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) <= 200 * 4 + 40 for chunk in chunks))
+
+
+class TestFetchSource(unittest.TestCase):
+    def test_etag_revalidation_reuses_cached_source(self):
+        cache = LRUCache()
+        session = FakeSession([
+            FakeResponse(body=b'def f(): pass', headers={'ETag': '"v1"'}),
+            FakeResponse(status_code=304),
+        ])
+        first = fetch_source('https://example.com/a.vy', cache, session)
+        second = fetch_source('https://example.com/a.vy', cache, session)
+        self.assertIs(first, second)
+        self.assertEqual(first.text, 'def f(): pass')
+        self.assertEqual(session.calls[1], {'If-None-Match': '"v1"'})
+
+    def test_size_cap(self):
+        with self.assertRaises(SourceTooLarge):
+            fetch_source('u', LRUCache(), FakeSession([FakeResponse(headers={'Content-Length': '100'})]), max_bytes=10)
+        with self.assertRaises(SourceTooLarge):
+            fetch_source('u', LRUCache(), FakeSession([FakeResponse(body=b'x' * 100)]), max_bytes=10)
+
+
+class TestAuditChunks(unittest.TestCase):
+    def test_findings_in_order_with_bounded_parallelism(self):
+        running = 0
+        peak = 0
+
+        class Messages:
+            async def create(self, **request):
+                nonlocal running, peak
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+                text = request['messages'][-1]['content'].split('\n')[0]
+                if text == 'part 3':
+                    raise RuntimeError('boom')
+                return SimpleNamespace(content=[SimpleNamespace(text=f'findings for {text}')],
+                                       usage=SimpleNamespace(input_tokens=1, output_tokens=1), model='m')
+
+        client = SimpleNamespace(messages=Messages())
+        chunks = [f'part {i}' for i in range(6)]
+        findings, tokens_used = asyncio.run(audit_chunks(client, chunks, parallelism=2))
+        self.assertEqual(findings[0], 'findings for part 0')
+        self.assertEqual(findings[5], 'findings for part 5')
+        self.assertIn('failed', findings[3])
+        self.assertLessEqual(peak, 2)
+        # The failed part used no tokens
+        self.assertEqual(tokens_used, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
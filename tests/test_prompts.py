@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+from llm import build_request
+from prompts import ANSWER_PROMPT, CLI_PROMPT, KnowledgeBase, PromptTemplate
+
+
+class TestKnowledgeBase(unittest.TestCase):
+    def test_load_matches_text(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'kb.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('#### ape.md\n\nÀpe is a framework.\n')
+            loaded = KnowledgeBase.load(path)
+            self.assertEqual(loaded.text, '#### ape.md\n\nÀpe is a framework.\n')
+            self.assertEqual(loaded.digest, KnowledgeBase(loaded.text).digest)
+            open(path, 'w').close()
+            self.assertEqual(KnowledgeBase.load(path).text, '')
+
+
+class TestPromptTemplate(unittest.TestCase):
+    def test_prefix_is_rendered_once_per_version(self):
+        template = PromptTemplate('system', 'KB:\n', '\nEND', 'Q: {question}')
+        knowledge_base = KnowledgeBase('knowledge')
+        first = template.request('first', knowledge_base=knowledge_base)
+        second = template.request('second', knowledge_base=knowledge_base)
+        self.assertIs(first['system'][1], second['system'][1])
+        self.assertEqual(first['system'][1]['text'], 'KB:\nknowledge\nEND')
+        self.assertEqual(first['system'][1]['cache_control'], {"type": "ephemeral"})
+        self.assertEqual(first['messages'], [{"role": "user", "content": "Q: first"}])
+        newer = template.request('first', knowledge_base=KnowledgeBase('knowledge v2'))
+        self.assertEqual(newer['system'][1]['text'], 'KB:\nknowledge v2\nEND')
+
+    def test_same_shape_as_build_request(self):
+        history = [{'role': 'user', 'content': 'q'}, {'role': 'assistant', 'content': 'a'}]
+        for knowledge_base, excerpts, cached in ((KnowledgeBase('kb'), None, True), (None, 'kb', False)):
+            request = CLI_PROMPT.request('{braces} ok', knowledge_base=knowledge_base, excerpts=excerpts,
+                                         history=history, model='m', max_tokens=10)
+            expected = build_request(CLI_PROMPT.system, 'Knowledge Base:\nkb', 'Question: {braces} ok',
+                                     cache_knowledge_base=cached, history=history, model='m', max_tokens=10)
+            self.assertEqual(request, expected)
+
+    def test_answer_prompt_asks_for_a_match_score(self):
+        self.assertIn('% score', ANSWER_PROMPT.system)
+        self.assertIn('START OF KNOWLEDGE BASE', ANSWER_PROMPT.request('q', excerpts='x')['messages'][0]['content'])
+
+
+if __name__ == '__main__':
+    unittest.main()
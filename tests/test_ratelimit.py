@@ -0,0 +1,78 @@
+import threading
+import unittest
+from ratelimit import RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(group_messages=3, group_period=300,
+                                   user_messages=2, user_period=60,
+                                   global_messages=100, global_period=60,
+                                   group_tokens=1000, group_tokens_period=100,
+                                   clock=self.clock)
+
+    def test_user_and_group_quotas(self):
+        self.assertTrue(self.limiter.acquire('g', 'alice').allowed)
+        self.assertTrue(self.limiter.acquire('g', 'alice').allowed)
+        decision = self.limiter.acquire('g', 'alice')
+        self.assertEqual((decision.allowed, decision.scope), (False, 'user'))
+        self.assertAlmostEqual(decision.retry_after, 30)
+        self.assertTrue(self.limiter.acquire('g', 'bob').allowed)
+        decision = self.limiter.acquire('g', 'carol')
+        self.assertEqual((decision.allowed, decision.scope), (False, 'group'))
+        # Other groups are unaffected
+        self.assertTrue(self.limiter.acquire('h', 'alice').allowed)
+
+    def test_rejected_request_takes_nothing(self):
+        self.limiter.acquire('g', 'alice')
+        self.limiter.acquire('g', 'alice')
+        self.limiter.acquire('g', 'alice')  # rejected by the user bucket
+        self.assertTrue(self.limiter.acquire('g', 'bob').allowed)
+
+    def test_refill_and_refund(self):
+        for user in ('a', 'b', 'c'):
+            self.limiter.acquire('g', user)
+        self.assertFalse(self.limiter.acquire('g', 'd').allowed)
+        self.limiter.refund('g', 'c')
+        self.assertTrue(self.limiter.acquire('g', 'd').allowed)
+        self.assertFalse(self.limiter.acquire('g', 'e').allowed)
+        self.clock.now = 100
+        self.assertTrue(self.limiter.acquire('g', 'e').allowed)
+
+    def test_token_budget(self):
+        self.limiter.charge_tokens('g', 1500)
+        decision = self.limiter.acquire('g', 'alice')
+        self.assertEqual((decision.allowed, decision.scope), (False, 'group_tokens'))
+        self.assertIn('token budget', self.limiter.describe(decision))
+        self.clock.now = 60
+        self.assertTrue(self.limiter.acquire('g', 'alice').allowed)
+
+    def test_concurrent_acquire_never_exceeds_quota(self):
+        limiter = RateLimiter(group_messages=50, user_messages=0, global_messages=0, group_tokens=0,
+                              clock=self.clock)
+        allowed = []
+
+        def work():
+            for _ in range(50):
+                if limiter.acquire('g', 'u').allowed:
+                    allowed.append(1)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(allowed), 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+import unittest
+from unittest import mock
+from telegram.error import BadRequest, RetryAfter
+import replies
+from replies import SendQueue, StreamingReply, close_open_code_block, safe_split_message, send_markdown
+
+
+class FakeMessage:
+    """Stand-in for a telegram Message that records replies and edits."""
+
+    def __init__(self, chat=None, chat_id=1):
+        self.chat = chat if chat is not None else []
+        self.chat_id = chat_id
+        self.text = None
+        self.edits = 0
+        self.fail_markdown = False
+        self.retry_after = 0
+
+    async def reply_text(self, text, parse_mode=None):
+        if self.retry_after:
+            retry_after, self.retry_after = self.retry_after, 0
+            raise RetryAfter(retry_after)
+        if parse_mode and self.fail_markdown:
+            raise BadRequest("Can't parse entities")
+        message = FakeMessage(self.chat, self.chat_id)
+        message.text = text
+        self.chat.append(message)
+        return message
+
+    async def edit_text(self, text, parse_mode=None):
+        if self.retry_after:
+            retry_after, self.retry_after = self.retry_after, 0
+            raise RetryAfter(retry_after)
+        if parse_mode and self.fail_markdown:
+            raise BadRequest("Can't parse entities")
+        self.text = text
+        self.edits += 1
+
+    async def delete(self):
+        self.chat.remove(self)
+
+
+class TestCodeBlocks(unittest.TestCase):
+    def test_close_open_code_block(self):
+        self.assertEqual(close_open_code_block("a\n```python\nx"), "a\n```python\nx\n```")
+        self.assertEqual(close_open_code_block("a\n```\nx\n```"), "a\n```\nx\n```")
+
+    def test_split_keeps_lines_and_code_blocks_whole(self):
+        code = "```python\nx = 1\ny = 2\n```"
+        parts = safe_split_message(f"{'a' * 30}\n{code}\nafter", max_length=40)
+        self.assertEqual(parts, [f"{'a' * 30}\n", f"{code}\nafter\n"])
+
+    def test_split_reopens_oversized_code_blocks(self):
+        code = "\n".join(f"value_{i} = {i}" for i in range(40))
+        parts = safe_split_message(f"Intro\n```python\n{code}\n```\nDone", max_length=100)
+        self.assertTrue(all(len(part) <= 100 for part in parts))
+        for part in parts[1:-1]:
+            self.assertTrue(part.startswith("```python\n") and part.endswith("\n```\n"))
+        self.assertEqual("".join(parts).replace("\n```\n```python\n", "\n"), f"Intro\n```python\n{code}\n```\nDone\n")
+
+    def test_split_cuts_overlong_lines(self):
+        parts = safe_split_message("x" * 250, max_length=100)
+        self.assertEqual([len(part) for part in parts], [100, 100, 51])
+
+
+class TestSendQueue(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.waits = []
+
+    async def sleep(self, seconds):
+        self.waits.append(seconds)
+        self.now += seconds
+
+    def queue(self, **kwargs):
+        return SendQueue(clock=lambda: self.now, sleep=self.sleep, **kwargs)
+
+    async def test_paces_each_chat_and_groups(self):
+        queue = self.queue(chat_interval=1, group_per_minute=3, global_per_second=0)
+        for _ in range(4):
+            await queue.call(-100, mock.AsyncMock())
+        # One a second, then the fourth message waits for the group's per minute bucket
+        self.assertEqual(self.waits[:2], [1.0, 1.0])
+        self.assertAlmostEqual(self.now, 20.0)
+        waits = len(self.waits)
+        await queue.call(7, mock.AsyncMock())
+        self.assertEqual(len(self.waits), waits)
+
+    async def test_retries_after_flood_control(self):
+        queue = self.queue(chat_interval=0, global_per_second=0)
+        fn = mock.AsyncMock(side_effect=[RetryAfter(5), 'sent'])
+        self.assertEqual(await queue.call(1, fn), 'sent')
+        self.assertEqual(self.waits, [5.0])
+        self.assertEqual(fn.await_count, 2)
+        fn = mock.AsyncMock(side_effect=RetryAfter(3))
+        with self.assertRaises(RetryAfter):
+            await queue.call(1, fn, retry=False)
+        self.assertFalse(queue.ready(1))
+
+    async def test_send_markdown_falls_back_to_plain_text(self):
+        origin = FakeMessage()
+        origin.fail_markdown = True
+        origin.retry_after = 1
+        sent = await send_markdown(origin, "*unbalanced", queue=self.queue(chat_interval=0, global_per_second=0))
+        self.assertEqual([message.text for message in sent], ["*unbalanced\n"])
+        self.assertEqual(self.waits, [1.0])
+
+
+class TestStreamingReply(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(replies, 'send_queue', SendQueue(chat_interval=0, global_per_second=0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_edits_placeholder_as_text_arrives(self):
+        origin = FakeMessage()
+        reply = StreamingReply(origin, edit_interval=0)
+        await reply.start()
+        for word in ["Hello", " there", ", ape"]:
+            await reply.append(word)
+        await reply.finish()
+        self.assertEqual(len(origin.chat), 1)
+        self.assertEqual(origin.chat[0].text, "Hello there, ape")
+
+    async def test_throttles_edits(self):
+        origin = FakeMessage()
+        reply = StreamingReply(origin, edit_interval=60)
+        await reply.start()
+        for i in range(20):
+            await reply.append(f"word{i} ")
+        await reply.finish()
+        # First delta is shown immediately, then only the final edit
+        self.assertEqual(origin.chat[0].edits, 2)
+
+    async def test_rolls_over_into_new_messages(self):
+        origin = FakeMessage()
+        reply = StreamingReply(origin, edit_interval=0, max_length=50)
+        await reply.start()
+        text = "".join(f"line {i:02d} of the answer\n" for i in range(10))
+        for i in range(0, len(text), 7):
+            await reply.append(text[i:i + 7])
+        await reply.finish()
+        self.assertGreater(len(origin.chat), 1)
+        self.assertTrue(all(len(message.text) <= 50 for message in origin.chat))
+        self.assertEqual("".join(message.text for message in origin.chat), text)
+        self.assertEqual(reply.sent, origin.chat)
+
+    async def test_segment_longer_than_two_messages_is_not_duplicated(self):
+        origin = FakeMessage()
+        reply = StreamingReply(origin, edit_interval=0, max_length=50)
+        await reply.start()
+        text = "".join(f"line {i:02d} of the answer\n" for i in range(12))
+        # One delta worth more than two messages
+        await reply.append(text[:130])
+        await reply.append(text[130:])
+        await reply.finish()
+        self.assertTrue(all(len(message.text) <= 50 for message in origin.chat))
+        self.assertEqual("".join(message.text for message in origin.chat), text)
+
+    async def test_abort_deletes_placeholder_without_text(self):
+        origin = FakeMessage()
+        reply = StreamingReply(origin, edit_interval=0)
+        await reply.start()
+        await reply.abort()
+        self.assertEqual(origin.chat, [])
+        self.assertEqual(reply.sent, [])
+
+    async def test_abort_marks_partial_answer(self):
+        origin = FakeMessage()
+        reply = StreamingReply(origin, edit_interval=60)
+        await reply.start()
+        await reply.append("Partial")
+        await reply.append(" answer")
+        await reply.abort()
+        self.assertEqual(origin.chat[0].text, f"Partial answer\n\n{replies.INTERRUPTED}")
+
+    async def test_replaces_an_earlier_answer(self):
+        origin = FakeMessage()
+        earlier = [await origin.reply_text(f"cheap answer, part {i}") for i in range(3)]
+        reply = StreamingReply(origin, edit_interval=0, reuse=earlier)
+        await reply.start()
+        await reply.append("Better answer")
+        await reply.finish()
+        # Edited over the first message, the rest of the earlier answer is deleted
+        self.assertEqual(origin.chat, earlier[:1])
+        self.assertEqual(origin.chat[0].text, "Better answer")
+        self.assertEqual(reply.sent, earlier[:1])
+
+    async def test_abort_keeps_the_answer_being_replaced(self):
+        origin = FakeMessage()
+        earlier = [await origin.reply_text("cheap answer")]
+        reply = StreamingReply(origin, edit_interval=0, reuse=earlier)
+        await reply.start()
+        await reply.abort()
+        self.assertEqual(origin.chat, earlier)
+        self.assertEqual(origin.chat[0].text, "cheap answer")
+        self.assertEqual(reply.sent, [])
+
+    async def test_falls_back_to_plain_text_and_honours_retry_after(self):
+        origin = FakeMessage()
+        reply = StreamingReply(origin, edit_interval=0)
+        await reply.start()
+        placeholder = origin.chat[0]
+        placeholder.fail_markdown = True
+        await reply.append("*unbalanced")
+        self.assertEqual(placeholder.text, "*unbalanced")
+        placeholder.retry_after = 1
+        await reply.append(" markdown")
+        self.assertEqual(placeholder.text, "*unbalanced")
+        self.assertGreater(reply.next_edit, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
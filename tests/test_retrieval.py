@@ -0,0 +1,56 @@
+import unittest
+from retrieval import KnowledgeIndex, split_sections, split_paragraphs, estimate_tokens
+
+KNOWLEDGE_BASE = """# Knowledge Base
+Generated from: /tmp/knowledge-base
+
+#### deploying-contracts.md
+
+# Deploying
+
+Use `ape run deploy` to deploy a contract to a network.
+
+#### Deploy flags
+
+Pass `--network` to choose the network.
+
+#### testing-contracts.md
+
+Run `ape test` to execute your pytest suite against a local chain.
+
+######## ./docs\\accounts.md
+
+Import an account with `ape accounts import`.
+"""
+
+
+class TestRetrieval(unittest.TestCase):
+    def test_split_sections_on_file_headers(self):
+        sections = split_sections(KNOWLEDGE_BASE)
+        self.assertEqual([source for source, _ in sections],
+                         ['deploying-contracts.md', 'testing-contracts.md', './docs\\accounts.md'])
+        # Markdown "####" headings stay inside their file's section
+        self.assertIn('#### Deploy flags', sections[0][1])
+
+    def test_split_paragraphs_respects_budget(self):
+        text = '\n\n'.join(f'paragraph {i} ' + 'word ' * 50 for i in range(20))
+        pieces = split_paragraphs(text, 100)
+        self.assertGreater(len(pieces), 1)
+        self.assertTrue(all(estimate_tokens(piece) <= 200 for piece in pieces))
+        self.assertEqual(' '.join(pieces).split(), text.split())
+
+    def test_search_ranks_relevant_chunk_first(self):
+        index = KnowledgeIndex.from_text(KNOWLEDGE_BASE)
+        results = index.search('how do I deploy a contract?', k=2)
+        self.assertEqual(results[0][0].source, 'deploying-contracts.md')
+
+    def test_context_includes_source_paths_within_budget(self):
+        index = KnowledgeIndex.from_text(KNOWLEDGE_BASE)
+        context = index.context_for('import an account', k=1)
+        self.assertIn('#### ./docs\\accounts.md', context)
+        self.assertNotIn('ape test', context)
+        self.assertEqual(index.select('deploy', max_tokens=1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+from retry import (CircuitBreaker, CircuitOpen, backoff_delay, call_with_retries, acall_with_retries,
+                   is_retryable)
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def flaky(errors, result='ok'):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+    return fn, calls
+
+
+class TestRetry(unittest.TestCase):
+    def test_classification(self):
+        self.assertTrue(is_retryable(StatusError(529)))
+        self.assertTrue(is_retryable(StatusError(429)))
+        self.assertFalse(is_retryable(StatusError(400)))
+        self.assertTrue(is_retryable(ConnectionResetError()))
+        self.assertFalse(is_retryable(ValueError()))
+
+    def test_backoff_has_full_jitter_and_cap(self):
+        self.assertEqual(backoff_delay(3, base=0.5, cap=20, rng=lambda: 1.0), 4.0)
+        self.assertEqual(backoff_delay(10, base=0.5, cap=20, rng=lambda: 1.0), 20)
+        self.assertEqual(backoff_delay(3, base=0.5, cap=20, rng=lambda: 0.0), 0.0)
+
+    def test_retries_transient_errors(self):
+        sleeps = []
+        fn, calls = flaky([StatusError(529), ConnectionError()])
+        self.assertEqual(call_with_retries(fn, attempts=3, sleep=sleeps.append), 'ok')
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(sleeps), 2)
+
+    def test_does_not_retry_bad_requests_or_vetoed_errors(self):
+        fn, calls = flaky([StatusError(400)])
+        with self.assertRaises(StatusError):
+            call_with_retries(fn, attempts=3, sleep=lambda _: None)
+        self.assertEqual(len(calls), 1)
+
+        fn, calls = flaky([StatusError(529)])
+        with self.assertRaises(StatusError):
+            call_with_retries(fn, attempts=3, sleep=lambda _: None, should_retry=lambda e: False)
+        self.assertEqual(len(calls), 1)
+
+    def test_breaker_fails_fast_then_probes(self):
+        clock = Clock()
+        circuit = CircuitBreaker('claude', failure_threshold=2, reset_timeout=30, clock=clock)
+        fn, calls = flaky([StatusError(503)] * 3)
+        with self.assertRaises(StatusError):
+            call_with_retries(fn, circuit, attempts=2, sleep=lambda _: None)
+        self.assertEqual(circuit.state, 'open')
+        with self.assertRaises(CircuitOpen) as raised:
+            call_with_retries(fn, circuit, sleep=lambda _: None)
+        self.assertAlmostEqual(raised.exception.retry_after, 30)
+        self.assertEqual(len(calls), 2)
+
+        # Failed probe opens the circuit again
+        clock.now = 31
+        self.assertEqual(circuit.state, 'half_open')
+        with self.assertRaises(StatusError):
+            call_with_retries(fn, circuit, attempts=1)
+        self.assertEqual(circuit.state, 'open')
+
+        clock.now = 62
+        self.assertEqual(call_with_retries(fn, circuit, attempts=1), 'ok')
+        self.assertEqual(circuit.state, 'closed')
+        self.assertEqual(circuit.retry_in(), 0)
+
+    def test_only_one_probe_at_a_time(self):
+        clock = Clock()
+        circuit = CircuitBreaker('claude', failure_threshold=1, reset_timeout=10, clock=clock)
+        circuit.record_failure()
+        clock.now = 10
+        circuit.before_call()
+        with self.assertRaises(CircuitOpen):
+            circuit.before_call()
+        circuit.release()
+        circuit.before_call()
+
+    def test_async_variant(self):
+        errors = [StatusError(529)]
+
+        async def fn():
+            if errors:
+                raise errors.pop(0)
+            return 'ok'
+
+        self.assertEqual(asyncio.run(acall_with_retries(fn, attempts=2, base_delay=0)), 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
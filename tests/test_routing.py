@@ -0,0 +1,64 @@
+import unittest
+from retrieval import KnowledgeIndex
+from routing import MODELS, Route, route_for, classify, escalate, confidence_score, should_escalate
+
+KNOWLEDGE_BASE = '''#### userguides/accounts.md
+
+Import an account with `ape accounts import`. Accounts are stored encrypted.
+
+#### userguides/networks.md
+
+Connect to a network with `--network ethereum:mainnet:alchemy`.
+'''
+
+
+class TestRouting(unittest.TestCase):
+    def setUp(self):
+        self.index = KnowledgeIndex.from_text(KNOWLEDGE_BASE)
+
+    def test_short_covered_question_uses_fast_tier(self):
+        route = classify('import accounts ape', self.index)
+        self.assertEqual(route.tier, 'fast')
+        self.assertEqual(route.model, MODELS['fast'])
+
+    def test_uncovered_question_uses_standard_tier(self):
+        self.assertLess(self.index.coverage('kubernetes helm chart'), 0.6)
+        self.assertEqual(classify('kubernetes helm chart', self.index).tier, 'standard')
+
+    def test_code_and_complexity_raise_the_tier(self):
+        self.assertEqual(classify('why is my account locked?').tier, 'standard')
+        self.assertEqual(classify('```python\nfrom ape import accounts\n```').tier, 'standard')
+        self.assertEqual(classify('debug this:\n```python\naccounts.load("me")\n```').tier, 'large')
+        self.assertEqual(classify('word ' * 2000).tier, 'large')
+
+    def test_configured_routes(self):
+        self.assertEqual(route_for('preaudit').tier, 'large')
+        self.assertEqual(route_for('prompt', 'anything', choice='fast').tier, 'fast')
+        custom = route_for('cli', 'anything', choice='claude-custom')
+        self.assertEqual((custom.tier, custom.model), (None, 'claude-custom'))
+        self.assertFalse(custom.can_escalate)
+
+    def test_confidence_score(self):
+        self.assertEqual(confidence_score('Fees are 5%.\n\nKnowledge base match: 85%'), 85)
+        self.assertEqual(confidence_score('Going creative, confidence score: -1'), -1)
+        self.assertIsNone(confidence_score('No score here'))
+        self.assertEqual(confidence_score('About 90% of this answer matches the knowledge base'), 90)
+        # Other percentages in the answer are not the score
+        self.assertEqual(confidence_score('Match score: 85%. Swaps pay a 5% fee'), 85)
+        self.assertIsNone(confidence_score('Deploying costs a 5% fee, and 2% more on L2.'))
+
+    def test_escalation(self):
+        fast = classify('import accounts ape', self.index)
+        self.assertTrue(should_escalate(fast, 'Answer.\n\nMatch score: 20%'))
+        self.assertFalse(should_escalate(fast, 'Answer.\n\nMatch score: 95%'))
+        self.assertFalse(should_escalate(fast, 'Creative answer, confidence score -1'))
+        self.assertFalse(should_escalate(fast, 'Answer without a score'))
+        self.assertFalse(should_escalate(fast, 'Knowledge base match: 90%\n\nThe pool charges a 5% fee.'))
+        standard = escalate(fast)
+        self.assertEqual(standard.tier, 'standard')
+        large = escalate(standard)
+        self.assertFalse(should_escalate(large, 'Match score: 0%'))
+
+
+if __name__ == '__main__':
+    unittest.main()
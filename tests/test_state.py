@@ -0,0 +1,203 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from ratelimit import RateLimiter
+from state import MemoryBackend, RedisBackend, SQLiteBackend
+from storage import Storage
+from stub_servers import StubRedis
+
+
+def run_threads(target, count=8):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class BackendTests:
+    """Contract every backend must meet; make_backend returns a new client of the same state."""
+
+    def make_backend(self):
+        raise NotImplementedError
+
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_get_set_delete_and_ttl(self):
+        backend = self.make_backend()
+        self.assertIsNone(backend.get('a'))
+        backend.set('a', '1')
+        backend.set('b', '2', ttl=0.05)
+        self.assertEqual(backend.get_many(['a', 'b', 'c']), ['1', '2', None])
+        time.sleep(0.1)
+        self.assertIsNone(backend.get('b'))
+        backend.delete('a')
+        self.assertIsNone(backend.get('a'))
+
+    def test_concurrent_increments_are_not_lost(self):
+        backend = self.make_backend()
+
+        def work():
+            client = self.make_backend()
+            for _ in range(25):
+                client.incr('counter')
+
+        run_threads(work)
+        self.assertEqual(backend.get('counter'), '200')
+        self.assertEqual(backend.incr('counter', 5, ttl=60), 205)
+
+    def test_compare_and_set(self):
+        backend = self.make_backend()
+        self.assertTrue(backend.compare_and_set('admin:1', None, '1'))
+        self.assertFalse(backend.compare_and_set('admin:1', None, '2'))
+        self.assertTrue(backend.compare_and_set('admin:1', '1', None))
+        self.assertIsNone(backend.get('admin:1'))
+
+    def test_transact_is_atomic_across_clients(self):
+        backend = self.make_backend()
+        backend.set('x', '0')
+        backend.set('y', '0')
+
+        def move():
+            client = self.make_backend()
+            for _ in range(20):
+                client.transact(['x', 'y'], lambda current: (
+                    {'x': str(int(current['x']) - 1), 'y': str(int(current['y']) + 1)}, None))
+
+        run_threads(move, 4)
+        self.assertEqual(backend.get_many(['x', 'y']), ['-80', '80'])
+
+    def test_scan(self):
+        backend = self.make_backend()
+        backend.set('group:1', 'a')
+        backend.set('group:2', 'b')
+        backend.set('group_x', 'c')
+        backend.set('admin:1', '1')
+        self.assertEqual(backend.scan('group:'), {'group:1': 'a', 'group:2': 'b'})
+
+    def test_notifications_reach_other_clients(self):
+        received = []
+        self.make_backend().subscribe('changes', received.append)
+        time.sleep(0.1)
+        self.make_backend().publish('changes', 'group:1')
+        self.assertTrue(self.wait_for(lambda: received == ['group:1']))
+
+    def test_storage_replicas(self):
+        first, second = Storage(backend=self.make_backend()), Storage(backend=self.make_backend())
+        changes = []
+        second.watch(lambda kind, key: changes.append((kind, key)))
+        time.sleep(0.1)
+        self.assertTrue(first.add_admin('7'))
+        self.assertFalse(second.add_admin('7'))
+        self.assertTrue(first.add_group_if_missing('-100'))
+        self.assertFalse(second.add_group_if_missing('-100'))
+        first.increment_messages('-100')
+        second.increment_messages('-100', 2)
+        admins, groups, _ = second.load()
+        self.assertEqual(admins, {'7': True})
+        self.assertEqual(groups['-100']['messages_today'], 3)
+        self.assertTrue(self.wait_for(lambda: ('admin', '7') in changes and ('group', '-100') in changes))
+
+    def test_rate_limit_is_shared_by_replicas(self):
+        replicas = [RateLimiter(group_messages=30, user_messages=0, global_messages=0, group_tokens=0,
+                                backend=self.make_backend()) for _ in range(3)]
+        allowed = []
+
+        def work(limiter):
+            for _ in range(20):
+                if limiter.acquire('g', 'u').allowed:
+                    allowed.append(1)
+
+        threads = [threading.Thread(target=work, args=(limiter,)) for limiter in replicas]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(allowed), 30)
+
+
+class TestMemoryBackend(BackendTests, unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryBackend()
+
+    def make_backend(self):
+        return self.backend
+
+
+class TestSQLiteBackend(BackendTests, unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.backends = []
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.close()
+        shutil.rmtree(self.temp_dir)
+
+    def make_backend(self):
+        backend = SQLiteBackend(os.path.join(self.temp_dir, 'state.db'), poll_interval=0.02)
+        self.backends.append(backend)
+        return backend
+
+    def test_close_stops_the_poller(self):
+        backend = self.make_backend()
+        backend.subscribe('changes', lambda message: None)
+        backend.close()
+        self.assertFalse(backend._poller.is_alive())
+
+    def test_migrates_old_tables(self):
+        import sqlite3
+        path = os.path.join(self.temp_dir, 'old.db')
+        conn = sqlite3.connect(path)
+        conn.executescript('''
+            CREATE TABLE admins (user_id TEXT PRIMARY KEY);
+            CREATE TABLE groups (group_id TEXT PRIMARY KEY, messages_today INTEGER, last_reset TEXT);
+            CREATE TABLE usage (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            INSERT INTO admins VALUES ('42');
+            INSERT INTO groups VALUES ('-7', 4, '2024-05-01');
+            INSERT INTO usage VALUES ('tokens', '{"input": 3}');
+            INSERT INTO meta VALUES ('yaml_migrated', 'yes');
+        ''')
+        conn.commit()
+        conn.close()
+        storage = Storage(path, backend=SQLiteBackend(path))
+        self.assertTrue(storage.migrate_from_tables())
+        self.assertFalse(storage.migrate_from_tables())
+        self.assertFalse(storage.migrate_from_yaml())
+        admins, groups, usage_data = storage.load()
+        self.assertEqual(admins, {'42': True})
+        self.assertEqual(groups, {'-7': {'messages_today': 0, 'last_reset': '2024-05-01'}})
+        self.assertEqual(usage_data, {'tokens': {'input': 3}})
+
+
+class TestRedisBackend(BackendTests, unittest.TestCase):
+    def setUp(self):
+        self.redis = StubRedis().start()
+        self.backends = []
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.close()
+        self.redis.stop()
+
+    def make_backend(self):
+        backend = RedisBackend(self.redis.url)
+        self.backends.append(backend)
+        return backend
+
+    def test_conflicting_transactions_are_retried(self):
+        self.test_transact_is_atomic_across_clients()
+        self.assertGreater(self.redis.calls['EXEC'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import yaml
+from storage import Storage, today
+
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, 'bot.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_round_trip(self):
+        storage = Storage(self.db_path)
+        storage.add_admin('1')
+        storage.set_group('-100', messages_today=3)
+        storage.set_usage('tokens', {'input': 10})
+        admins, groups, usage_data = Storage(self.db_path).load()
+        self.assertEqual(admins, {'1': True})
+        self.assertEqual(groups, {'-100': {'messages_today': 3, 'last_reset': today()}})
+        self.assertEqual(usage_data, {'tokens': {'input': 10}})
+
+    def test_increment_resets_on_new_day(self):
+        storage = Storage(self.db_path)
+        storage.set_group('-100', messages_today=7, last_reset='2000-01-01')
+        self.assertEqual(storage.increment_messages('-100'), {'messages_today': 1, 'last_reset': today()})
+        self.assertEqual(storage.increment_messages('-100')['messages_today'], 2)
+        with self.assertRaises(KeyError):
+            storage.increment_messages('unknown')
+
+    def test_concurrent_increments_are_not_lost(self):
+        storage = Storage(self.db_path)
+        storage.set_group('-100')
+
+        def work():
+            for _ in range(25):
+                storage.increment_messages('-100')
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(storage.load()[1]['-100']['messages_today'], 100)
+
+    def test_migrates_yaml_once(self):
+        paths = {name: os.path.join(self.temp_dir, f'{name}.yml') for name in ('admins', 'groups', 'usage')}
+        with open(paths['admins'], 'w') as f:
+            yaml.dump({'42': True}, f)
+        with open(paths['groups'], 'w') as f:
+            yaml.dump({'-7': {'messages_today': 4, 'last_reset': '2024-05-01'}}, f)
+
+        storage = Storage(self.db_path)
+        self.assertTrue(storage.migrate_from_yaml(paths['admins'], paths['groups'], paths['usage']))
+        storage.set_group('-7', messages_today=0)
+        self.assertFalse(storage.migrate_from_yaml(paths['admins'], paths['groups'], paths['usage']))
+        admins, groups, _ = storage.load()
+        self.assertEqual(admins, {'42': True})
+        self.assertEqual(groups['-7']['messages_today'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,9 @@
 import os
 import sys
 import argparse
+import asyncio
 import time
 from dotenv import load_dotenv
-from telegram.ext import Updater
 from telegram import Bot
 from telegram.error import TelegramError
 
@@ -11,8 +11,7 @@ class TelegramBotTester:
     def __init__(self):
         load_dotenv()
         self.token = os.getenv('TELEGRAM_TOKEN')
-        self.updater = Updater(token=self.token, use_context=True)
-        self.bot = self.updater.bot
+        self.bot = Bot(token=self.token)
         self.direct_chat_id = None
         self.test_results = []
         
@@ -34,12 +33,16 @@ class TelegramBotTester:
         """Send a message and return success status"""
         print(f"\n📤 Sending: {message}")
         try:
-            self.bot.send_message(chat_id=chat_id, text=message)
+            asyncio.run(self._send(chat_id, message))
             return True
         except Exception as e:
             print(f"❌ Error: {e}")
             return False
 
+    async def _send(self, chat_id, message):
+        async with self.bot:
+            await self.bot.send_message(chat_id=chat_id, text=message)
+
     def run_test_suite(self, chat_id):
         """Run a complete test suite"""
         print(f"\n🧪 Starting test suite on chat ID: {chat_id}")
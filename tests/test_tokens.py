@@ -0,0 +1,67 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+from llm import build_request, create_message, acreate_message
+from tokens import (TokenBudgetExceeded, TokenLedger, estimate_request_tokens, check_budget,
+                    truncate_to_tokens, cost, count_tokens)
+
+
+class TestTokenAccounting(unittest.TestCase):
+    def test_estimate_covers_system_and_messages(self):
+        request = build_request("s" * 400, "k" * 4000, "q" * 40)
+        self.assertEqual(estimate_request_tokens(request), 100 + 1000 + 10 + 3 * 4)
+        uncached = build_request("s" * 400, "k" * 4000, "q" * 40, cache_knowledge_base=False)
+        self.assertAlmostEqual(estimate_request_tokens(uncached), estimate_request_tokens(request), delta=5)
+
+    def test_over_budget_is_rejected_before_the_call(self):
+        client = MagicMock()
+        request = build_request("system", "k" * 1_000_000, "question")
+        with self.assertRaises(TokenBudgetExceeded) as raised:
+            create_message(client, request)
+        self.assertGreater(raised.exception.tokens, raised.exception.budget)
+        client.messages.create.assert_not_called()
+
+        async_client = MagicMock()
+        async_client.messages.create = AsyncMock()
+        with self.assertRaises(TokenBudgetExceeded):
+            asyncio.run(acreate_message(async_client, request))
+        async_client.messages.create.assert_not_called()
+
+    def test_check_budget_disabled_with_zero(self):
+        check_budget(10 ** 9, budget=0)
+
+    def test_truncate_to_tokens(self):
+        text = '\n'.join(f'line {i}' for i in range(1000))
+        truncated = truncate_to_tokens(text, 100)
+        self.assertLessEqual(len(truncated.split('\n\n[...')[0]), 400)
+        self.assertIn('truncated', truncated)
+        self.assertEqual(truncate_to_tokens('short', 100), 'short')
+
+    def test_exact_count_uses_count_endpoint(self):
+        client = MagicMock()
+        client.messages.count_tokens.return_value = SimpleNamespace(input_tokens=42)
+        self.assertEqual(count_tokens(client, build_request("system", "kb", "q")), 42)
+        kwargs = client.messages.count_tokens.call_args.kwargs
+        self.assertEqual(set(kwargs), {'model', 'system', 'messages'})
+
+    def test_cost_and_ledger(self):
+        usage = SimpleNamespace(input_tokens=1_000_000, output_tokens=0,
+                                cache_creation_input_tokens=0, cache_read_input_tokens=1_000_000)
+        self.assertAlmostEqual(cost('claude-3-opus-20240229', usage), 16.5)
+        self.assertAlmostEqual(cost('claude-3-5-sonnet-20241022', usage), 3.3)
+        self.assertEqual(cost('unknown-model', usage), 0.0)
+
+        ledger = TokenLedger()
+        ledger.record('group-a', 'claude-3-opus-20240229', usage)
+        ledger.record('group-a', 'claude-3-opus-20240229', usage)
+        ledger.record('group-b', 'claude-3-haiku-20240307', SimpleNamespace(input_tokens=10, output_tokens=5))
+        self.assertEqual(ledger.totals('group-a')['requests'], 2)
+        self.assertAlmostEqual(ledger.totals('group-a')['cost'], 33.0)
+        self.assertEqual(ledger.totals('missing')['requests'], 0)
+        self.assertEqual(ledger.totals()['requests'], 3)
+        self.assertEqual(ledger.totals()['output_tokens'], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from telegram.ext import Application, CommandHandler
+
+import storage
+
+# Other tests may have imported storage already, so point it at a temp database directly
+os.environ.setdefault('CLAUDE_KEY', 'test')
+storage.DB_PATH = os.path.join(tempfile.mkdtemp(), 'test.db')
+
+import bot
+from stub_servers import StubTelegram
+from webhook import WebhookApp
+
+
+async def call(app, method, path, body=b'', headers=(), client=('203.0.113.5', 1234)):
+    """Run one ASGI request and return (status, body)."""
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': list(headers), 'client': client}
+    await app(scope, receive, send)
+    return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+
+def start_update(update_id=1):
+    return json.dumps({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'text': '/start',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        'chat': {'id': 42, 'type': 'private', 'first_name': 'user'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'user'}}}).encode()
+
+
+class TestWebhook(unittest.TestCase):
+    def setUp(self):
+        self.telegram = StubTelegram().start()
+
+        def build_application():
+            application = Application.builder().token('123:test').base_url(f'{self.telegram.url}/bot').build()
+            application.add_handler(CommandHandler('start', bot.start))
+            return application
+
+        self.app = WebhookApp(build_application, path='/telegram', secret='s3cret', url='')
+
+    def tearDown(self):
+        self.telegram.stop()
+
+    def run_app(self, test):
+        async def run():
+            await self.app.startup()
+            try:
+                await test()
+            finally:
+                await self.app.shutdown()
+        asyncio.run(run())
+
+    def test_update_is_acknowledged_and_handled(self):
+        async def test():
+            status, _ = await call(self.app, 'POST', '/telegram', start_update(),
+                                   [(b'x-telegram-bot-api-secret-token', b's3cret')])
+            self.assertEqual(status, 200)
+            for _ in range(100):
+                if self.telegram.calls['sendMessage']:
+                    break
+                await asyncio.sleep(0.02)
+            self.assertEqual(self.telegram.calls['sendMessage'], 1)
+        self.run_app(test)
+
+    def test_rejected_requests(self):
+        async def test():
+            secret = [(b'x-telegram-bot-api-secret-token', b's3cret')]
+            self.assertEqual((await call(self.app, 'POST', '/telegram', start_update()))[0], 403)
+            self.assertEqual((await call(self.app, 'POST', '/telegram', b'{not json', secret))[0], 400)
+            self.assertEqual((await call(self.app, 'GET', '/telegram'))[0], 405)
+            self.assertEqual((await call(self.app, 'GET', '/nope'))[0], 404)
+            self.assertEqual(await call(self.app, 'GET', '/healthz'), (200, b'ok\n'))
+            self.assertEqual((await call(self.app, 'GET', '/metrics'))[0], 404)
+            status, body = await call(self.app, 'GET', '/metrics', client=('127.0.0.1', 1234))
+            self.assertEqual(status, 200)
+            self.assertIn(b'# TYPE', body)
+        self.run_app(test)
+        self.assertEqual(self.telegram.calls['sendMessage'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
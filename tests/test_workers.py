@@ -0,0 +1,96 @@
+import asyncio
+import unittest
+from workers import RequestQueue, SingleFlight
+
+
+class TestRequestQueue(unittest.IsolatedAsyncioTestCase):
+    async def test_limits_concurrency_per_group_and_globally(self):
+        queue = RequestQueue(max_concurrent=3, max_per_group=1, max_pending=10)
+        running = {'a': 0, 'b': 0, 'c': 0, 'd': 0}
+        peaks = {'total': 0}
+
+        def job(group):
+            async def run():
+                running[group] += 1
+                self.assertLessEqual(running[group], 1)
+                peaks['total'] = max(peaks['total'], sum(running.values()))
+                await asyncio.sleep(0.01)
+                running[group] -= 1
+            return run
+
+        for group in ['a', 'a', 'b', 'c', 'd', 'd']:
+            self.assertTrue(queue.submit(group, job(group)))
+        await queue.join()
+        self.assertEqual(peaks['total'], 3)
+        self.assertEqual(queue.pending, 0)
+        # Idle groups keep no semaphore
+        self.assertEqual(queue._groups, {})
+
+    async def test_rejects_when_full(self):
+        queue = RequestQueue(max_concurrent=1, max_per_group=1, max_pending=1)
+        release = asyncio.Event()
+        self.assertTrue(queue.submit('a', release.wait))
+        self.assertFalse(queue.submit('b', release.wait))
+        release.set()
+        await queue.join()
+
+    async def test_failing_job_does_not_break_queue(self):
+        queue = RequestQueue(max_concurrent=1, max_per_group=1)
+
+        async def fail():
+            raise RuntimeError("boom")
+
+        done = asyncio.Event()
+
+        async def succeed():
+            done.set()
+
+        with self.assertLogs('workers', level='ERROR'):
+            queue.submit('a', fail)
+            queue.submit('a', succeed)
+            await queue.join()
+        self.assertTrue(done.is_set())
+
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_callers_share_one_call(self):
+        flights = SingleFlight()
+        calls = []
+        release = asyncio.Event()
+
+        async def call(value):
+            calls.append(value)
+            await release.wait()
+            return value
+
+        tasks = [asyncio.create_task(flights.do('key', lambda i=i: call(i))) for i in range(3)]
+        other = asyncio.create_task(flights.do('other', lambda: call('other')))
+        await asyncio.sleep(0)
+        self.assertIn('key', flights)
+        release.set()
+        results = await asyncio.gather(*tasks)
+        self.assertEqual(results, [(0, False), (0, True), (0, True)])
+        self.assertEqual(await other, ('other', False))
+        self.assertEqual(calls, [0, 'other'])
+        self.assertEqual(len(flights), 0)
+        # Finished calls are not reused
+        self.assertEqual(await flights.do('key', lambda: call(4)), (4, False))
+
+    async def test_errors_reach_every_caller(self):
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def fail():
+            await release.wait()
+            raise RuntimeError("boom")
+
+        tasks = [asyncio.create_task(flights.do('key', fail)) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertNotIn('key', flights)
+
+if __name__ == '__main__':
+    unittest.main()
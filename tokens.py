@@ -0,0 +1,147 @@
+import os
+from collections import defaultdict
+from threading import Lock
+from typing import Any, Dict, Optional
+
+from retrieval import estimate_tokens
+
+# Largest estimated input (system + messages) sent in one request; Claude 3 models accept 200k
+MAX_INPUT_TOKENS = int(os.getenv('MAX_INPUT_TOKENS', '180000'))
+# Confirm over-budget estimates with the API's count endpoint before rejecting
+EXACT_TOKEN_COUNT = os.getenv('EXACT_TOKEN_COUNT', 'false').lower() in ('1', 'true', 'yes')
+TOKEN_COUNTING_BETA = 'token-counting-2024-11-01'
+
+# Tokens added per message / system block for role markers and formatting
+MESSAGE_OVERHEAD = 4
+
+# USD per million tokens: (input, output, cache write, cache read)
+PRICES = {
+    'claude-3-opus': (15.0, 75.0, 18.75, 1.5),
+    'claude-3-sonnet': (3.0, 15.0, 3.75, 0.3),
+    'claude-3-5-sonnet': (3.0, 15.0, 3.75, 0.3),
+    'claude-3-haiku': (0.25, 1.25, 0.3, 0.03),
+    'claude-3-5-haiku': (0.8, 4.0, 1.0, 0.08),
+}
+
+
+class TokenBudgetExceeded(Exception):
+    """Raised before the network call when a request is larger than the input budget."""
+
+    def __init__(self, tokens: int, budget: int):
+        super().__init__(f"Request is ~{tokens} input tokens, over the budget of {budget}")
+        self.tokens = tokens
+        self.budget = budget
+
+
+def _text_of(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    return ''.join(block.get('text', '') for block in content if isinstance(block, dict))
+
+
+def estimate_request_tokens(request: Dict[str, Any]) -> int:
+    """Fast local estimate of the input tokens of a messages.create request."""
+    system = request.get('system') or []
+    if isinstance(system, str):
+        system = [{'text': system}]
+    tokens = sum(estimate_tokens(block.get('text', '')) + MESSAGE_OVERHEAD for block in system)
+    for message in request.get('messages', []):
+        tokens += estimate_tokens(_text_of(message['content'])) + MESSAGE_OVERHEAD
+    return tokens
+
+
+def _count_kwargs(request: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: request[key] for key in ('model', 'system', 'messages', 'tools') if key in request}
+
+
+def count_tokens(client, request: Dict[str, Any]) -> int:
+    """Exact input token count from the API (one extra round trip, no generation)."""
+    if hasattr(client.messages, 'count_tokens'):
+        return client.messages.count_tokens(**_count_kwargs(request)).input_tokens
+    return client.beta.messages.count_tokens(betas=[TOKEN_COUNTING_BETA], **_count_kwargs(request)).input_tokens
+
+
+async def acount_tokens(client, request: Dict[str, Any]) -> int:
+    """Async variant of count_tokens for an AsyncAnthropic client."""
+    if hasattr(client.messages, 'count_tokens'):
+        return (await client.messages.count_tokens(**_count_kwargs(request))).input_tokens
+    return (await client.beta.messages.count_tokens(betas=[TOKEN_COUNTING_BETA],
+                                                    **_count_kwargs(request))).input_tokens
+
+
+def check_budget(tokens: int, budget: int = MAX_INPUT_TOKENS) -> None:
+    if budget > 0 and tokens > budget:
+        raise TokenBudgetExceeded(tokens, budget)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to about max_tokens, at a line break when possible, noting what was dropped."""
+    max_chars = max(max_tokens, 0) * 4
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind('\n', 0, max_chars)
+    if cut < max_chars // 2:
+        cut = max_chars
+    dropped = estimate_tokens(text[cut:])
+    return f"{text[:cut]}\n\n[... truncated ~{dropped} tokens ...]"
+
+
+def _prices(model: str):
+    # Longest prefix wins, so 'claude-3-5-sonnet-...' is not priced as 'claude-3-sonnet'
+    for prefix in sorted(PRICES, key=len, reverse=True):
+        if model.startswith(prefix):
+            return PRICES[prefix]
+    return None
+
+
+def cost(model: str, usage) -> float:
+    """USD cost of a response's usage, 0.0 for models without a known price."""
+    prices = _prices(model if isinstance(model, str) else '')
+    if prices is None:
+        return 0.0
+    input_price, output_price, write_price, read_price = prices
+    return ((getattr(usage, 'input_tokens', 0) or 0) * input_price
+            + (getattr(usage, 'output_tokens', 0) or 0) * output_price
+            + (getattr(usage, 'cache_creation_input_tokens', 0) or 0) * write_price
+            + (getattr(usage, 'cache_read_input_tokens', 0) or 0) * read_price) / 1_000_000
+
+
+class TokenLedger:
+    """Running token and cost totals per account (group id, CLI name, ...)."""
+
+    FIELDS = ('requests', 'input_tokens', 'output_tokens', 'cache_write_tokens', 'cache_read_tokens', 'cost')
+
+    def __init__(self):
+        self._lock = Lock()
+        self._totals: Dict[str, Dict[str, float]] = defaultdict(lambda: dict.fromkeys(self.FIELDS, 0))
+
+    def record(self, account: str, model: str, usage) -> float:
+        """Add one response's usage to account and return its cost."""
+        amount = cost(model, usage)
+        with self._lock:
+            totals = self._totals[account]
+            totals['requests'] += 1
+            totals['input_tokens'] += getattr(usage, 'input_tokens', 0) or 0
+            totals['output_tokens'] += getattr(usage, 'output_tokens', 0) or 0
+            totals['cache_write_tokens'] += getattr(usage, 'cache_creation_input_tokens', 0) or 0
+            totals['cache_read_tokens'] += getattr(usage, 'cache_read_input_tokens', 0) or 0
+            totals['cost'] += amount
+        return amount
+
+    def totals(self, account: Optional[str] = None) -> Dict[str, float]:
+        """Totals of one account, or of all accounts together."""
+        with self._lock:
+            if account is not None:
+                return dict(self._totals.get(account) or dict.fromkeys(self.FIELDS, 0))
+            combined = dict.fromkeys(self.FIELDS, 0)
+            for totals in self._totals.values():
+                for field in self.FIELDS:
+                    combined[field] += totals[field]
+            return combined
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {account: dict(totals) for account, totals in self._totals.items()}
+
+
+ledger = TokenLedger()
@@ -0,0 +1,173 @@
+"""Webhook mode: an ASGI app that receives Telegram updates over HTTP.
+
+    gunicorn webhook:app -k uvicorn.workers.UvicornWorker -w 4 -b 0.0.0.0:8080
+    python webhook.py              # a single uvicorn process
+    python webhook.py --delete     # remove the webhook to go back to `python bot.py` polling
+
+Each update is acknowledged as soon as it is queued; the bot's handlers run it in the
+background and hand slow Claude calls to the request queue.
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import os
+from typing import Callable, Optional
+
+from telegram import Update
+from telegram.ext import Application
+
+import bot
+from metrics import configure_logging, registry
+
+logger = logging.getLogger(__name__)
+
+# Public base URL Telegram posts to, e.g. https://apegenius.fly.dev; registered on startup when set
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Sent back by Telegram in X-Telegram-Bot-Api-Secret-Token, requests without it are rejected
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+# Concurrent connections Telegram opens to the webhook
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8080'))
+MAX_UPDATE_BYTES = 1024 * 1024
+
+SECRET_HEADER = b'x-telegram-bot-api-secret-token'
+LOOPBACK = ('127.0.0.1', '::1')
+
+
+class WebhookApp:
+    """ASGI app: POST WEBHOOK_PATH takes updates, GET /healthz answers probes.
+
+    GET /metrics is served to local clients only, since a worker cannot bind METRICS_PORT
+    next to its siblings.
+    """
+
+    def __init__(self, build_application: Callable[[], Application] = bot.build_application,
+                 path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET, url: str = WEBHOOK_URL):
+        self.build_application = build_application
+        self.path = path
+        self.secret = secret
+        self.url = url
+        self.application: Optional[Application] = None
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    logger.exception("Webhook startup failed")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self) -> None:
+        configure_logging()
+        await asyncio.to_thread(bot.load_data)
+        self.application = self.build_application()
+        await self.application.initialize()
+        await self.application.start()
+        if self.url:
+            await self.register()
+
+    async def shutdown(self) -> None:
+        # Let in-flight answers finish before the worker exits
+        await bot.request_queue.join()
+        if self.application is not None:
+            await self.application.stop()
+            await self.application.shutdown()
+
+    async def register(self) -> None:
+        """Point Telegram at this webhook, unless a sibling worker already did."""
+        target = self.url + self.path
+        info = await self.application.bot.get_webhook_info()
+        if info.url == target:
+            return
+        await self.application.bot.set_webhook(target, secret_token=self.secret or None,
+                                               max_connections=WEBHOOK_MAX_CONNECTIONS,
+                                               allowed_updates=Update.ALL_TYPES)
+        logger.info("Webhook set to %s", target)
+
+    async def _http(self, scope, receive, send) -> None:
+        path, method = scope['path'], scope['method']
+        if path == self.path:
+            if method != 'POST':
+                await respond(send, 405, b'method not allowed\n')
+                return
+            status = await self.receive_update(scope, receive)
+            await respond(send, status, b'' if status == 200 else b'rejected\n')
+        elif path == '/healthz' and method == 'GET':
+            await respond(send, 200, b'ok\n')
+        elif path == '/metrics' and method == 'GET' and (scope.get('client') or ('',))[0] in LOOPBACK:
+            await respond(send, 200, registry.render().encode(), b'text/plain; version=0.0.4')
+        else:
+            await respond(send, 404, b'not found\n')
+
+    async def receive_update(self, scope, receive) -> int:
+        """Queue the posted update for the bot's handlers; returns the HTTP status."""
+        if self.secret:
+            headers = dict(scope.get('headers') or [])
+            if not hmac.compare_digest(headers.get(SECRET_HEADER, b''), self.secret.encode()):
+                return 403
+        body = bytearray()
+        while True:
+            message = await receive()
+            body.extend(message.get('body', b''))
+            if len(body) > MAX_UPDATE_BYTES:
+                return 413
+            if not message.get('more_body'):
+                break
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning("Rejected malformed update: %s", e)
+            return 400
+        await self.application.update_queue.put(update)
+        return 200
+
+
+async def respond(send, status: int, body: bytes, content_type: bytes = b'text/plain') -> None:
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+app = WebhookApp()
+
+
+async def delete_webhook() -> None:
+    application = bot.build_application()
+    async with application:
+        await application.bot.delete_webhook()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the bot as a Telegram webhook')
+    parser.add_argument('--delete', action='store_true', help='Remove the webhook and exit, to poll again')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WEB_CONCURRENCY', '1')))
+    args = parser.parse_args()
+    if args.delete:
+        asyncio.run(delete_webhook())
+        return
+
+    import uvicorn
+    uvicorn.run('webhook:app', host=WEBHOOK_HOST, port=WEBHOOK_PORT, workers=args.workers,
+                lifespan='on', log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Concurrency limits for slow LLM jobs
+MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', '8'))
+MAX_CONCURRENT_PER_GROUP = int(os.getenv('MAX_CONCURRENT_PER_GROUP', '2'))
+MAX_PENDING_REQUESTS = int(os.getenv('MAX_PENDING_REQUESTS', '100'))
+
+
+class RequestQueue:
+    """In-process queue for slow jobs, bounded globally and per group.
+
+    Handlers submit a job and return immediately, so commands like /start are never
+    stuck behind a Claude call. A group's jobs wait on that group's semaphore before
+    taking a global slot, so one busy group cannot starve the others. A group's semaphore
+    is dropped once none of its jobs is waiting or running.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+                 max_per_group: int = MAX_CONCURRENT_PER_GROUP,
+                 max_pending: int = MAX_PENDING_REQUESTS):
+        self.max_pending = max_pending
+        self.max_per_group = max_per_group
+        self._global = asyncio.Semaphore(max_concurrent)
+        self._groups: Dict[str, asyncio.Semaphore] = {}
+        # Jobs waiting on or holding each group's semaphore
+        self._group_jobs: Dict[str, int] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def submit(self, group_id: str, job: Callable[[], Awaitable[None]]) -> bool:
+        """Schedule job for group_id; returns False if the queue is full."""
+        if len(self._tasks) >= self.max_pending:
+            return False
+        task = asyncio.create_task(self._run(group_id, job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _run(self, group_id: str, job: Callable[[], Awaitable[None]]) -> None:
+        semaphore = self._groups.get(group_id)
+        if semaphore is None:
+            semaphore = self._groups[group_id] = asyncio.Semaphore(self.max_per_group)
+        self._group_jobs[group_id] = self._group_jobs.get(group_id, 0) + 1
+        try:
+            async with semaphore:
+                async with self._global:
+                    try:
+                        await job()
+                    except Exception:
+                        logger.exception("Job for group %s failed", group_id)
+        finally:
+            self._group_jobs[group_id] -= 1
+            if not self._group_jobs[group_id]:
+                del self._group_jobs[group_id]
+                del self._groups[group_id]
+
+    async def join(self) -> None:
+        """Wait for all submitted jobs to finish."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution.
+
+    The first caller of do(key, fn) runs fn; callers arriving while it runs wait for
+    the same result (or exception) instead of running fn again. Nothing is kept once
+    the call finishes.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._flights
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Returns (result, shared), shared being True for callers that joined another's call."""
+        flight = self._flights.get(key)
+        if flight is not None:
+            # Shielded: one waiter being cancelled must not cancel the call for everyone
+            return await asyncio.shield(flight), True
+
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting; don't let an unread exception be logged as lost
+        flight.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        else:
+            flight.set_result(result)
+            return result, False
+        finally:
+            del self._flights[key]